@@ -5,6 +5,7 @@ Generated by 'django-admin startproject' using Django 5.2.6.
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 # -------------------------------------------------------
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'player.metrics.ServerTimingMiddleware',  # Server-Timing header for render stages
 ]
 
 ROOT_URLCONF = 'musicflow.urls'
@@ -62,6 +64,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'player.user_context.user_context',
             ],
         },
     },
@@ -85,8 +88,20 @@ DATABASES = {
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    },
+    # Must be shared by every worker process, or player.sessions reads the database instead. Use Redis
+    # (SESSION_CACHE_URL, needs redis-py) wherever there is one: the file cache lists its whole directory on
+    # every write, so it is kept small, and a session culled from it is just read from the database again.
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['SESSION_CACHE_URL'],
+    } if os.environ.get('SESSION_CACHE_URL') else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('SESSION_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'musicflow_sessions')),
+        'OPTIONS': {'MAX_ENTRIES': 5000, 'CULL_FREQUENCY': 2},  # when full, drop half rather than a third
+    },
 }
+USER_CONTEXT_TIMEOUT = 300  # seconds a user's cached Profile/Dashboard may live; saves invalidate it sooner
 
 # -------------------------------------------------------
 # PASSWORD VALIDATION
@@ -114,6 +129,8 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media').replace('\\', '/')  # Forced / separators for Django storage
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT', '')  # e.g. '/protected-media/': nginx serves generated audio
+AVATAR_WORKERS = 2  # background threads encoding resized profile picture variants (player/avatars.py)
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -157,9 +174,70 @@ else:
 # SESSION SETTINGS - FIXED FOR PROPER PERSISTENCE
 # -------------------------------------------------------
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
-SESSION_SAVE_EVERY_REQUEST = True  # Save session on every request to ensure persistence
+SESSION_SAVE_EVERY_REQUEST = True  # Re-send the cookie on every request so it keeps sliding
 SESSION_COOKIE_HTTPONLY = True  # Prevent JavaScript access to session cookie
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'  # Use database-backed sessions
+SESSION_ENGINE = 'player.sessions'  # Cached, database-backed; written only on change (player/sessions.py)
+SESSION_CACHE_ALIAS = 'sessions'  # shared Redis or file cache; see CACHES
+SESSION_REFRESH_INTERVAL = 3600  # seconds between writes that only slide an unchanged session's expiry
+
+# -------------------------------------------------------
+# RATE LIMITING (player/rate_limit.py)
+# -------------------------------------------------------
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', os.path.join(BASE_DIR, 'rate_limit.sqlite3'))  # shared by all workers on the host
+# Addresses (or networks) of the reverse proxies in front of the app. Requests from them are keyed by the
+# X-Forwarded-For client instead; without this, 'ip' rules count every client behind a proxy together.
+RATE_LIMIT_TRUSTED_PROXIES = [p.strip() for p in os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '').split(',') if p.strip()]
+RATE_LIMITS = {  # per @rate_limit.limit() name: key 'ip', 'account' or 'route'; algorithm 'window' or 'bucket'
+    'login': [  # wrong passwords only (rate_limit.record_failure); no account lockout: anyone can name an account
+        {'key': 'ip', 'algorithm': 'window', 'limit': 10, 'period': 60, 'lockout': True, 'failures': True},
+        {'key': 'account', 'field': 'username', 'algorithm': 'window', 'limit': 5, 'period': 300, 'failures': True},
+    ],
+    'reset': [  # every request sends an email
+        {'key': 'ip', 'algorithm': 'window', 'limit': 10, 'period': 60, 'lockout': True},
+        {'key': 'account', 'field': 'email', 'algorithm': 'window', 'limit': 3, 'period': 900},
+    ],
+    'render': [
+        {'key': 'account', 'algorithm': 'bucket', 'limit': 60, 'period': 60, 'burst': 20},
+        {'key': 'ip', 'algorithm': 'bucket', 'limit': 120, 'period': 60, 'burst': 40},
+    ],
+}
+RATE_LIMIT_LOCKOUT = {'base': 60, 'factor': 2, 'max': 86400, 'forget': 86400}  # seconds; doubles per strike up to max
+
+# -------------------------------------------------------
+# AUDIO RENDERING
+# -------------------------------------------------------
+SYNTH_POOL_SIZE = int(os.environ.get('SYNTH_POOL_SIZE', 2))  # warm synths per guitar type, per worker
+SYNTH_POOL_TIMEOUT = 30  # seconds a request waits for a free synth
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 512 * 1024 * 1024))  # media/generated/ budget
+GENERATED_USER_QUOTA_BYTES = int(os.environ.get('GENERATED_USER_QUOTA_BYTES', 100 * 1024 * 1024))  # per user, in media/generated/
+GENERATED_SWEEP_INTERVAL = int(os.environ.get('GENERATED_SWEEP_INTERVAL', 0))  # seconds between in-process sweeps; 0 = cron only
+RENDER_STREAM_BLOCK_FRAMES = 2048  # samples per streamed block (~46 ms at 44.1 kHz)
+SAMPLE_BANK_DIR = os.path.join(BASE_DIR, 'sample_bank')  # built by `manage.py build_sample_bank`
+RENDER_JOB_BACKEND = 'process'  # 'process' (local worker pool) or 'inline' (run in the request)
+RENDER_JOB_WORKERS = int(os.environ.get('RENDER_JOB_WORKERS', 2))  # render processes per web worker
+RENDER_BATCH_WORKERS = int(os.environ.get('RENDER_BATCH_WORKERS', 4))  # render processes per staff batch request
+RENDER_QUEUE_MAX = 20  # queued + running jobs across all workers before submit returns 429
+RENDER_USER_ACTIVE_MAX = 3  # queued + running jobs per user before submit returns 429
+RENDER_QUEUED_TIMEOUT = 3600  # seconds a job may wait unstarted before it counts as lost and is failed
+RENDER_TIMEOUT = 300  # seconds a render job may run before its worker is killed and replaced
+RENDER_MEMORY_LIMIT = int(os.environ.get('RENDER_MEMORY_LIMIT', 2 * 1024 * 1024 * 1024))  # address space per render worker
+RENDER_CPU_LIMIT = 300  # CPU seconds per render job
+RENDER_COST_MAX = 250_000  # note-seconds (notes x length); costlier renders are refused with 413
+RENDER_COST_LOW_PRIORITY = 25_000  # note-seconds above which a job queues behind cheaper ones
+RENDER_QUOTA_TIERS = {  # per-user token buckets in synth CPU-seconds; a user's tier is 'staff', a group name or 'default'
+    'default': {'capacity': 60, 'refill_per_hour': 300},
+    'pro': {'capacity': 600, 'refill_per_hour': 3600},
+    'staff': None,  # unlimited
+}
+RENDER_QUOTA_SECONDS_PER_COST = 0.005  # CPU-seconds a queued job reserves per note-second of estimated cost
+RENDER_DEFAULT_FORMAT = 'wav'  # when neither ?format= nor Accept picks one: wav, flac, opus or mp3
+RENDER_BENCH_BASELINE = os.path.join(BASE_DIR, 'benchmarks', 'render_baseline.json')  # manage.py bench_render
+RENDER_SEGMENT_WORKERS = int(os.environ.get('RENDER_SEGMENT_WORKERS', 1))  # processes per long render; 1 = single pass
+RENDER_SEGMENT_MIN_SECONDS = 30  # shortest segment worth its own process
+RENDER_COALESCE_TIMEOUT = 120  # seconds a request waits for an identical render already in flight
+RENDER_PREWARM_PROGRESS = os.path.join(BASE_DIR, 'prewarm_progress.json')  # manage.py prewarm_renders
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # bearer token for /metrics; without it only staff can read it
+METRICS_DB = os.environ.get('METRICS_DB', os.path.join(BASE_DIR, 'metrics.sqlite3'))  # counters shared by all workers on the host: metrics, user context versions
 
 # -------------------------------------------------------
 # LOGGING (for debugging email & views)
@@ -8,6 +8,9 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.index, name='index'),  # Added: Serves the root '/' path with player index view
     path('player/', include('player.urls', namespace='player')),
+    path('metrics', views.metrics_view, name='metrics'),
+    # Generated audio: ranges, ETags and long-lived caching, in production too
+    path(f"{settings.MEDIA_URL.strip('/')}/generated/<str:name>", views.serve_generated, name='serve_generated'),
 ]
 
 # CRITICAL: Serve static & media files in development ONLY (DEBUG=True)
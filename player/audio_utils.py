@@ -1,61 +1,206 @@
 import os
-import pretty_midi
+import time
+
 from django.conf import settings
 
+from . import (counters, encoders, generated_files, incremental, metrics, peaks, quality as quality_tiers,
+               render_cache, sample_bank, segmented)
+from .synth_pool import normalize_peak, synth_pool
+
+# Guitar type → .sf2 file in sondfonts/
+SOUNDFONT_FILES = {
+    'acoustic': 'acoustic_guitar.sf2',
+    'bass': 'bass_guitar.sf2',
+    'classical': 'classical_guitar.sf2',
+    'electric': 'electric_guitar.sf2',
+}
+
+
+def get_soundfont_path(guitar_type: str):
+    if guitar_type not in SOUNDFONT_FILES:
+        raise ValueError("Invalid guitar_type. Choose: acoustic, bass, classical, electric")
+    return os.path.join(settings.BASE_DIR, 'sondfonts', SOUNDFONT_FILES[guitar_type])
+
 
-def create_guitar_music(guitar_type: str, notes_list, duration=1.0, filename=None):
+@counters.batch()
+def create_guitar_music(guitar_type: str, notes_list, duration=1.0, filename=None, fmt='wav', bitrate=None,
+                        sample_rate=None, quality='final', base=None, owner=None):
     """
-    Convert notes + guitar type → real .wav file with real guitar sound
+    Convert notes + guitar type → real audio file with real guitar sound
     guitar_type: 'acoustic', 'bass', 'classical', 'electric'
-    notes_list: list of MIDI numbers, e.g. [40, 45, 50, 55]  (E2, A2, D3, G3)
-    duration: how long each note plays (seconds)
-    filename: optional custom name, otherwise auto-generated
-    Returns: full path to the generated .wav file
+    notes_list: list of MIDI numbers, e.g. [40, 45, 50, 55]  (E2, A2, D3, G3), played
+                back to back, or a composition with its own onsets, durations and
+                velocities (anything composition.from_client accepts)
+    duration: how long each note plays (seconds), or a list with one length per note
+    filename: optional custom name; otherwise the file is named after the
+              render's content hash and served from the render cache
+    fmt: output format, see encoders.py ('wav', 'flac', 'opus', 'mp3')
+    bitrate: kbps for lossy formats, None for the encoder default
+    sample_rate: synthesis rate in Hz, default from the quality tier (codecs with
+                 fixed rates may raise it)
+    quality: 'final' or 'preview' (smaller and faster), see quality.py
+    base: URL of an earlier render of an edited version of this composition; only
+          the part of it the edit changed is re-synthesized (see incremental.py)
+    owner: the user a newly written file counts against (see generated_files.py)
+    Returns: URL of the generated audio file
     """
-    # 1. Map guitar type → your .sf2 file
-    soundfont_map = {
-        'acoustic': os.path.join(settings.BASE_DIR, 'sondfonts', 'acoustic_guitar.sf2'),
-        'bass': os.path.join(settings.BASE_DIR, 'sondfonts', 'bass_guitar.sf2'),
-        'classical': os.path.join(settings.BASE_DIR, 'sondfonts', 'classical_guitar.sf2'),
-        'electric': os.path.join(settings.BASE_DIR, 'sondfonts', 'electric_guitar.sf2'),
-    }
-
-    if guitar_type not in soundfont_map:
-        raise ValueError("Invalid guitar_type. Choose: acoustic, bass, classical, electric")
+    # 1. Validate guitar type (the synth pool maps it to the .sf2 file), format and tier
+    get_soundfont_path(guitar_type)
+    with metrics.stage('prepare', guitar_type):
+        encoder = encoders.get_encoder(fmt)
+        bitrate = encoder.check_bitrate(bitrate)
+        tier = quality_tiers.get_tier(quality)
+        sample_rate = encoder.sample_rate_for(sample_rate or tier.sample_rate)
 
-    sf2_path = soundfont_map[guitar_type]
+        # 2. Identical requests hash to the same file – skip synthesis on a hit
+        events = render_cache.normalize_events(notes_list, duration)
+        key = render_cache.render_key(guitar_type, events, sample_rate, fmt, bitrate=bitrate, quality=tier.name)
+    if filename is not None:
+        return _render_counted(guitar_type, events, key, encoder, bitrate, sample_rate, tier, filename, base, owner)
+    cached_url = render_cache.lookup(key, fmt)
+    if cached_url:
+        metrics.count('cache_hits', guitar_type)
+        return cached_url
 
-    # 2. Create MIDI with the notes
-    midi = pretty_midi.PrettyMIDI()
-    guitar = pretty_midi.Instrument(program=25)  # Acoustic Guitar (nylon) – works great with all your sf2
+    # Identical renders already in flight (in any thread or worker) are waited for, not repeated
+    with render_cache.render_lock(key, fmt):
+        cached_url = render_cache.lookup(key, fmt, count_miss=False)
+        if cached_url:
+            metrics.count('coalesced', guitar_type)
+            return cached_url
+        return _render_counted(guitar_type, events, key, encoder, bitrate, sample_rate, tier, filename, base, owner)
 
-    time = 0
-    for pitch in notes_list:
-        note = pretty_midi.Note(
-            velocity=100,  # loudness
-            pitch=pitch,  # MIDI note number
-            start=time,
-            end=time + duration
-        )
-        guitar.notes.append(note)
-        time += duration
 
-    midi.instruments.append(guitar)
+def _render_counted(guitar_type, *args):
+    try:
+        url = _render(guitar_type, *args)
+    except Exception:
+        metrics.count('failures', guitar_type)
+        raise
+    metrics.count('renders', guitar_type)
+    return url
 
-    # 3. Render MIDI → real audio using your .sf2 + fluidsynth.exe
-    audio_data = midi.fluidsynth(sf2_path=sf2_path, fs=44100)
 
-    # 4. Save the .wav file in media/generated/
-    os.makedirs(os.path.join(settings.MEDIA_ROOT, 'generated'), exist_ok=True)
+def _render(guitar_type, events, key, encoder, bitrate, sample_rate, tier, filename, base, owner):
+    fmt = encoder.name
 
-    if filename is None:
-        filename = f"{guitar_type}_song_{pretty_midi.note_number_to_name(notes_list[0])}.wav"
+    # 3. Render the events → real audio on a warm synth that already has the .sf2 loaded.
+    #    An edit of a cached render only re-synthesizes what the edit changed; a long
+    #    composition is rendered in parallel segments when RENDER_SEGMENT_WORKERS allows.
+    previous = _load_base(base, guitar_type, fmt, sample_rate, tier) if filename is None else None
+    audio_data = None
+    if previous is None:
+        started = time.perf_counter()
+        audio_data = segmented.render(guitar_type, events, sample_rate, tail=tier.tail, dtype=tier.dtype)
+        if audio_data is not None:
+            peak = normalize_peak(audio_data)
+            metrics.observe('synthesis', guitar_type, time.perf_counter() - started)
+    if audio_data is None:
+        with synth_pool.borrow(guitar_type, sample_rate=sample_rate) as synth:
+            with metrics.stage('synthesis', guitar_type):
+                if previous is not None:
+                    audio_data, peak, _ = incremental.rerender(synth, *previous, events, tail=tier.tail)
+                else:
+                    audio_data = synth.render_events(events, tail=tier.tail, dtype=tier.dtype, normalize=False)
+                    peak = normalize_peak(audio_data)
 
-    full_path = os.path.join(settings.MEDIA_ROOT, 'generated', filename)
-    import soundfile as sf
-    sf.write(full_path, audio_data, 44100)
+    # 4. Encode into media/generated/
+    with metrics.stage('encode', guitar_type):
+        if filename is None:
+            # Lossless renders keep what an incremental re-render of an edit needs
+            sidecar = ({'events': events, 'peak': peak, 'sample_rate': sample_rate, 'guitar_type': guitar_type}
+                       if encoder.lossless else None)
+            return _store_render(key, audio_data, sample_rate, fmt, bitrate, sidecar=sidecar, owner=owner)
+
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'generated'), exist_ok=True)
+        full_path = os.path.join(settings.MEDIA_ROOT, 'generated', filename)
+        encoders.write_file(full_path, encoders.iter_array_blocks(audio_data), fmt, sample_rate, bitrate)
+        generated_files.record(filename, os.path.getsize(full_path), owner=owner)
 
     # Return the URL so you can play/download it
     file_url = os.path.join(settings.MEDIA_URL, 'generated', filename)
     return file_url
 
+
+@counters.batch()
+def create_guitar_music_fast(guitar_type: str, notes_list, duration=1.0, fmt='wav', bitrate=None,
+                             sample_rate=None, quality='final', owner=None):
+    """
+    Same inputs and result as create_guitar_music, but the audio is assembled
+    from the pre-rendered sample bank (see sample_bank.py) instead of being
+    synthesized. Falls back to create_guitar_music when no bank has been built
+    for this guitar type or any note/length/velocity isn't in it.
+    Bank renders are cached separately from synth renders: they are close
+    but not sample-identical, because each note was recorded on its own.
+    """
+    get_soundfont_path(guitar_type)
+    with metrics.stage('prepare', guitar_type):
+        encoder = encoders.get_encoder(fmt)
+        bitrate = encoder.check_bitrate(bitrate)
+        tier = quality_tiers.get_tier(quality)
+        sample_rate = encoder.sample_rate_for(sample_rate or tier.sample_rate)
+
+        events = render_cache.normalize_events(notes_list, duration)
+        key = render_cache.render_key(guitar_type, events, sample_rate, fmt, bitrate=bitrate, engine='bank',
+                                      quality=tier.name)
+    # A miss is counted once: here if the bank renders it, else by create_guitar_music's own lookup
+    cached_url = render_cache.lookup(key, fmt, count_miss=False)
+    if cached_url:
+        metrics.count('cache_hits', guitar_type)
+        return cached_url
+
+    try:
+        started = time.perf_counter()
+        audio_data = sample_bank.render_events(guitar_type, events, sample_rate, tail=tier.tail)
+        if audio_data is not None:
+            render_cache.record_miss()
+            metrics.observe('synthesis', guitar_type, time.perf_counter() - started)
+            with metrics.stage('encode', guitar_type):
+                url = _store_render(key, audio_data, sample_rate, fmt, bitrate, owner=owner)
+    except Exception:
+        metrics.count('failures', guitar_type)
+        raise
+    if audio_data is None:
+        return create_guitar_music(guitar_type, events, duration, fmt=fmt, bitrate=bitrate,
+                                   sample_rate=sample_rate, quality=tier.name, owner=owner)
+    metrics.count('renders', guitar_type)
+    return url
+
+
+def _load_base(base, guitar_type, fmt, sample_rate, tier):
+    """
+    (audio, peak, events) of a cached render an edit can be spliced into, or
+    None if `base` isn't a lossless render of the same guitar, format and tier
+    at this sample rate, or it has been evicted.
+    """
+    import soundfile as sf
+
+    parsed = render_cache.key_from_url(base)
+    if parsed is None or parsed[1] != fmt or not encoders.ENCODERS[fmt].lossless:
+        return None
+    base_key = parsed[0]
+    if (tier.name != quality_tiers.FINAL) != base_key.startswith(f"{tier.name}-"):
+        return None
+    sidecar = render_cache.load_sidecar(base_key, fmt)
+    if (sidecar is None or str(sidecar.get('guitar_type')) != guitar_type
+            or int(sidecar.get('sample_rate', 0)) != sample_rate):
+        return None
+    try:
+        pcm, _ = sf.read(render_cache.cache_path(base_key, fmt), dtype='int16')
+    except (OSError, RuntimeError):
+        return None
+    return pcm / 32767, float(sidecar['peak']), sidecar['events']
+
+
+def _store_render(key, audio_data, sample_rate, fmt='wav', bitrate=None, sidecar=None, owner=None):
+    """Encode rendered audio into the render cache, with its waveform peaks, and return its URL."""
+    tmp_path = render_cache.temp_path(key, fmt)
+    builder = peaks.PeakBuilder(sample_rate)
+    try:
+        blocks = peaks.tap(encoders.iter_array_blocks(audio_data), builder)
+        encoders.write_file(tmp_path, blocks, fmt, sample_rate, bitrate)
+        return render_cache.store(tmp_path, key, fmt, sidecar=sidecar, peaks=builder.finish(), owner=owner)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
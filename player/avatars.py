@@ -0,0 +1,172 @@
+"""
+Profile picture upload pipeline.
+
+An upload is decoded exactly once, on the request thread, by prepare(): the
+decode itself is the validation (anything Pillow can't read, or a
+decompression bomb, raises InvalidImage), and JPEGs are decoded in draft mode,
+so the decoder scales a phone photo down by up to 8x while reading it instead
+of expanding all of its pixels first. The result is rotated upright from its
+EXIF orientation, centre-cropped to a square and reduced to the largest
+variant size; the EXIF block itself, location included, is left behind.
+
+save() then writes SIZES x FORMATS variants under names derived from a hash
+of the uploaded bytes and the uploader, so the same photo uploaded again maps
+to the same files and never to another user's:
+
+    profile_pics/<hash>-<size>.webp
+    profile_pics/<hash>-<size>.jpg
+
+The largest JPEG is the one stored in Profile.profile_picture and used as the
+plain `src`. It is written before the request returns, so the URL handed back
+is always servable; the others are encoded on a background thread. Pages get
+the rest through srcsets(), which works from the stored name alone.
+"""
+import hashlib
+import logging
+import re
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+SIZES = (64, 128, 256)
+FORMATS = {'webp': 'webp', 'jpeg': 'jpg'}  # Pillow format -> extension
+UPLOAD_DIR = 'profile_pics'
+DEFAULT_WORKERS = 2
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+_NAME = re.compile(rf'^{UPLOAD_DIR}/(?P<digest>[0-9a-f]{{20}})-{max(SIZES)}\.jpg$')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class InvalidImage(ValueError):
+    """Raised by prepare() for an upload that isn't a readable image."""
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'AVATAR_WORKERS', DEFAULT_WORKERS)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='avatar')
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        _executor = None
+
+
+def variant_name(digest, size, fmt):
+    return f'{UPLOAD_DIR}/{digest}-{size}.{FORMATS[fmt]}'
+
+
+def prepare(upload, owner_id):
+    """
+    (digest, image): the hash naming an upload's variants and the upload
+    decoded to an upright, square RGB image of at most max(SIZES) pixels.
+    """
+    data = upload.read()
+    digest = hashlib.sha256(f'{owner_id}:'.encode() + data).hexdigest()[:20]
+    largest = max(SIZES)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+            image = Image.open(BytesIO(data))
+            if image.format == 'JPEG':
+                image.draft('RGB', (largest, largest))
+            image.load()
+            image = ImageOps.exif_transpose(image)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombWarning, Image.DecompressionBombError) as e:
+        raise InvalidImage(f"Not a usable image: {e}") from e
+
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        background = Image.new('RGB', image.size, 'white')  # JPEG has no alpha
+        background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    else:
+        image = image.convert('RGB')
+    side = min(largest, *image.size)
+    return digest, ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+
+
+def _encode(image, size, fmt):
+    if image.width > size:
+        image = image.resize((size, size), Image.Resampling.LANCZOS)
+    out = BytesIO()
+    if fmt == 'jpeg':
+        image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return out.getvalue()
+
+
+def _write(name, data):
+    # Same hash, same bytes: an existing file is already right
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(data))
+
+
+def _write_variants(digest, image, variants):
+    for size, fmt in variants:
+        try:
+            _write(variant_name(digest, size, fmt), _encode(image, size, fmt))
+        except Exception as e:
+            logger.error(f"Could not write avatar variant {variant_name(digest, size, fmt)}: {e}")
+
+
+def save(upload, owner_id):
+    """
+    Validate and decode an upload, write its `src` variant and queue the
+    rest. Returns (name for Profile.profile_picture, Future of the rest).
+    Raises InvalidImage.
+    """
+    digest, image = prepare(upload, owner_id)
+    name = variant_name(digest, max(SIZES), 'jpeg')
+    _write(name, _encode(image, max(SIZES), 'jpeg'))
+    rest = [(size, fmt) for size in SIZES for fmt in FORMATS if (size, fmt) != (max(SIZES), 'jpeg')]
+    return name, _get_executor().submit(_write_variants, digest, image, rest)
+
+
+def names(name):
+    """Every file belonging to a stored picture name: its variants, or just itself for older uploads."""
+    match = _NAME.match(name or '')
+    if match is None:
+        return [name] if name else []
+    return [variant_name(match['digest'], size, fmt) for size in SIZES for fmt in FORMATS]
+
+
+def delete(name):
+    """Delete a stored picture and its variants."""
+    for path in names(name):
+        try:
+            if default_storage.exists(path):
+                default_storage.delete(path)
+        except Exception as e:
+            logger.debug(f"Could not delete profile picture {path}: {e}")
+
+
+def srcsets(name):
+    """
+    {'webp': srcset, 'jpeg': srcset} for a stored picture name, or None for
+    uploads made before variants existed. Built from the name only.
+    """
+    match = _NAME.match(name or '')
+    if match is None:
+        return None
+    return {
+        fmt: ', '.join(f"{default_storage.url(variant_name(match['digest'], size, fmt))} {size}w" for size in SIZES)
+        for fmt in FORMATS
+    }
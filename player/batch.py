@@ -0,0 +1,92 @@
+"""
+Batch rendering for lesson content.
+
+render_batch() takes many (guitar_type, notes, duration) specs, renders them
+in parallel on a process pool sized to the machine, and reports per-item
+results plus aggregate throughput. Used by the `render_batch` management
+command and the staff-only batch API.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .composition import end_time
+from .render_cache import normalize_events
+from .render_jobs import init_worker_process
+from .sample_bank import RELEASE_TAIL
+
+logger = logging.getLogger(__name__)
+
+
+def parse_spec(spec):
+    """
+    Accept {'guitar_type', 'notes', 'duration'} dicts or (guitar_type, notes, duration)
+    triples; `notes` is anything composition.from_client accepts.
+    """
+    if isinstance(spec, dict):
+        return spec.get('guitar_type'), spec.get('notes') or [], spec.get('duration', 1.0)
+    guitar_type, notes_list, duration = spec
+    return guitar_type, notes_list, duration
+
+
+def _render_one(index, spec, owner=None):
+    from .audio_utils import create_guitar_music
+
+    start = time.perf_counter()
+    result = {'index': index, 'url': None, 'error': None, 'audio_seconds': 0.0}
+    try:
+        guitar_type, notes_list, duration = parse_spec(spec)
+        events = normalize_events(notes_list, duration)
+        if not len(events):
+            raise ValueError("No notes given")
+        result['url'] = create_guitar_music(guitar_type, events, owner=owner)
+        result['audio_seconds'] = round(end_time(events) + RELEASE_TAIL, 3)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def render_batch(specs, workers=None, owner=None):
+    """
+    Render every spec and return
+        {'results': [...one dict per spec, in input order...],
+         'renders', 'succeeded', 'failed', 'wall_seconds',
+         'renders_per_second', 'realtime_factor'}
+    A failing item records its error and doesn't stop the rest of the batch.
+    workers=1 renders in this process, which is handy for small batches.
+    owner: id of the user the new files count against (see generated_files.py)
+    """
+    specs = list(specs)
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+
+    if workers == 1 or len(specs) <= 1:
+        results = [_render_one(i, spec, owner) for i, spec in enumerate(specs)]
+    else:
+        results = [None] * len(specs)
+        with ProcessPoolExecutor(max_workers=min(workers, len(specs)), initializer=init_worker_process) as pool:
+            futures = {pool.submit(_render_one, i, spec, owner): i for i, spec in enumerate(specs)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:  # worker process died
+                    results[i] = {'index': i, 'url': None, 'error': f"{type(e).__name__}: {e}",
+                                  'audio_seconds': 0.0, 'seconds': 0.0}
+
+    wall = time.perf_counter() - start
+    succeeded = sum(1 for r in results if r['error'] is None)
+    audio_seconds = sum(r['audio_seconds'] for r in results)
+    logger.info(f"Batch rendered {succeeded}/{len(results)} items in {wall:.2f}s on {workers} workers")
+    return {
+        'results': results,
+        'renders': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'workers': workers,
+        'wall_seconds': round(wall, 3),
+        'renders_per_second': round(succeeded / wall, 3) if wall else 0.0,
+        'realtime_factor': round(audio_seconds / wall, 3) if wall else 0.0,
+    }
@@ -0,0 +1,224 @@
+"""
+Render benchmark suite.
+
+Times every render engine (the synth in one pass, the synth in parallel
+segments on every core, and the sample bank) over a matrix of guitar types,
+note counts and sample rates and records, per case:
+
+    wall_seconds     time spent in the render call (synthesis + encoding)
+    realtime_factor  seconds of audio produced per second of wall time
+    peak_rss_mb      peak resident memory of the process that rendered
+                     (None on Windows, where it isn't measured)
+    output_bytes     size of the generated file
+
+Each case runs in a freshly spawned process by default, so peak RSS belongs to
+that case alone and no case benefits from a synth or bank warmed by another.
+Renders go to a throwaway MEDIA_ROOT, so every case is a cache miss.
+
+compare() checks a run against a saved baseline (a previous run's JSON) and
+lists the cases that got slower, bigger in memory, or changed their output.
+Used by `manage.py bench_render`.
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import django
+from django.conf import settings
+from django.test import override_settings
+from django.utils import timezone
+
+from .audio_utils import SOUNDFONT_FILES
+from .sample_bank import PITCH_RANGES
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ('synth', 'segmented', 'bank')
+DEFAULT_SIZES = (1, 10, 100, 1000, 10000, 100000)
+DEFAULT_SAMPLE_RATES = (22050, 44100, 48000)
+DEFAULT_NOTE_SECONDS = 0.125  # one of the sample bank's lengths, so both engines can play it
+DEFAULT_TOLERANCE = 0.2
+MIN_COMPARABLE_SECONDS = 0.01  # below this, timing differences are noise
+
+
+def default_baseline_path():
+    return getattr(settings, 'RENDER_BENCH_BASELINE',
+                   os.path.join(settings.BASE_DIR, 'benchmarks', 'render_baseline.json'))
+
+
+def case_key(case):
+    return f"{case['engine']}/{case.get('quality', 'final')}/{case['guitar_type']}/{case['sample_rate']}/{case['notes']}"
+
+
+def composition(guitar_type, size):
+    """`size` notes walking the instrument's playable range in fourths and fifths."""
+    low, high = PITCH_RANGES[guitar_type]
+    return [low + (i * 7) % (high - low + 1) for i in range(size)]
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process in MB, or None where the platform can't tell."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(engine, guitar_type, size, sample_rate, note_seconds=DEFAULT_NOTE_SECONDS, fmt='wav', quality='final'):
+    """Render one case and return its measurements."""
+    import soundfile as sf
+
+    from . import audio_utils, sample_bank
+
+    case = {'engine': engine, 'guitar_type': guitar_type, 'notes': size, 'sample_rate': sample_rate,
+            'format': fmt, 'quality': quality, 'note_seconds': note_seconds, 'error': None, 'skipped': None}
+    if engine == 'bank' and sample_bank.get_bank(guitar_type, sample_rate) is None:
+        # create_guitar_music_fast would quietly fall back to the synth
+        case['skipped'] = f"no sample bank for {guitar_type} @ {sample_rate} Hz"
+        return case
+
+    render = audio_utils.create_guitar_music_fast if engine == 'bank' else audio_utils.create_guitar_music
+    notes = composition(guitar_type, size)
+    media_root = tempfile.mkdtemp(prefix='bench_render_')
+    try:
+        segment_workers = os.cpu_count() if engine == 'segmented' else 1
+        with override_settings(MEDIA_ROOT=media_root, RENDER_SEGMENT_WORKERS=segment_workers):
+            start = time.perf_counter()
+            url = render(guitar_type, notes, note_seconds, fmt=fmt, sample_rate=sample_rate, quality=quality)
+            wall = time.perf_counter() - start
+        path = os.path.join(media_root, 'generated', os.path.basename(url))
+        audio_seconds = sf.info(path).duration
+        case.update({
+            'wall_seconds': round(wall, 4),
+            'audio_seconds': round(audio_seconds, 3),
+            'realtime_factor': round(audio_seconds / wall, 2) if wall else None,
+            'output_bytes': os.path.getsize(path),
+        })
+    except Exception as e:
+        case['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+    case['peak_rss_mb'] = _peak_rss_mb()
+    return case
+
+
+def run_suite(guitar_types=None, engines=ENGINES, sizes=DEFAULT_SIZES, sample_rates=DEFAULT_SAMPLE_RATES,
+              note_seconds=DEFAULT_NOTE_SECONDS, fmt='wav', quality='final', isolate=True, progress=None):
+    """
+    Run every (engine, guitar type, sample rate, size) case and return the
+    report dict. isolate=False renders in this process, which is faster but
+    makes peak_rss_mb a running maximum over the whole suite.
+    """
+    guitar_types = guitar_types or sorted(SOUNDFONT_FILES)
+    cases = [(engine, guitar_type, size, sample_rate)
+             for engine in engines for guitar_type in guitar_types
+             for sample_rate in sample_rates for size in sorted(sizes)]
+
+    started = time.perf_counter()
+    results = []
+    for engine, guitar_type, size, sample_rate in cases:
+        if isolate:
+            # One spawned process per case: clean RSS high-water mark, cold synth.
+            # Spawned processes share nothing with this one, so setup is all they need.
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn'),
+                                     initializer=django.setup) as pool:
+                try:
+                    result = pool.submit(run_case, engine, guitar_type, size, sample_rate, note_seconds, fmt,
+                                         quality).result()
+                except Exception as e:  # the render killed its process (e.g. out of memory)
+                    result = {'engine': engine, 'guitar_type': guitar_type, 'notes': size,
+                              'sample_rate': sample_rate, 'format': fmt, 'quality': quality,
+                              'note_seconds': note_seconds,
+                              'error': f"{type(e).__name__}: {e}", 'skipped': None}
+        else:
+            result = run_case(engine, guitar_type, size, sample_rate, note_seconds, fmt, quality)
+        results.append(result)
+        if progress:
+            progress(result)
+
+    logger.info(f"Render benchmark ran {len(results)} cases in {time.perf_counter() - started:.1f}s")
+    return {
+        'created_at': timezone.now().isoformat(),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare a report against a baseline report. A case regresses when its
+    wall time or peak RSS grows by more than `tolerance` (0.2 = 20%), when its
+    output size changes (renders are deterministic), or when it used to
+    succeed and now fails. Cases missing from either side are listed but
+    don't count as regressions.
+    """
+    previous = {case_key(c): c for c in baseline.get('results', [])}
+    current = {case_key(c): c for c in report.get('results', [])}
+    regressions, improvements = [], []
+
+    for key, case in current.items():
+        old = previous.get(key)
+        if old is None or case.get('skipped') or old.get('skipped'):
+            continue
+        if case.get('error'):
+            if not old.get('error'):
+                regressions.append({'case': key, 'metric': 'error', 'baseline': None, 'current': case['error']})
+            continue
+        if old.get('error'):
+            continue
+
+        for metric in ('wall_seconds', 'peak_rss_mb'):
+            before, after = old.get(metric), case.get(metric)
+            if not before or after is None:
+                continue
+            if metric == 'wall_seconds' and max(before, after) < MIN_COMPARABLE_SECONDS:
+                continue
+            ratio = after / before
+            entry = {'case': key, 'metric': metric, 'baseline': before, 'current': after, 'ratio': round(ratio, 3)}
+            if ratio > 1 + tolerance:
+                regressions.append(entry)
+            elif ratio < 1 - tolerance:
+                improvements.append(entry)
+
+        if old.get('output_bytes') != case.get('output_bytes'):
+            regressions.append({'case': key, 'metric': 'output_bytes',
+                                'baseline': old.get('output_bytes'), 'current': case.get('output_bytes')})
+
+    return {
+        'tolerance': tolerance,
+        'baseline_created_at': baseline.get('created_at'),
+        'regressions': regressions,
+        'improvements': improvements,
+        'new_cases': sorted(set(current) - set(previous)),
+        'missing_cases': sorted(set(previous) - set(current)),
+    }
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_report(report, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
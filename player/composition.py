@@ -0,0 +1,179 @@
+"""
+Compositions as NumPy structured arrays.
+
+A composition is a 1-D array of EVENT_DTYPE rows, one per note:
+
+    onset     float64  seconds from the start of the piece
+    duration  float64  seconds the note is held
+    pitch     int16    MIDI note number
+    velocity  int16    MIDI velocity, 1-127
+    string    int8     guitar string the note was played on (1 = high E), -1 if unknown
+    channel   int8     MIDI channel, 0-15
+
+Notes with the same onset form a chord, a duration longer than the gap to the
+next onset is legato, and every note carries its own velocity. Everything
+below works column-wise, so building, validating, hashing and scheduling a
+composition costs the same handful of NumPy calls for 10 notes or 100k, and
+no Python object is created per note.
+"""
+import hashlib
+
+import numpy as np
+
+EVENT_DTYPE = np.dtype([
+    ('onset', '<f8'),
+    ('duration', '<f8'),
+    ('pitch', '<i2'),
+    ('velocity', '<i2'),
+    ('string', 'i1'),
+    ('channel', 'i1'),
+])
+COLUMNS = EVENT_DTYPE.names
+DEFAULT_VELOCITY = 100
+NO_STRING = -1
+TIME_DECIMALS = 6  # microseconds; float noise below this can't change a render
+
+
+def empty(size=0):
+    events = np.zeros(size, dtype=EVENT_DTYPE)
+    events['velocity'] = DEFAULT_VELOCITY
+    events['string'] = NO_STRING
+    return events
+
+
+def from_columns(pitch, onset=None, duration=1.0, velocity=DEFAULT_VELOCITY, string=NO_STRING, channel=0):
+    """
+    Build a composition from per-column arrays (or scalars, which apply to
+    every note). Without `onset` the notes are played back to back.
+    Raises ValueError if the columns don't line up or hold out-of-range values.
+    """
+    try:
+        pitch = np.asarray(pitch, dtype=np.float64).reshape(-1)
+        durations = _column(duration, len(pitch))
+        if onset is None:
+            # Same running sum as playing the notes one after another
+            onsets = np.concatenate(([0.0], np.cumsum(durations)[:-1])) if len(pitch) else durations
+        else:
+            onsets = _column(onset, len(pitch))
+        velocities = _column(velocity, len(pitch))
+        strings = _column(string, len(pitch))
+        channels = _column(channel, len(pitch))
+    except (TypeError, ValueError):
+        raise ValueError("Need exactly one number per note in every column")
+    events = empty(len(pitch))
+
+    for name, values, low, high in (('pitch', pitch, 0, 127), ('velocity', velocities, 1, 127),
+                                    ('string', strings, NO_STRING, 12), ('channel', channels, 0, 15)):
+        if not np.all((values >= low) & (values <= high) & (values == np.round(values))):
+            raise ValueError(f"Note {name}s must be whole numbers between {low} and {high}")
+    if not np.all(np.isfinite(durations) & (durations > 0)):
+        raise ValueError("Note durations must be positive")
+    if not np.all(np.isfinite(onsets) & (onsets >= 0)):
+        raise ValueError("Note onsets must be zero or later")
+
+    events['onset'] = np.round(onsets, TIME_DECIMALS)
+    events['duration'] = np.round(durations, TIME_DECIMALS)
+    events['pitch'] = pitch
+    events['velocity'] = velocities
+    events['string'] = strings
+    events['channel'] = channels
+    return events
+
+
+def _column(values, size):
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 0:
+        return np.broadcast_to(values, (size,))
+    if values.shape != (size,):
+        raise ValueError("column length doesn't match the number of notes")
+    return values
+
+
+def sequence(notes_list, duration=1.0, velocity=DEFAULT_VELOCITY):
+    """The historical input: MIDI numbers played back to back, one length each or per note."""
+    if not isinstance(duration, (int, float)) and len(duration) != len(notes_list):
+        raise ValueError("Need exactly one duration per note")
+    return from_columns(notes_list, duration=duration, velocity=velocity)
+
+
+def from_client(notes, duration=1.0):
+    """
+    Accept any composition shape a client or a stored job can send:
+      [40, 45, 50]                          MIDI numbers, back to back
+      {'pitch': [...], 'onset': [...], ...} columns, scalars broadcast
+      [{'pitch': 40, 'onset': 0.5}, ...]    one dict per note
+      an EVENT_DTYPE array
+    `duration` is the default length for notes that don't give their own.
+    """
+    if isinstance(notes, np.ndarray) and notes.dtype == EVENT_DTYPE:
+        return notes
+    if isinstance(notes, dict):
+        unknown = set(notes) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown note fields: {', '.join(sorted(unknown))}")
+        columns = dict(notes)
+        columns.setdefault('duration', duration)
+        if 'pitch' not in columns:
+            raise ValueError("Notes need a pitch")
+        return from_columns(**columns)
+    notes = list(notes)
+    if notes and isinstance(notes[0], dict):
+        fields = set().union(*notes)
+        if 'pitch' not in fields:
+            raise ValueError("Notes need a pitch")
+        defaults = {'duration': duration, 'velocity': DEFAULT_VELOCITY, 'string': NO_STRING, 'channel': 0}
+        columns = {name: [note.get(name, defaults.get(name)) for note in notes]
+                   for name in fields & set(COLUMNS)}
+        if 'onset' in columns and any(o is None for o in columns['onset']):
+            raise ValueError("Give every note an onset, or none of them")
+        return from_client(columns, duration)
+    return sequence(notes, duration)
+
+
+def as_events(events):
+    """Coerce an EVENT_DTYPE array or [(onset, length, pitch, velocity), ...] rows."""
+    if isinstance(events, np.ndarray) and events.dtype == EVENT_DTYPE:
+        return events
+    rows = np.asarray(events, dtype=np.float64).reshape(-1, 4)
+    return from_columns(rows[:, 2], onset=rows[:, 0], duration=rows[:, 1], velocity=rows[:, 3])
+
+
+def to_columns(events):
+    """JSON-friendly {column: list} form, the inverse of from_client."""
+    return {name: events[name].tolist() for name in COLUMNS}
+
+
+def end_time(events):
+    """When the last note is released, in seconds."""
+    return float((events['onset'] + events['duration']).max()) if len(events) else 0.0
+
+
+def sort(events):
+    """Canonical note order: by onset, then pitch, then the remaining columns."""
+    order = np.lexsort((events['channel'], events['string'], events['velocity'],
+                        events['duration'], events['pitch'], events['onset']))
+    return events[order]
+
+
+def digest(events):
+    """Content hash of a composition; sort() it first to ignore note order."""
+    return hashlib.sha256(np.ascontiguousarray(events).tobytes()).hexdigest()
+
+
+def schedule(events, sample_rate):
+    """
+    The MIDI messages a composition turns into, as parallel arrays sorted by
+    time: (sample, is_on, pitch, velocity, channel). Like pretty_midi, a
+    note-off sorts before a note-on at the same sample, and ties otherwise
+    keep note order.
+    """
+    n = len(events)
+    samples = np.empty(2 * n, dtype=np.int64)
+    samples[:n] = (sample_rate * events['onset']).astype(np.int64)
+    samples[n:] = (sample_rate * (events['onset'] + events['duration'])).astype(np.int64)
+    is_on = np.repeat(np.array([1, 0], dtype=np.int8), n)
+    pitch = np.tile(events['pitch'], 2)
+    velocity = np.concatenate([events['velocity'], np.zeros(n, dtype=events['velocity'].dtype)])
+    channel = np.tile(events['channel'], 2)
+    order = np.lexsort((is_on, samples))
+    return samples[order], is_on[order], pitch[order], velocity[order], channel[order]
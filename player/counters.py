@@ -0,0 +1,134 @@
+"""
+Counters shared by every worker process on the host.
+
+The render metrics and the render cache's hit/miss stats count into here
+rather than into the Django cache: the default LocMemCache is private to each
+process, so a counter kept there only ever sees the renders of whichever
+worker answers the scrape, and starts again from zero when it restarts.
+
+user_context.py keeps its per-user cache versions here for the same reason:
+a version bumped by one process is seen by all of them.
+
+Counters live in a SQLite file (METRICS_DB), one row per name. incr() is a
+single UPSERT in its own transaction, so increments from any number of
+processes add up exactly. If the file can't be used the increment is dropped
+and a warning logged: counting never fails a render.
+
+A render counts half a dozen things (stages, hits, stores...). Inside a
+batch() block, add() collects them and they are written together, in one
+transaction, when the block ends.
+"""
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BUSY_TIMEOUT = 5.0  # seconds to wait for another process's write
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);"
+
+_local = threading.local()
+_pending = contextvars.ContextVar('counters_pending', default=None)
+
+
+def _path():
+    return getattr(settings, 'METRICS_DB', None) or os.path.join(settings.BASE_DIR, 'metrics.sqlite3')
+
+
+def _connection():
+    """This thread's connection to the counters file, opened again after a fork or a settings change."""
+    path = _path()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.key != (os.getpid(), path):
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        _local.conn, _local.key = conn, (os.getpid(), path)
+    return conn
+
+
+def incr_many(amounts):
+    """Add {name: amount} to the counters in one transaction."""
+    try:
+        conn = _connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO counters (name, value) VALUES (?, ?) '
+                             'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                             list(amounts.items()))
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    except sqlite3.Error as e:
+        logger.warning(f"Counters unavailable, dropping {amounts}: {e}")
+
+
+def incr(name, amount=1):
+    incr_many({name: amount})
+
+
+def add(amounts):
+    """incr_many(), or folded into the enclosing batch() to be written when it ends."""
+    pending = _pending.get()
+    if pending is None:
+        incr_many(amounts)
+        return
+    for name, amount in amounts.items():
+        pending[name] = pending.get(name, 0) + amount
+
+
+@contextmanager
+def batch():
+    """
+    @counters.batch()
+    def create_guitar_music(...): ...
+
+    Every add() in the block is written in one transaction at its end, even
+    if it raises. A nested block joins the outermost one.
+    """
+    if _pending.get() is not None:
+        yield
+        return
+    amounts = {}
+    token = _pending.set(amounts)
+    try:
+        yield
+    finally:
+        _pending.reset(token)
+        if amounts:
+            incr_many(amounts)
+
+
+def get_many(names):
+    """{name: value} for the given counters; ones never incremented are 0."""
+    names = list(names)
+    values = dict.fromkeys(names, 0)
+    try:
+        conn = _connection()
+        for start in range(0, len(names), 500):  # under SQLite's bound-parameter limit
+            chunk = names[start:start + 500]
+            values.update(conn.execute(f"SELECT name, value FROM counters WHERE name IN "
+                                       f"({', '.join('?' * len(chunk))})", chunk).fetchall())
+    except sqlite3.Error as e:
+        logger.warning(f"Counters unavailable: {e}")
+    return values
+
+
+def get(name):
+    return get_many([name])[name]
+
+
+def reset(prefix=''):
+    """Forget every counter whose name starts with `prefix` (all of them by default)."""
+    try:
+        _connection().execute('DELETE FROM counters WHERE substr(name, 1, ?) = ?', (len(prefix), prefix))
+    except sqlite3.Error as e:
+        logger.warning(f"Counters unavailable: {e}")
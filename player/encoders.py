@@ -0,0 +1,203 @@
+"""
+Output encoders for generated audio.
+
+Every encoder writes PCM block by block through libsndfile (via soundfile),
+so a render never has to exist as one big array just to be encoded. Which
+formats are usable depends on the libsndfile build; available_formats()
+only lists the ones it can actually write.
+
+    wav   16-bit PCM, the historical default
+    flac  lossless, roughly half the size of WAV
+    opus  Ogg/Opus, 48 kHz only, bitrate selectable (6-256 kbps)
+    mp3   MPEG layer III, constant bitrate (32-320 kbps)
+
+Only formats that never seek backwards while writing (wav through our own
+streaming header, and Ogg/Opus) can be sent as a live HTTP stream.
+"""
+import logging
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_FRAMES = 65536
+
+
+class Encoder:
+    def __init__(self, name, content_type, sf_format, subtype, content_types=(), sample_rates=None,
+                 bitrate_range=None, default_bitrate=None, bitrate_mode=None, streamable=False):
+        self.name = name
+        self.extension = name
+        self.content_type = content_type
+        self.content_types = (content_type,) + tuple(content_types)  # Accept header aliases
+        self.sf_format = sf_format
+        self.subtype = subtype
+        self.sample_rates = sample_rates
+        self.bitrate_range = bitrate_range
+        self.default_bitrate = default_bitrate
+        self.bitrate_mode = bitrate_mode
+        self.streamable = streamable
+
+    @property
+    def lossless(self):
+        return self.bitrate_range is None
+
+    def available(self):
+        import soundfile as sf
+        return (self.sf_format in sf.available_formats()
+                and self.subtype in sf.available_subtypes(self.sf_format))
+
+    def sample_rate_for(self, requested):
+        """The rate to render at: `requested` unless the codec can't take it."""
+        if not self.sample_rates or requested in self.sample_rates:
+            return requested
+        higher = [r for r in self.sample_rates if r >= requested]
+        return min(higher) if higher else max(self.sample_rates)
+
+    def check_bitrate(self, bitrate):
+        """Validate a kbps value; None means the encoder's default."""
+        if bitrate is None:
+            return self.default_bitrate
+        if not self.bitrate_range:
+            raise ValueError(f"{self.name} does not take a bitrate")
+        low, high = self.bitrate_range
+        if not low <= bitrate <= high:
+            raise ValueError(f"{self.name} bitrate must be between {low} and {high} kbps")
+        return int(bitrate)
+
+    def open(self, file, sample_rate, channels=1, bitrate=None):
+        import soundfile as sf
+
+        kwargs = {}
+        bitrate = self.check_bitrate(bitrate)
+        if bitrate is not None:
+            # libsndfile takes a 0..1 "compression level" instead of a bitrate;
+            # both lossy codecs map it linearly from max to min bitrate.
+            low, high = self.bitrate_range
+            kwargs['compression_level'] = min(0.99, (high - bitrate) / (high - low))
+            if self.bitrate_mode:
+                kwargs['bitrate_mode'] = self.bitrate_mode
+        return sf.SoundFile(file, 'w', samplerate=sample_rate, channels=channels,
+                            format=self.sf_format, subtype=self.subtype, **kwargs)
+
+
+ENCODERS = {
+    'wav': Encoder('wav', 'audio/wav', 'WAV', 'PCM_16', content_types=('audio/x-wav', 'audio/wave'),
+                   streamable=True),
+    'flac': Encoder('flac', 'audio/flac', 'FLAC', 'PCM_16', content_types=('audio/x-flac',)),
+    'opus': Encoder('opus', 'audio/ogg', 'OGG', 'OPUS', content_types=('audio/opus', 'application/ogg'),
+                    sample_rates=(48000,), bitrate_range=(6, 256), default_bitrate=96, streamable=True),
+    'mp3': Encoder('mp3', 'audio/mpeg', 'MP3', 'MPEG_LAYER_III', content_types=('audio/mp3',),
+                   bitrate_range=(32, 320), default_bitrate=192, bitrate_mode='CONSTANT'),
+}
+# When a client accepts several formats equally, send the smallest
+PREFERENCE = ('opus', 'mp3', 'flac', 'wav')
+
+
+def available_formats(streaming=False):
+    return [name for name in PREFERENCE
+            if ENCODERS[name].available() and (ENCODERS[name].streamable or not streaming)]
+
+
+def get_encoder(fmt, streaming=False):
+    encoder = ENCODERS.get(fmt)
+    if encoder is None or fmt not in available_formats(streaming):
+        raise ValueError(f"Unsupported audio format: {fmt}. Choose: {', '.join(available_formats(streaming))}")
+    return encoder
+
+
+def negotiate(request, streaming=False):
+    """
+    Pick the output format for a request: an explicit ?format= wins, then the
+    best explicitly listed type in the Accept header, then RENDER_DEFAULT_FORMAT.
+    Wildcards (audio/*, */*) never override the default.
+    Raises ValueError for an unknown or unavailable ?format=.
+    """
+    default = getattr(settings, 'RENDER_DEFAULT_FORMAT', 'wav')
+    explicit = request.GET.get('format') or request.POST.get('format')
+    if explicit:
+        get_encoder(explicit, streaming)
+        return explicit
+
+    usable = available_formats(streaming)
+    best, best_q = None, 0.0
+    for item in request.META.get('HTTP_ACCEPT', '').split(','):
+        media_type, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        for name in usable:
+            if media_type.strip().lower() in ENCODERS[name].content_types:
+                if q > best_q or (q == best_q and best and usable.index(name) < usable.index(best)):
+                    best, best_q = name, q
+    return best or default
+
+
+def iter_array_blocks(audio, block_frames=DEFAULT_BLOCK_FRAMES):
+    """Views over a rendered array, so encoders can consume it like a live render."""
+    for start in range(0, len(audio), block_frames):
+        yield audio[start:start + block_frames]
+
+
+def write_file(path, blocks, fmt, sample_rate, bitrate=None):
+    """Encode PCM blocks (float in -1..1 or int16) into `path`, one block at a time."""
+    encoder = get_encoder(fmt)
+    with encoder.open(path, sample_rate, bitrate=bitrate) as f:
+        for block in blocks:
+            f.write(block)
+
+
+class _ChunkSink:
+    """
+    Write-only file object that hands out whatever libsndfile has written so
+    far. It only supports the seeks a non-seeking encoder makes (to where it
+    already is), which is why only streamable encoders may use it.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        target = {0: offset, 1: self._pos + offset, 2: self._pos + offset}[whence]
+        if target != self._pos:
+            raise OSError("stream is not seekable")
+        return self._pos
+
+    def read(self, size=-1):
+        return b''
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_encoded(blocks, fmt, sample_rate, bitrate=None):
+    """Encode PCM blocks on the fly, yielding compressed bytes as they are produced."""
+    encoder = get_encoder(fmt, streaming=True)
+    sink = _ChunkSink()
+    with encoder.open(sink, sample_rate, bitrate=bitrate) as f:
+        for block in blocks:
+            f.write(np.asarray(block))
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
@@ -0,0 +1,228 @@
+"""
+Index and garbage collection of media/generated/.
+
+Every file written to media/generated/ gets a GeneratedFile row (owner, size,
+render hash, last access), and render cache hits bump its last access. The
+sweeps below work from that table alone, so they cost a few queries however
+many files there are:
+
+    evict()           least recently used files go until the directory fits
+                      in RENDER_CACHE_MAX_BYTES (also run after every store)
+    enforce_quotas()  every user's oldest files go until they are within
+                      GENERATED_USER_QUOTA_BYTES (the owner of a shared,
+                      content-addressed render is whoever rendered it first)
+    sweep()           quotas, then the global budget
+
+sweep() runs from `manage.py sweep_generated` (cron) or, with
+GENERATED_SWEEP_INTERVAL set, from a background thread in each process; a
+cache lock keeps processes sharing a cache from sweeping at the same time.
+rebuild_index() reconciles the table with the disk once, e.g. for files
+written before the index existed.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from . import render_cache
+from .models import GeneratedFile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_QUOTA_BYTES = 100 * 1024 * 1024
+DELETE_BATCH = 500
+SWEEP_LOCK = 'generated_files_sweep'
+
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+
+def _owner_id(owner):
+    return getattr(owner, 'pk', owner)
+
+
+def record(name, size, key='', owner=None):
+    """Index a file that was just written to media/generated/."""
+    try:
+        GeneratedFile.objects.update_or_create(
+            name=name, defaults={'size': size, 'key': key, 'last_access': timezone.now()},
+            create_defaults={'size': size, 'key': key, 'owner_id': _owner_id(owner), 'last_access': timezone.now()})
+    except DatabaseError as e:
+        logger.warning(f"Could not index generated file {name}: {e}")
+
+
+def touch(name):
+    """Mark a file as just used."""
+    try:
+        GeneratedFile.objects.filter(name=name).update(last_access=timezone.now())
+    except DatabaseError as e:
+        logger.warning(f"Could not update last access of {name}: {e}")
+
+
+def usage():
+    """(files, bytes) in the index."""
+    totals = GeneratedFile.objects.aggregate(files=Count('pk'), size=Sum('size'))
+    return totals['files'], totals['size'] or 0
+
+
+def _delete(entries, dry_run=False):
+    """Delete (name, size) entries from disk and the index; returns (files, bytes)."""
+    if dry_run:
+        return len(entries), sum(size for _, size in entries)
+    root = os.path.join(settings.MEDIA_ROOT, render_cache.CACHE_DIR)
+    freed = 0
+    for name, size in entries:
+        try:
+            os.remove(os.path.join(root, name))
+        except FileNotFoundError:
+            pass  # already gone; dropping the row is all that's left
+        for suffix in render_cache.COMPANION_SUFFIXES:
+            try:
+                os.remove(os.path.join(root, f".{name}{suffix}"))
+            except FileNotFoundError:
+                pass
+        freed += size
+        render_cache.count_eviction(size)
+        logger.info(f"Evicted generated file {name} ({size} bytes)")
+    names = [name for name, _ in entries]
+    for start in range(0, len(names), DELETE_BATCH):
+        GeneratedFile.objects.filter(name__in=names[start:start + DELETE_BATCH]).delete()
+    return len(entries), freed
+
+
+def _oldest_until(queryset, excess):
+    """The least recently used (name, size) rows of `queryset` adding up to at least `excess` bytes."""
+    entries, total = [], 0
+    for name, size in queryset.order_by('last_access').values_list('name', 'size').iterator():
+        if total >= excess:
+            break
+        entries.append((name, size))
+        total += size
+    return entries
+
+
+def evict(max_bytes=None, keep=None, dry_run=False):
+    """
+    Delete least recently used files until the directory fits in max_bytes
+    (default RENDER_CACHE_MAX_BYTES). `keep` protects one file name.
+    Returns (files, bytes) deleted.
+    """
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'RENDER_CACHE_MAX_BYTES', render_cache.DEFAULT_MAX_BYTES)
+    _, total = usage()
+    if total <= max_bytes:
+        return 0, 0
+    candidates = GeneratedFile.objects.exclude(name=keep) if keep else GeneratedFile.objects.all()
+    return _delete(_oldest_until(candidates, total - max_bytes), dry_run)
+
+
+def enforce_quotas(quota=None, dry_run=False):
+    """
+    Delete each user's least recently used files until they are within
+    `quota` bytes (default GENERATED_USER_QUOTA_BYTES).
+    Returns (users over quota, files, bytes deleted).
+    """
+    if quota is None:
+        quota = getattr(settings, 'GENERATED_USER_QUOTA_BYTES', DEFAULT_USER_QUOTA_BYTES)
+    over = (GeneratedFile.objects.filter(owner__isnull=False).values('owner')
+            .annotate(total=Sum('size')).filter(total__gt=quota).values_list('owner', 'total'))
+    files = freed = users = 0
+    for owner_id, total in over:
+        deleted, size = _delete(_oldest_until(GeneratedFile.objects.filter(owner_id=owner_id), total - quota),
+                                dry_run)
+        users, files, freed = users + 1, files + deleted, freed + size
+    return users, files, freed
+
+
+def sweep(max_bytes=None, user_quota=None, dry_run=False):
+    """Enforce per-user quotas, then the global budget. Returns a report dict."""
+    started = time.perf_counter()
+    users, quota_files, quota_bytes = enforce_quotas(user_quota, dry_run)
+    budget_files, budget_bytes = evict(max_bytes, dry_run=dry_run)
+    files, size = usage()
+    report = {
+        'users_over_quota': users,
+        'quota_files': quota_files,
+        'quota_bytes': quota_bytes,
+        'budget_files': budget_files,
+        'budget_bytes': budget_bytes,
+        'files': files,
+        'bytes': size,
+        'dry_run': dry_run,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    logger.info(f"Generated media sweep freed {quota_bytes + budget_bytes} bytes "
+                f"({quota_files + budget_files} files); {size} bytes in {files} files left")
+    return report
+
+
+def rebuild_index():
+    """
+    Reconcile the index with media/generated/: index files it doesn't know
+    (last access = mtime, no owner) and drop rows whose file is gone.
+    This is the one operation that lists the directory. Returns (added, removed).
+    """
+    root = os.path.join(settings.MEDIA_ROOT, render_cache.CACHE_DIR)
+    on_disk = {}
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    st = entry.stat()
+                    on_disk[entry.name] = (st.st_size, st.st_mtime)
+    except FileNotFoundError:
+        pass
+
+    indexed = set(GeneratedFile.objects.values_list('name', flat=True).iterator())
+    tz = dt_timezone.utc if settings.USE_TZ else None
+    new = []
+    for name in on_disk.keys() - indexed:
+        size, mtime = on_disk[name]
+        parsed = render_cache.key_from_url(name)
+        new.append(GeneratedFile(name=name, size=size, key=parsed[0] if parsed else '',
+                                 last_access=datetime.fromtimestamp(mtime, tz)))
+    GeneratedFile.objects.bulk_create(new, batch_size=DELETE_BATCH, ignore_conflicts=True)
+    gone = list(indexed - on_disk.keys())
+    for start in range(0, len(gone), DELETE_BATCH):
+        GeneratedFile.objects.filter(name__in=gone[start:start + DELETE_BATCH]).delete()
+    return len(new), len(gone)
+
+
+def _sweep_periodically(interval):
+    while True:
+        time.sleep(interval)
+        # One process per interval when they share a cache
+        if not cache.add(SWEEP_LOCK, os.getpid(), timeout=max(1, int(interval) - 1)):
+            continue
+        try:
+            sweep()
+        except Exception as e:
+            logger.error(f"Generated media sweep failed: {e}")
+        finally:
+            close_old_connections()
+
+
+def start_periodic_sweep():
+    """
+    Start the background sweeper in this process if GENERATED_SWEEP_INTERVAL
+    (seconds) is set and it isn't running yet. Safe to call on every render;
+    a forked child starts its own.
+    """
+    global _sweeper_pid
+    interval = getattr(settings, 'GENERATED_SWEEP_INTERVAL', 0)
+    if not interval or _sweeper_pid == os.getpid():
+        return
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+        threading.Thread(target=_sweep_periodically, args=(interval,), name='generated-sweeper',
+                         daemon=True).start()
+        logger.info(f"Sweeping media/generated/ every {interval}s")
@@ -0,0 +1,110 @@
+"""
+Incremental re-rendering of edited compositions.
+
+When a composition changes by a few notes, most of its audio is unchanged.
+rerender() diffs the new events against the ones a cached render was made
+from, finds the window the changed notes can be heard in (onset to note-off
+plus the release tail), re-synthesizes only that window and splices it into
+the cached PCM. The work scales with the edit, not with the song.
+
+The window is padded by CROSSFADE_SECONDS on both sides and the splice is
+crossfaded inside that padding, where old and new audio contain exactly the
+same notes, so the seams are inaudible. Notes that are already sounding when
+the window starts are re-rendered from their own onset (the "lookback"), so
+they enter the window with the right envelope.
+
+A splice is within a quantization step or so of a full render; the residual
+differences are synth state that doesn't follow the notes (reverb/chorus
+tails from before the window).
+"""
+import logging
+
+import numpy as np
+
+from . import composition
+from .synth_pool import normalize_peak
+
+logger = logging.getLogger(__name__)
+
+CROSSFADE_SECONDS = 0.01
+
+
+def changed_events(old, new):
+    """Events present in one composition but not the other (as a multiset)."""
+    row = np.dtype((np.void, composition.EVENT_DTYPE.itemsize))
+    old_rows = np.ascontiguousarray(old).view(row)
+    new_rows = np.ascontiguousarray(new).view(row)
+    unique, inverse = np.unique(np.concatenate([old_rows, new_rows]), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    old_counts = np.bincount(inverse[:len(old_rows)], minlength=len(unique))
+    new_counts = np.bincount(inverse[len(old_rows):], minlength=len(unique))
+    return unique[old_counts != new_counts].view(composition.EVENT_DTYPE)
+
+
+def affected_window(old, new, tail):
+    """(start, end) seconds in which the edit is audible, or None if nothing changed."""
+    changed = changed_events(old, new)
+    if not len(changed):
+        return None
+    return float(changed['onset'].min()), composition.end_time(changed) + tail
+
+
+def render_window(synth, events, start, end, tail=1.0):
+    """
+    Raw (un-normalized) audio of samples [start, end) of a full render of
+    `events`. Every note audible in the window is synthesized from its own
+    onset, so notes still ringing at `start` come in with the right envelope;
+    event times land on the same samples as in a render from the beginning.
+    """
+    fs = synth.sample_rate
+    ends = events['onset'] + events['duration'] + tail
+    audible = events[(events['onset'] < end / fs) & (ends > start / fs)]
+    if not len(audible):
+        return np.zeros(end - start)
+    offset = min(start, int(fs * audible['onset'].min()))
+    segment = synth.render_events(audible, tail=tail, normalize=False, offset=offset)
+    if len(segment) < end - offset:
+        segment = np.pad(segment, (0, end - offset - len(segment)))
+    return segment[start - offset:end - offset]
+
+
+def rerender(synth, old_audio, old_peak, old_events, new_events, tail=1.0):
+    """
+    Render `new_events` by patching `old_audio` (the normalized render of
+    `old_events`, whose raw peak was `old_peak`) on a borrowed synth.
+    Returns (audio, peak, window) with audio normalized like a full render
+    and window the (start, end) samples that were re-synthesized, or None
+    as the window when nothing changed.
+    """
+    fs = synth.sample_rate
+    total = int(np.ceil(fs * (composition.end_time(new_events) + tail)))
+    raw = np.zeros(total)
+    keep = min(total, len(old_audio))
+    raw[:keep] = old_audio[:keep] * old_peak
+
+    changed = changed_events(old_events, new_events)
+    if not len(changed):
+        peak = normalize_peak(raw)
+        return raw, peak, None
+
+    fade = int(fs * CROSSFADE_SECONDS)
+    start = max(0, int(fs * changed['onset'].min()) - fade)
+    end = min(total, int(np.ceil(fs * (composition.end_time(changed) + tail))) + fade)
+
+    patch = render_window(synth, new_events, start, end, tail)
+
+    # Crossfade in the padding, where both versions hold the same notes
+    ramp = np.linspace(0.0, 1.0, fade, endpoint=False) if fade else np.zeros(0)
+    head = min(fade, len(patch)) if start > 0 else 0
+    tail_len = min(fade, len(patch) - head) if end < total else 0
+    if head:
+        patch[:head] = raw[start:start + head] * (1 - ramp[:head]) + patch[:head] * ramp[:head]
+    if tail_len:
+        fall = ramp[::-1][-tail_len:]
+        patch[-tail_len:] = raw[end - tail_len:end] * (1 - fall) + patch[-tail_len:] * fall
+    raw[start:end] = patch
+
+    peak = normalize_peak(raw)
+    logger.info(f"Incremental render re-synthesized {(end - start) / fs:.2f}s "
+                f"of {total / fs:.2f}s ({len(changed)} changed notes)")
+    return raw, peak, (start, end)
@@ -0,0 +1,116 @@
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from multiprocessing import get_context
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from player import rate_limit
+
+
+CLIENTS = 1000  # distinct keys the requests are spread over, as from that many clients
+UNLIMITED = 10 ** 9
+
+
+def _view(request):
+    return HttpResponse(request.POST.get('username', ''))  # reads the form, as the login view does
+
+
+def _keyed(rules, i):
+    return [(f'{name}:{i % CLIENTS}', rule) for name, rule in rules]
+
+
+def _hammer(rules, requests, start_at, worker):
+    """Run `requests` checks from a worker process; returns (allowed, seconds)."""
+    while time.time() < start_at:
+        time.sleep(0.001)
+    allowed = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        try:
+            rate_limit.check(_keyed(rules, worker * requests + i))
+            allowed += 1
+        except rate_limit.RateLimited:
+            pass
+    return allowed, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = ("Measure the rate limiter's overhead per request: one check per algorithm, a decorated view "
+            "against a bare one, and throughput with several processes sharing the state file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per measurement')
+        parser.add_argument('--processes', type=int, action='append',
+                            help='Concurrent processes for the shared-file run (default: 1, 4)')
+
+    def handle(self, *args, **options):
+        requests = options['requests']
+        state_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(RATE_LIMIT_DB=os.path.join(state_dir, 'rate_limit.sqlite3'), RATE_LIMITS={
+                'bench': [{'key': 'ip', 'algorithm': 'window', 'limit': UNLIMITED, 'period': 60},
+                          {'key': 'account', 'algorithm': 'bucket', 'limit': UNLIMITED, 'period': 60,
+                           'field': 'username'}],
+            }):
+                self._per_check(requests)
+                self._per_request(requests)
+                self._shared(requests, options['processes'] or [1, 4])
+        finally:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+    def _per_check(self, requests):
+        self.stdout.write(f"{'check':<28} {'median us':>10} {'p99 us':>10}")
+        window = rate_limit.Rule('ip', 'window', limit=UNLIMITED, period=60)
+        bucket = rate_limit.Rule('ip', 'bucket', limit=UNLIMITED, period=60)
+        lockout = rate_limit.Rule('ip', 'window', limit=UNLIMITED, period=60, lockout=True)
+        for label, rules in (('window', [('w', window)]), ('bucket', [('b', bucket)]),
+                             ('window + lockout', [('l', lockout)]),
+                             ('window + bucket', [('w2', window), ('b2', bucket)])):
+            samples = self._time(lambda i: rate_limit.check(_keyed(rules, i)), requests)
+            self.stdout.write(f"{label:<28} {statistics.median(samples):>10.1f} "
+                              f"{statistics.quantiles(samples, n=100)[98]:>10.1f}")
+
+    def _per_request(self, requests):
+        factory = RequestFactory()
+        limited = rate_limit.limit('bench')(_view)
+
+        def call(view, i):
+            request = factory.post('/login/', {'username': f'bench{i % CLIENTS}'},
+                                   REMOTE_ADDR=f'10.0.{i % CLIENTS // 256}.{i % 256}')
+            request.user = AnonymousUser()
+            view(request)
+
+        bare = statistics.median(self._time(lambda i: call(_view, i), requests))
+        decorated = statistics.median(self._time(lambda i: call(limited, i), requests))
+        self.stdout.write(f"\n{'view':<28} {'median us':>10}")
+        self.stdout.write(f"{'bare':<28} {bare:>10.1f}")
+        self.stdout.write(f"{'@rate_limit.limit (2 rules)':<28} {decorated:>10.1f}")
+        self.stdout.write(self.style.SUCCESS(f"Overhead per request: {decorated - bare:.1f} us"))
+
+    def _shared(self, requests, process_counts):
+        rules = [('shared-ip', rate_limit.Rule('ip', 'window', limit=UNLIMITED, period=60)),
+                 ('shared-account', rate_limit.Rule('account', 'bucket', limit=UNLIMITED, period=60))]
+        self.stdout.write(f"\n{'processes':<10} {'checks/s':>10} {'us/check':>10}")
+        context = get_context('fork')
+        for processes in process_counts:
+            with context.Pool(processes) as pool:
+                start_at = time.time() + 0.5
+                results = pool.starmap(_hammer, [(rules, requests, start_at, n) for n in range(processes)])
+            wall = max(seconds for _, seconds in results)
+            total = sum(allowed for allowed, _ in results)
+            self.stdout.write(f"{processes:<10} {total / wall:>10.0f} {wall / requests * 1e6:>10.1f}")
+
+    @staticmethod
+    def _time(fn, runs):
+        samples = []
+        for i in range(runs):
+            start = time.perf_counter()
+            fn(i)
+            samples.append((time.perf_counter() - start) * 1e6)
+        return samples
@@ -0,0 +1,98 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from player import benchmarks, encoders, quality
+from player.audio_utils import SOUNDFONT_FILES
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+def _str_list(value):
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+class Command(BaseCommand):
+    help = ("Benchmark every render engine across soundfonts, note counts and sample rates, "
+            "print the results as JSON and compare them with a saved baseline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guitar-types', type=_str_list, default=sorted(SOUNDFONT_FILES),
+                            help='Comma-separated guitar types (default: all four)')
+        parser.add_argument('--engines', type=_str_list, default=list(benchmarks.ENGINES),
+                            help='Comma-separated render engines: synth, segmented, bank')
+        parser.add_argument('--sizes', type=_int_list, default=list(benchmarks.DEFAULT_SIZES),
+                            help='Comma-separated note counts')
+        parser.add_argument('--sample-rates', type=_int_list, default=list(benchmarks.DEFAULT_SAMPLE_RATES),
+                            help='Comma-separated sample rates in Hz')
+        parser.add_argument('--note-seconds', type=float, default=benchmarks.DEFAULT_NOTE_SECONDS)
+        parser.add_argument('--format', default='wav', help='Output format to encode')
+        parser.add_argument('--quality', choices=sorted(quality.TIERS), default=quality.FINAL,
+                            help='Render quality tier')
+        parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+        parser.add_argument('--baseline', default=None,
+                            help='Baseline report to compare against (default: RENDER_BENCH_BASELINE)')
+        parser.add_argument('--save-baseline', action='store_true', help='Store this run as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=benchmarks.DEFAULT_TOLERANCE,
+                            help='Allowed slowdown / memory growth before a case counts as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error if any case regressed against the baseline')
+        parser.add_argument('--no-isolate', action='store_true',
+                            help='Render in this process (faster, but peak RSS accumulates across cases)')
+
+    def handle(self, *args, **options):
+        unknown = set(options['guitar_types']) - set(SOUNDFONT_FILES)
+        if unknown:
+            raise CommandError(f"Unknown guitar types: {', '.join(sorted(unknown))}")
+        unknown = set(options['engines']) - set(benchmarks.ENGINES)
+        if unknown:
+            raise CommandError(f"Unknown engines: {', '.join(sorted(unknown))}")
+        try:
+            encoders.get_encoder(options['format'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def progress(case):
+            if case.get('skipped'):
+                status = f"skipped ({case['skipped']})"
+            elif case.get('error'):
+                status = case['error']
+            else:
+                status = (f"{case['wall_seconds']:.3f}s  {case['realtime_factor']}x realtime  "
+                          f"{case['peak_rss_mb'] if case['peak_rss_mb'] is not None else '-'} MB  "
+                          f"{case['output_bytes']} bytes")
+            self.stderr.write(f"{benchmarks.case_key(case):<40} {status}")
+
+        report = benchmarks.run_suite(
+            guitar_types=options['guitar_types'], engines=options['engines'], sizes=options['sizes'],
+            sample_rates=options['sample_rates'], note_seconds=options['note_seconds'], fmt=options['format'],
+            quality=options['quality'], isolate=not options['no_isolate'], progress=progress)
+
+        baseline_path = options['baseline'] or benchmarks.default_baseline_path()
+        if os.path.exists(baseline_path):
+            try:
+                report['comparison'] = benchmarks.compare(report, benchmarks.load_report(baseline_path),
+                                                          options['tolerance'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read baseline {baseline_path}: {e}")
+        elif options['baseline']:
+            raise CommandError(f"Baseline {baseline_path} does not exist")
+
+        if options['output']:
+            benchmarks.save_report(report, options['output'])
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+        if options['save_baseline']:
+            benchmarks.save_report({k: v for k, v in report.items() if k != 'comparison'}, baseline_path)
+            self.stderr.write(self.style.SUCCESS(f"Saved baseline to {baseline_path}"))
+
+        regressions = report.get('comparison', {}).get('regressions', [])
+        for entry in regressions:
+            self.stderr.write(self.style.WARNING(
+                f"REGRESSION {entry['case']} {entry['metric']}: {entry['baseline']} -> {entry['current']}"))
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"{len(regressions)} render regressions against {baseline_path}")
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from player import render_cache, sample_bank
+from player.audio_utils import SOUNDFONT_FILES
+from player.synth_pool import SynthPool
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+class Command(BaseCommand):
+    help = "Compare sample-bank overlay-add rendering with full FluidSynth rendering."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guitar-type', choices=sorted(SOUNDFONT_FILES), default='acoustic')
+        parser.add_argument('--sizes', type=_int_list, default=[10, 1000, 50000],
+                            help='Comma-separated note counts')
+        parser.add_argument('--duration', type=float, default=0.125,
+                            help='Seconds per note (must be one of the bank lengths)')
+        parser.add_argument('--skip-synth-above', type=int, default=None,
+                            help='Only time the synth path for compositions up to this many notes')
+
+    def handle(self, *args, **options):
+        guitar_type = options['guitar_type']
+        if sample_bank.get_bank(guitar_type) is None:
+            raise CommandError(f"No sample bank for {guitar_type}; run build_sample_bank first.")
+
+        low, high = sample_bank.PITCH_RANGES[guitar_type]
+        pool = SynthPool(size=1)
+        self.stdout.write(f"{'notes':>8} {'audio s':>9} {'bank s':>9} {'synth s':>9} {'speedup':>8}")
+        try:
+            for size in options['sizes']:
+                notes = [low + (i * 7) % (high - low + 1) for i in range(size)]
+                events = render_cache.normalize_events(notes, options['duration'])
+
+                start = time.perf_counter()
+                audio = sample_bank.render_events(guitar_type, events)
+                bank_s = time.perf_counter() - start
+                if audio is None:
+                    raise CommandError("Composition fell outside the bank; pick a --duration from the bank lengths.")
+
+                synth_s = None
+                skip = options['skip_synth_above']
+                if skip is None or size <= skip:
+                    start = time.perf_counter()
+                    try:
+                        with pool.borrow(guitar_type) as synth:
+                            synth.render_events(events)
+                    except (ImportError, ValueError) as e:
+                        raise CommandError(f"Cannot run the synth path: {e}")
+                    synth_s = time.perf_counter() - start
+
+                self.stdout.write(
+                    f"{size:>8} {len(audio) / 44100:>9.1f} {bank_s:>9.3f} "
+                    + (f"{synth_s:>9.3f} {synth_s / bank_s:>7.1f}x" if synth_s is not None else f"{'-':>9} {'-':>8}"))
+        finally:
+            pool.close()
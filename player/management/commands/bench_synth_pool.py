@@ -0,0 +1,63 @@
+import statistics
+import time
+
+import pretty_midi
+from django.core.management.base import BaseCommand, CommandError
+
+from player.audio_utils import SOUNDFONT_FILES, get_soundfont_path
+from player.synth_pool import SynthPool
+
+
+def _build_midi(notes, duration):
+    midi = pretty_midi.PrettyMIDI()
+    guitar = pretty_midi.Instrument(program=25)
+    for i, pitch in enumerate(notes):
+        guitar.notes.append(pretty_midi.Note(velocity=100, pitch=pitch, start=i * duration, end=(i + 1) * duration))
+    midi.instruments.append(guitar)
+    return midi
+
+
+class Command(BaseCommand):
+    help = "Compare cold renders (new synth + .sf2 load per call) with warm renders from the synth pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guitar-type', choices=sorted(SOUNDFONT_FILES), action='append',
+                            help='Guitar type(s) to benchmark (default: all four)')
+        parser.add_argument('--notes', type=int, default=8, help='Notes per composition')
+        parser.add_argument('--duration', type=float, default=0.5, help='Seconds per note')
+        parser.add_argument('--runs', type=int, default=5, help='Renders per mode')
+
+    def handle(self, *args, **options):
+        guitar_types = options['guitar_type'] or sorted(SOUNDFONT_FILES)
+        notes = [40 + (i * 5) % 24 for i in range(options['notes'])]
+        midi = _build_midi(notes, options['duration'])
+        pool = SynthPool(size=1)
+
+        self.stdout.write(f"{'guitar':<10} {'cold ms':>10} {'warm ms':>10} {'speedup':>8}")
+        try:
+            for guitar_type in guitar_types:
+                sf2_path = get_soundfont_path(guitar_type)
+                try:
+                    cold = self._time(lambda: midi.fluidsynth(sf2_path=sf2_path, fs=44100), options['runs'])
+                    pool.warm([guitar_type])
+
+                    def warm_render():
+                        with pool.borrow(guitar_type) as synth:
+                            synth.render(midi)
+
+                    warm = self._time(warm_render, options['runs'])
+                except (ImportError, ValueError) as e:
+                    raise CommandError(f"Cannot render {guitar_type}: {e}")
+
+                self.stdout.write(f"{guitar_type:<10} {cold:>10.1f} {warm:>10.1f} {cold / warm:>7.1f}x")
+        finally:
+            pool.close()
+
+    @staticmethod
+    def _time(fn, runs):
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from player import sample_bank
+from player.audio_utils import SOUNDFONT_FILES
+from player.synth_pool import SynthPool
+
+
+def _float_list(value):
+    return [float(x) for x in value.split(',') if x.strip()]
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+class Command(BaseCommand):
+    help = "Pre-render every playable pitch per soundfont into the memory-mapped sample bank."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guitar-type', choices=sorted(SOUNDFONT_FILES), action='append',
+                            help='Guitar type(s) to build (default: all four)')
+        parser.add_argument('--lengths', type=_float_list, default=list(sample_bank.DEFAULT_LENGTHS),
+                            help='Comma-separated note lengths in seconds')
+        parser.add_argument('--velocities', type=_int_list, default=list(sample_bank.DEFAULT_VELOCITIES),
+                            help='Comma-separated MIDI velocities')
+        parser.add_argument('--sample-rate', type=int, default=44100)
+
+    def handle(self, *args, **options):
+        pool = SynthPool(size=1)
+        try:
+            for guitar_type in options['guitar_type'] or sorted(SOUNDFONT_FILES):
+                try:
+                    with pool.borrow(guitar_type, options['sample_rate']) as synth:
+                        path, frames = sample_bank.build_bank(
+                            guitar_type, synth, options['lengths'], options['velocities'])
+                except (ImportError, ValueError) as e:
+                    raise CommandError(f"Cannot build {guitar_type} bank: {e}")
+                self.stdout.write(self.style.SUCCESS(
+                    f"{guitar_type}: {frames * 2 / 1e6:.1f} MB → {path}"))
+        finally:
+            pool.close()
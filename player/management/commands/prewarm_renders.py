@@ -0,0 +1,65 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from player import encoders, prewarm
+from player.quality import TIERS
+
+
+class Command(BaseCommand):
+    help = ("Render the catalog of scales, arpeggios, chords and lesson exercises for every guitar type into the "
+            "render cache in parallel, resuming an interrupted run; or --report how production used it since.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guitar', action='append', dest='guitar_types',
+                            help='Only this guitar type (repeatable; default: all)')
+        parser.add_argument('--format', action='append', dest='formats',
+                            help='Output format to warm (repeatable; default: RENDER_DEFAULT_FORMAT)')
+        parser.add_argument('--quality', action='append', dest='qualities', choices=sorted(TIERS),
+                            help='Quality tier to warm (repeatable; default: final)')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+        parser.add_argument('--progress', default=None,
+                            help='Progress file (default: RENDER_PREWARM_PROGRESS)')
+        parser.add_argument('--restart', action='store_true', help='Ignore the progress of an earlier run')
+        parser.add_argument('--list', action='store_true', help='Print the catalog, render nothing')
+        parser.add_argument('--report', action='store_true',
+                            help='Report cache use since the last finished run, render nothing')
+
+    def handle(self, *args, **options):
+        progress_path = options['progress'] or settings.RENDER_PREWARM_PROGRESS
+        if options['report']:
+            try:
+                report = prewarm.report(progress_path)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(json.dumps(report, indent=2))
+            if report['hit_rate'] is None:
+                lookups = "render cache counters were reset since, no hit rate"
+            else:
+                lookups = (f"render cache hit rate {report['hit_rate']:.1%} "
+                           f"over {report['hits'] + report['misses']} lookups")
+            self.stderr.write(self.style.SUCCESS(
+                f"{report['warmed_served']}/{report['warmed']} warmed renders served since {report['finished_at']} "
+                f"({report['warmed_evicted']} evicted); {lookups}"))
+            return
+
+        try:
+            items = prewarm.catalog(options['guitar_types'])
+            for fmt in options['formats'] or ():
+                encoders.get_encoder(fmt)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['list']:
+            for item in items:
+                self.stdout.write(item.name)
+            return
+
+        report = prewarm.prewarm(items, options['formats'], options['qualities'], workers=options['workers'],
+                                 progress_path=progress_path, restart=options['restart'])
+        for task_id, error in sorted(report['errors'].items()):
+            self.stderr.write(f"{task_id}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['rendered']} rendered, {report['skipped']} already done, {report['failed']} failed "
+            f"of {report['total']} in {report['wall_seconds']}s on {report['workers']} workers "
+            f"— {report['renders_per_second']} renders/s"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from player import sessions
+
+
+class Command(BaseCommand):
+    help = ("Delete expired sessions in bounded batches, so pruning never holds a long lock on the "
+            "session table. Safe to run from cron while the site is up.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=sessions.BATCH_SIZE,
+                            help='Sessions deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        deleted = sessions.prune(options['batch_size'], pause=options['pause'])
+        self.stdout.write(self.style.SUCCESS(f"{deleted} expired sessions deleted"))
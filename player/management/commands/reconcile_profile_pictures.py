@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from player import profile_pictures
+
+
+class Command(BaseCommand):
+    help = ("Clear the profile picture of every profile whose file is missing from storage, in batches. "
+            "Page views never check storage themselves.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=profile_pictures.BATCH_SIZE,
+                            help='Profiles checked per query')
+        parser.add_argument('--dry-run', action='store_true', help='Report missing files, change nothing')
+
+    def handle(self, *args, **options):
+        checked, cleared = profile_pictures.reconcile(options['batch_size'], dry_run=options['dry_run'])
+        verb = 'would be cleared' if options['dry_run'] else 'cleared'
+        self.stdout.write(self.style.SUCCESS(f"{checked} profile pictures checked, {cleared} missing {verb}"))
@@ -0,0 +1,37 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from player.batch import render_batch
+
+
+class Command(BaseCommand):
+    help = "Render a JSON list of {guitar_type, notes, duration} specs in parallel across all CPU cores."
+
+    def add_arguments(self, parser):
+        parser.add_argument('specs', help='JSON file with a list of render specs')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+        parser.add_argument('--output', help='Write the full per-item report to this JSON file')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['specs']) as f:
+                specs = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read specs: {e}")
+        if not isinstance(specs, list):
+            raise CommandError("Specs file must contain a JSON list")
+
+        report = render_batch(specs, workers=options['workers'])
+
+        for item in report['results']:
+            if item['error']:
+                self.stderr.write(f"#{item['index']}: {item['error']}")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['succeeded']}/{report['renders']} rendered in {report['wall_seconds']}s "
+            f"on {report['workers']} workers — {report['renders_per_second']} renders/s, "
+            f"{report['realtime_factor']}x realtime"))
@@ -0,0 +1,32 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from player import generated_files
+
+
+class Command(BaseCommand):
+    help = ("Delete generated audio over the per-user quotas and the global budget, least recently used "
+            "first, working from the generated files index.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, default=None,
+                            help='Global budget for media/generated/ (default: RENDER_CACHE_MAX_BYTES)')
+        parser.add_argument('--user-quota', type=int, default=None,
+                            help='Bytes each user may own (default: GENERATED_USER_QUOTA_BYTES)')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted, delete nothing')
+        parser.add_argument('--reindex', action='store_true',
+                            help='First reconcile the index with the files on disk (lists the directory once)')
+
+    def handle(self, *args, **options):
+        if options['reindex']:
+            added, removed = generated_files.rebuild_index()
+            self.stderr.write(f"Index: {added} files added, {removed} missing files dropped")
+
+        report = generated_files.sweep(options['max_bytes'], options['user_quota'], dry_run=options['dry_run'])
+        self.stdout.write(json.dumps(report, indent=2))
+        verb = 'Would free' if options['dry_run'] else 'Freed'
+        self.stderr.write(self.style.SUCCESS(
+            f"{verb} {report['quota_bytes'] + report['budget_bytes']} bytes "
+            f"({report['quota_files']} files over quota for {report['users_over_quota']} users, "
+            f"{report['budget_files']} over budget); {report['bytes']} bytes in {report['files']} files left"))
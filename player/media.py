@@ -0,0 +1,140 @@
+"""
+Serving generated audio from MEDIA_ROOT/generated/.
+
+serve_file() answers the requests a media element actually makes:
+
+    Range: bytes=...    206 with just those bytes, so seeking doesn't refetch
+                        the file (one range per request; 416 if out of bounds)
+    If-None-Match       304 while the file hasn't changed
+    If-Range            the range only if the validator still matches
+
+Render cache files are named after a hash of everything that determines
+their bytes, so that hash is their (strong) ETag and they can be cached
+forever. Other files (custom file names) get a weak ETag from their size and
+mtime and must be revalidated.
+
+Full responses go out as FileResponse, which the WSGI server can send with
+sendfile(). With MEDIA_ACCEL_REDIRECT set (e.g. '/protected-media/'), the body
+is left to a front proxy instead: the response only carries the headers and
+an X-Accel-Redirect to MEDIA_ACCEL_REDIRECT + 'generated/<name>', and nginx
+serves the bytes, ranges included.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+
+from . import encoders, render_cache
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class _FileRange:
+    """File-like view of `length` bytes of an open file from `start` on."""
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive byte positions for a single-range Range header,
+    None to ignore the header (missing, malformed, or several ranges), or
+    False when the range can't be satisfied.
+    """
+    match = _RANGE.match((header or '').replace(' ', ''))
+    if not match or not (match[1] or match[2]):
+        return None
+    if not match[1]:  # bytes=-N: the last N bytes
+        suffix = int(match[2])
+        return (max(0, size - suffix), size - 1) if suffix and size else False
+    start = int(match[1])
+    end = min(int(match[2]), size - 1) if match[2] else size - 1
+    if match[2] and int(match[2]) < start:
+        return None
+    return (start, end) if start < size else False
+
+
+def validators(name, st):
+    """(etag, cache_control) for a generated file."""
+    parsed = render_cache.key_from_url(name)
+    if parsed is not None:
+        return f'"{parsed[0]}"', IMMUTABLE
+    return f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"', REVALIDATE
+
+
+def content_type_for(name):
+    ext = os.path.splitext(name)[1].lstrip('.').lower()
+    if ext in encoders.ENCODERS:
+        return encoders.ENCODERS[ext].content_type
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def serve_file(request, path, name):
+    """Response for GET/HEAD of the file at `path`, published as `name`. Raises FileNotFoundError."""
+    file = open(path, 'rb')
+    try:
+        st = os.fstat(file.fileno())
+        etag, cache_control = validators(name, st)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(st.st_mtime),
+            'Cache-Control': cache_control,
+            'Accept-Ranges': 'bytes',
+        }
+        response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+        if response is not None:  # 304 Not Modified / 412 Precondition Failed
+            file.close()
+            return _with_headers(response, headers)
+
+        byte_range = parse_range(request.headers.get('Range'), st.st_size)
+        if_range = request.headers.get('If-Range')
+        if byte_range is not None and if_range and (etag.startswith('W/') or etag not in parse_etags(if_range)):
+            byte_range = None  # the client's copy is stale: send the whole file
+        if byte_range is False:
+            file.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{st.st_size}'
+            return response
+
+        accel = getattr(settings, 'MEDIA_ACCEL_REDIRECT', '')
+        if accel:
+            file.close()
+            response = HttpResponse(content_type=content_type_for(name))
+            response['X-Accel-Redirect'] = f"{accel.rstrip('/')}/{render_cache.CACHE_DIR}/{name}"
+        elif byte_range is None:
+            response = FileResponse(file, content_type=content_type_for(name))
+        else:
+            start, end = byte_range
+            response = FileResponse(_FileRange(file, start, end - start + 1), status=206,
+                                    content_type=content_type_for(name))
+            response['Content-Length'] = str(end - start + 1)
+            response['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+    except BaseException:
+        file.close()
+        raise
+    return _with_headers(response, headers)
+
+
+def _with_headers(response, headers):
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,132 @@
+"""
+Render pipeline metrics.
+
+Renders are split into timed stages, all labeled by guitar type:
+
+    prepare    validating the request and building the composition + cache key
+    soundfont  getting a synth with the SoundFont loaded (near zero when warm)
+    synthesis  turning the events into PCM (synth, sample bank or splice)
+    encode     encoding and writing the file, with its waveform peaks
+
+Every stage goes into a histogram, and renders, cache hits, failures and
+coalesced renders are counted. The numbers are kept in counters.py's SQLite
+file, like the render cache stats, so every worker process on the host adds
+to the same series and a scrape sees all of them. A render's counts are
+written together when it finishes (counters.batch()), not one by one.
+export() renders them in the Prometheus text format for the /metrics view.
+
+Stages timed while a request is being handled are also reported to the
+browser: ServerTimingMiddleware sends them as a Server-Timing header.
+"""
+import bisect
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from . import counters
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('prepare', 'soundfont', 'synthesis', 'encode')
+COUNTERS = {
+    'renders': 'Renders that produced a new file.',
+    'cache_hits': 'Renders answered from the render cache.',
+    'failures': 'Renders that raised an error.',
+    'coalesced': 'Renders answered by waiting for an identical render already in flight.',
+}
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'musicflow'
+
+_trace = contextvars.ContextVar('render_trace', default=None)
+
+
+def _key(*parts):
+    return 'metrics:' + ':'.join(str(p) for p in parts)
+
+
+def count(name, guitar_type, amount=1):
+    """Add to one of the COUNTERS."""
+    counters.add({_key(name, guitar_type): amount})
+
+
+def observe(stage_name, guitar_type, seconds):
+    """Record one stage duration in its histogram (and the current request's trace)."""
+    bucket = bisect.bisect_left(BUCKETS, seconds)
+    counters.add({_key('stage', guitar_type, stage_name, bucket): 1,
+                  _key('stage', guitar_type, stage_name, 'sum_us'): int(seconds * 1e6)})
+    trace = _trace.get()
+    if trace is not None:
+        trace[stage_name] = trace.get(stage_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(stage_name, guitar_type):
+    """
+    with metrics.stage('synthesis', guitar_type):
+        audio = synth.render_events(events)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage_name, guitar_type, time.perf_counter() - start)
+
+
+def export(guitar_types=None):
+    """Every series in the Prometheus text exposition format."""
+    if guitar_types is None:
+        from .audio_utils import SOUNDFONT_FILES
+        guitar_types = sorted(SOUNDFONT_FILES)
+
+    keys = [_key(name, g) for name in COUNTERS for g in guitar_types]
+    for g in guitar_types:
+        for s in STAGES:
+            keys += [_key('stage', g, s, i) for i in range(len(BUCKETS) + 1)] + [_key('stage', g, s, 'sum_us')]
+    values = counters.get_many(keys)
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        metric = f"{PREFIX}_{name}_total"
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        lines += [f'{metric}{{guitar_type="{g}"}} {values.get(_key(name, g), 0)}' for g in guitar_types]
+
+    metric = f"{PREFIX}_render_stage_seconds"
+    lines += [f"# HELP {metric} Time spent in each render stage.", f"# TYPE {metric} histogram"]
+    for g in guitar_types:
+        for s in STAGES:
+            labels = f'guitar_type="{g}",stage="{s}"'
+            cumulative = 0
+            for i, bound in enumerate(BUCKETS + (float('inf'),)):
+                cumulative += values.get(_key('stage', g, s, i), 0)
+                le = '+Inf' if i == len(BUCKETS) else repr(bound)
+                lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{labels}}} {values.get(_key("stage", g, s, "sum_us"), 0) / 1e6}')
+            lines.append(f'{metric}_count{{{labels}}} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(timings):
+    """Server-Timing header value for {stage: seconds}, in pipeline order."""
+    order = {name: i for i, name in enumerate(STAGES)}
+    return ', '.join(f"{name};dur={seconds * 1000:.1f}"
+                     for name, seconds in sorted(timings.items(), key=lambda item: order.get(item[0], len(order))))
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header for the render stages a request ran."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _trace.set({})
+        try:
+            response = self.get_response(request)
+            timings = _trace.get()
+        finally:
+            _trace.reset(token)
+        if timings:
+            response['Server-Timing'] = server_timing(timings)
+        return response
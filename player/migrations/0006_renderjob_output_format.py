@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player', '0005_renderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='bitrate',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='renderjob',
+            name='output_format',
+            field=models.CharField(default='wav', max_length=10),
+        ),
+    ]
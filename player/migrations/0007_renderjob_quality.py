@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player', '0006_renderjob_output_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='quality',
+            field=models.CharField(default='final', max_length=10),
+        ),
+    ]
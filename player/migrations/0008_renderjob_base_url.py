@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player', '0007_renderjob_quality'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='base_url',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
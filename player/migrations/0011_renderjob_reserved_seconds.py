@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 03:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player', '0010_renderquota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='reserved_seconds',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
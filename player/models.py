@@ -1,6 +1,8 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 
 class Profile(models.Model):
@@ -34,6 +36,81 @@ class Dashboard(models.Model):
     def __str__(self):
         return f"{self.user.username} Dashboard"
 
+class RenderJob(models.Model):
+    """
+    One asynchronous render. Kept in the database (not in worker memory) so any
+    web worker can answer status and cancel requests for it.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='render_jobs')
+    guitar_type = models.CharField(max_length=20)
+    notes = models.JSONField(default=list)       # MIDI numbers, or columns for composition.from_client
+    duration = models.JSONField()                # seconds per note, or one length per note
+    output_format = models.CharField(max_length=10, default='wav')
+    bitrate = models.PositiveIntegerField(null=True, blank=True)  # kbps, lossy formats only
+    quality = models.CharField(max_length=10, default='final')   # tier name, see quality.py
+    base_url = models.CharField(max_length=255, blank=True)       # earlier render this one edits
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    result_url = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    reserved_seconds = models.FloatField(default=0.0)  # quota CPU-seconds held while queued or running
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.guitar_type} render {self.id} ({self.status})"
+
+
+class GeneratedFile(models.Model):
+    """
+    Index of media/generated/ (see generated_files.py), so eviction and quota
+    sweeps query this table instead of stat-ing every file on disk.
+    """
+    name = models.CharField(max_length=255, unique=True)  # file name inside media/generated/
+    key = models.CharField(max_length=64, blank=True)      # render cache key, blank for custom names
+    owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                              related_name='generated_files')  # whoever first rendered it
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_access = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.size} bytes)"
+
+
+class RenderQuota(models.Model):
+    """
+    A user's render token bucket (see render_quota.py), in synthesis
+    CPU-seconds. `tokens` is the balance at `updated_at`; refill since then is
+    worked out when it is read.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='render_quota')
+    tokens = models.FloatField()  # may go negative: a render is charged what it actually cost
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user.username} render quota ({self.tokens:.1f}s)"
+
+
 @receiver(post_save, sender=User)
 def create_user_dashboard(sender, instance, created, **kwargs):
     if created:
@@ -47,3 +124,35 @@ def create_user_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
 
 
+# Drop the user's cached page context (see user_context.py) whenever one of its rows changes
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_context(sender, instance, **kwargs):
+    from .user_context import invalidate
+    invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+@receiver(post_save, sender=Dashboard)
+@receiver(post_delete, sender=Dashboard)
+@receiver(post_save, sender=RenderQuota)
+@receiver(post_delete, sender=RenderQuota)
+def invalidate_owner_context(sender, instance, **kwargs):
+    from .user_context import invalidate
+    invalidate(instance.user_id)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_member_context(sender, instance, action, reverse, pk_set, **kwargs):
+    # Groups pick the render quota tier. Changed from the group's side, a clear
+    # has to find its members before they are gone.
+    from .user_context import invalidate
+    if not reverse:
+        user_ids = [instance.pk] if action in ('post_add', 'post_remove', 'post_clear') else []
+    elif action == 'pre_clear':
+        user_ids = list(instance.user_set.values_list('pk', flat=True))
+    else:
+        user_ids = (pk_set or []) if action in ('post_add', 'post_remove') else []
+    for user_id in user_ids:
+        invalidate(user_id)
@@ -0,0 +1,112 @@
+"""
+Waveform peaks for generated audio.
+
+Every cached render gets a companion .peaks file, so the player can draw a
+waveform without downloading and decoding the audio. For each zoom level in
+PIXELS_PER_SECOND it holds one (min, max) int8 pair per pixel column.
+PeakBuilder is fed the PCM blocks on their way into the encoder, so the peaks
+cost a min/max reduction per block and no second pass over the audio.
+
+File format, little-endian:
+
+    header  b'MFPK', version u8, level count u8, sample rate u32
+    levels  per level: pixels per second u16, samples per pixel u32, pixel count u32
+    data    per level, in header order: pixel count (min, max) int8 pairs
+"""
+import struct
+
+import numpy as np
+from django.urls import reverse
+
+from . import render_cache
+
+MAGIC = b'MFPK'
+VERSION = 1
+PIXELS_PER_SECOND = (10, 50, 150)  # 150 divides 22.05, 44.1 and 48 kHz evenly
+CONTENT_TYPE = 'application/octet-stream'
+_HEADER = struct.Struct('<4sBBI')
+_LEVEL = struct.Struct('<HII')
+
+
+class PeakBuilder:
+    """
+    Accumulates (min, max) per pixel for every level from a stream of mono
+    PCM blocks (float in -1..1 or int16), in any block size.
+    """
+
+    def __init__(self, sample_rate, levels=PIXELS_PER_SECOND):
+        self.sample_rate = sample_rate
+        self.levels = [(pps, max(1, round(sample_rate / pps))) for pps in levels]
+        self._pending = [None] * len(self.levels)  # samples short of a whole pixel, per level
+        self._mins = [[] for _ in self.levels]
+        self._maxs = [[] for _ in self.levels]
+        self._scale = None
+
+    def feed(self, block):
+        block = np.asarray(block)
+        if not len(block):
+            return
+        if self._scale is None:
+            self._scale = 127 / 32767 if block.dtype.kind == 'i' else 127.0
+        for i, (_, spp) in enumerate(self.levels):
+            pending = self._pending[i]
+            samples = block if pending is None else np.concatenate((pending, block))
+            whole = len(samples) // spp * spp
+            if whole:
+                pixels = samples[:whole].reshape(-1, spp)
+                self._mins[i].append(pixels.min(axis=1))
+                self._maxs[i].append(pixels.max(axis=1))
+            self._pending[i] = samples[whole:].copy() if whole < len(samples) else None
+
+    def finish(self):
+        """The peaks file as bytes; a trailing partial pixel counts as a pixel."""
+        header = [_HEADER.pack(MAGIC, VERSION, len(self.levels), self.sample_rate)]
+        data = []
+        for i, (pps, spp) in enumerate(self.levels):
+            mins, maxs = self._mins[i], self._maxs[i]
+            if self._pending[i] is not None:
+                mins = mins + [self._pending[i].min(keepdims=True)]
+                maxs = maxs + [self._pending[i].max(keepdims=True)]
+            pairs = np.empty((sum(len(m) for m in mins), 2), dtype=np.int8)
+            if len(pairs):
+                scaled = np.stack([np.concatenate(mins), np.concatenate(maxs)], axis=1) * self._scale
+                pairs[:] = np.clip(np.round(scaled), -128, 127)
+            header.append(_LEVEL.pack(pps, spp, len(pairs)))
+            data.append(pairs.tobytes())
+        return b''.join(header + data)
+
+
+def tap(blocks, builder):
+    """Pass PCM blocks through unchanged, feeding each one to `builder` on the way."""
+    for block in blocks:
+        builder.feed(block)
+        yield block
+
+
+def parse(data):
+    """
+    Read a peaks file back: (sample_rate, {pixels_per_second: (samples_per_pixel,
+    int8 array of shape (pixels, 2))}). Raises ValueError if it isn't one.
+    """
+    try:
+        magic, version, count, sample_rate = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a peaks file")
+        offset = _HEADER.size + count * _LEVEL.size
+        levels = {}
+        for i in range(count):
+            pps, spp, pixels = _LEVEL.unpack_from(data, _HEADER.size + i * _LEVEL.size)
+            pairs = np.frombuffer(data, dtype=np.int8, count=2 * pixels, offset=offset).reshape(-1, 2)
+            levels[pps] = (spp, pairs)
+            offset += 2 * pixels
+    except struct.error:
+        raise ValueError("Truncated peaks file")
+    return sample_rate, levels
+
+
+def peaks_url(render_url):
+    """Where the peaks of a render cache URL are served, or None for other URLs."""
+    parsed = render_cache.key_from_url(render_url)
+    if parsed is None:
+        return None
+    return reverse('player:render_peaks', args=[render_cache.cache_filename(*parsed)])
@@ -0,0 +1,284 @@
+"""
+Render cache pre-warming.
+
+catalog() lists the content most users play, for every guitar type:
+
+    scales      major, natural minor, both pentatonics and blues, ascending
+                and back down, from each of the 12 roots
+    arpeggios   major, minor and the three common sevenths, from each root
+    chords      strummed open chords and E/A-shape barre chords on six
+                strings; root-fifth and root-fifth-octave shapes on the
+                four-string bass
+    exercises   the lesson warm-ups (chromatic, spider, open strings, string
+                skipping), laid out on each instrument's strings
+
+prewarm() renders it into the render cache in parallel, so none of it costs a
+synthesis after a deploy. Progress goes to a JSON file as items finish: a run
+that is stopped picks up where it left off, and the file keeps what was warmed
+and the shared render cache counters at the end of the run, which report()
+compares with production traffic since. Used by `manage.py prewarm_renders`.
+"""
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import render_cache
+from .models import GeneratedFile
+from .render_jobs import init_worker_process
+
+logger = logging.getLogger(__name__)
+
+Item = namedtuple('Item', 'name guitar_type notes duration')
+
+NOTE_NAMES = ('C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B')
+TUNINGS = {
+    'six-string': (40, 45, 50, 55, 59, 64),  # E2 A2 D3 G3 B3 E4, low to high
+    'four-string': (28, 33, 38, 43),  # E1 A1 D2 G2
+}
+GUITAR_TUNINGS = {'acoustic': 'six-string', 'classical': 'six-string', 'electric': 'six-string',
+                  'bass': 'four-string'}
+SCALES = {
+    'major': (0, 2, 4, 5, 7, 9, 11, 12),
+    'natural-minor': (0, 2, 3, 5, 7, 8, 10, 12),
+    'major-pentatonic': (0, 2, 4, 7, 9, 12),
+    'minor-pentatonic': (0, 3, 5, 7, 10, 12),
+    'blues': (0, 3, 5, 6, 7, 10, 12),
+}
+ARPEGGIOS = {
+    'major': (0, 4, 7, 12),
+    'minor': (0, 3, 7, 12),
+    'dominant-7': (0, 4, 7, 10, 12),
+    'major-7': (0, 4, 7, 11, 12),
+    'minor-7': (0, 3, 7, 10, 12),
+}
+# Frets per string, low to high; None = not played
+OPEN_CHORDS = {
+    'C': (None, 3, 2, 0, 1, 0), 'A': (None, 0, 2, 2, 2, 0), 'G': (3, 2, 0, 0, 0, 3), 'E': (0, 2, 2, 1, 0, 0),
+    'D': (None, None, 0, 2, 3, 2), 'Am': (None, 0, 2, 2, 1, 0), 'Em': (0, 2, 2, 0, 0, 0),
+    'Dm': (None, None, 0, 2, 3, 1), 'A7': (None, 0, 2, 0, 2, 0), 'B7': (None, 2, 1, 2, 0, 2),
+    'C7': (None, 3, 2, 3, 1, 0), 'D7': (None, None, 0, 2, 1, 2), 'E7': (0, 2, 0, 1, 0, 0),
+    'G7': (3, 2, 0, 0, 0, 1),
+}
+# Movable shapes: (chord suffix, string the root is on, frets relative to the barre)
+BARRE_SHAPES = {
+    'six-string': (('', 0, (0, 2, 2, 1, 0, 0)), ('m', 0, (0, 2, 2, 0, 0, 0)),
+                   ('', 1, (None, 0, 2, 2, 2, 0)), ('m', 1, (None, 0, 2, 2, 1, 0))),
+    'four-string': (('5', 0, (0, 2, None, None)), ('8', 0, (0, 2, 2, None)),
+                    ('5', 1, (None, 0, 2, None)), ('8', 1, (None, 0, 2, 2))),
+}
+EXERCISES = {  # frets played on every string in turn, low string first
+    'chromatic': (1, 2, 3, 4),
+    'spider': (1, 3, 2, 4),
+    'open-strings': (0,),
+}
+NOTE_SECONDS = 0.5  # the render views' default note length
+CHORD_SECONDS = 2.0
+STRUM_SECONDS = 0.02  # between strings of a strummed chord
+PROGRESS_EVERY = 20  # completed items between progress file writes
+
+
+def _note_name(pitch):
+    return NOTE_NAMES[pitch % 12]
+
+
+def _chord(tuning, frets, duration=CHORD_SECONDS):
+    """A chord strummed low to high, each note tagged with its string (1 = highest)."""
+    played = [(i, tuning[i] + fret) for i, fret in enumerate(frets) if fret is not None]
+    return {
+        'pitch': [pitch for _, pitch in played],
+        'onset': [round(n * STRUM_SECONDS, 6) for n in range(len(played))],
+        'duration': [round(duration - n * STRUM_SECONDS, 6) for n in range(len(played))],
+        'string': [len(tuning) - i for i, _ in played],
+    }
+
+
+def _exercises(tuning):
+    items = {}
+    for name, frets in EXERCISES.items():
+        items[name] = [base + fret for base in tuning for fret in frets]
+    # Every other string, there and back
+    skips = [tuning[i] for i in range(0, len(tuning), 2)] + [tuning[i] for i in range(1, len(tuning), 2)]
+    items['string-skipping'] = skips + skips[::-1][1:]
+    return items
+
+
+def catalog(guitar_types=None):
+    """Every catalog Item for the given guitar types (default: all of them), in a stable order."""
+    items = []
+    for guitar_type in guitar_types or sorted(GUITAR_TUNINGS):
+        if guitar_type not in GUITAR_TUNINGS:
+            raise ValueError(f"Invalid guitar_type: {guitar_type}")
+        tuning_name = GUITAR_TUNINGS[guitar_type]
+        tuning = TUNINGS[tuning_name]
+        low = tuning[0]
+        for pc in range(12):
+            root = low + (pc - low) % 12  # lowest playable root of this pitch class
+            key = NOTE_NAMES[pc]
+            for name, steps in SCALES.items():
+                notes = [root + s for s in steps]
+                items.append(Item(f"{guitar_type}/scale/{key}-{name}", guitar_type,
+                                  notes + notes[-2::-1], NOTE_SECONDS))
+            for name, steps in ARPEGGIOS.items():
+                items.append(Item(f"{guitar_type}/arpeggio/{key}-{name}", guitar_type,
+                                  [root + s for s in steps], NOTE_SECONDS))
+
+        if tuning_name == 'six-string':
+            for name, frets in OPEN_CHORDS.items():
+                items.append(Item(f"{guitar_type}/chord/{name}-open", guitar_type, _chord(tuning, frets),
+                                  CHORD_SECONDS))
+        for suffix, root_string, shape in BARRE_SHAPES[tuning_name]:
+            # Bass shapes start on the open string; guitar barres start at fret 1 (fret 0 is an open chord)
+            for barre in range(0 if tuning_name == 'four-string' else 1, 12):
+                frets = tuple(None if f is None else f + barre for f in shape)
+                name = f"{_note_name(tuning[root_string] + barre)}{suffix}"
+                items.append(Item(f"{guitar_type}/chord/{name}-{'EADG'[root_string]}{barre}", guitar_type,
+                                  _chord(tuning, frets), CHORD_SECONDS))
+
+        for name, notes in _exercises(tuning).items():
+            items.append(Item(f"{guitar_type}/exercise/{name}", guitar_type, notes, NOTE_SECONDS))
+    return items
+
+
+def _prewarm_one(item, fmt, quality):
+    from .audio_utils import create_guitar_music
+
+    return create_guitar_music(item.guitar_type, item.notes, item.duration, fmt=fmt, quality=quality)
+
+
+def load_progress(path):
+    try:
+        with open(path) as f:
+            progress = json.load(f)
+    except FileNotFoundError:
+        return {'done': {}}
+    except ValueError:
+        logger.warning(f"Ignoring unreadable prewarm progress file {path}")
+        return {'done': {}}
+    progress.setdefault('done', {})
+    return progress
+
+
+def _save_progress(path, progress):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def prewarm(items, formats=None, qualities=None, workers=None, progress_path=None, restart=False):
+    """
+    Render every item in every format and quality tier (defaults:
+    RENDER_DEFAULT_FORMAT, 'final'), skipping those a previous run with the
+    same progress file finished unless restart=True. Returns
+        {'total', 'skipped', 'rendered', 'failed', 'errors', 'workers',
+         'wall_seconds', 'renders_per_second'}
+    workers=1 renders in this process.
+    """
+    formats = formats or [getattr(settings, 'RENDER_DEFAULT_FORMAT', 'wav')]
+    qualities = qualities or ['final']
+    workers = workers or os.cpu_count() or 1
+    progress = {'done': {}} if restart or not progress_path else load_progress(progress_path)
+    done = progress['done']
+
+    tasks = [(f"{item.name}.{fmt}.{quality}", item, fmt, quality)
+             for item in items for fmt in formats for quality in qualities]
+    todo = [task for task in tasks if task[0] not in done]
+    errors = {}
+    unsaved = 0
+    start = time.perf_counter()
+
+    def finished(task_id, url):
+        nonlocal unsaved
+        done[task_id] = os.path.basename(url)
+        unsaved += 1
+        if progress_path and unsaved >= PROGRESS_EVERY:
+            _save_progress(progress_path, progress)
+            unsaved = 0
+
+    if workers == 1 or len(todo) <= 1:
+        for task_id, item, fmt, quality in todo:
+            try:
+                url = _prewarm_one(item, fmt, quality)
+            except Exception as e:
+                errors[task_id] = f"{type(e).__name__}: {e}"
+                continue
+            finished(task_id, url)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)), initializer=init_worker_process) as pool:
+            futures = {pool.submit(_prewarm_one, item, fmt, quality): task_id for task_id, item, fmt, quality in todo}
+            for future in as_completed(futures):
+                try:
+                    url = future.result()
+                except Exception as e:  # the render failed or its worker process died
+                    errors[futures[future]] = f"{type(e).__name__}: {e}"
+                    continue
+                finished(futures[future], url)
+
+    wall = time.perf_counter() - start
+    rendered = len(todo) - len(errors)
+    progress['finished_at'] = timezone.now().isoformat()
+    progress['stats'] = {name: render_cache.stats()[name] for name in ('hits', 'misses')}
+    if progress_path:
+        _save_progress(progress_path, progress)
+    logger.info(f"Prewarmed {rendered}/{len(todo)} renders ({len(tasks) - len(todo)} done before) "
+                f"in {wall:.2f}s on {workers} workers")
+    return {
+        'total': len(tasks),
+        'skipped': len(tasks) - len(todo),
+        'rendered': rendered,
+        'failed': len(errors),
+        'errors': errors,
+        'workers': workers,
+        'wall_seconds': round(wall, 3),
+        'renders_per_second': round(rendered / wall, 3) if wall else 0.0,
+    }
+
+
+def report(progress_path):
+    """
+    How production has used the cache since the last prewarm run with this
+    progress file:
+        warmed / warmed_served   catalog files, and how many were requested
+                                 since (from the generated files index)
+        warmed_evicted           catalog files no longer in the index
+        hits / misses / hit_rate render cache lookups since, by every process
+                                 on the host (from the shared counters); None
+                                 if the counters were reset after the run
+    """
+    progress = load_progress(progress_path)
+    finished_at = parse_datetime(progress.get('finished_at') or '')
+    if finished_at is None:
+        raise ValueError(f"No finished prewarm run recorded in {progress_path}")
+    names = sorted(set(progress['done'].values()))
+    served = indexed = 0
+    try:
+        for start in range(0, len(names), 500):
+            batch = GeneratedFile.objects.filter(name__in=names[start:start + 500])
+            indexed += batch.count()
+            served += batch.filter(last_access__gt=finished_at).count()
+    except DatabaseError as e:
+        logger.warning(f"Could not read the generated files index: {e}")
+
+    stats = render_cache.stats()
+    baseline = progress.get('stats', {})
+    hits = stats['hits'] - baseline.get('hits', 0)
+    misses = stats['misses'] - baseline.get('misses', 0)
+    if hits < 0 or misses < 0:  # the counters file was replaced; the run's baseline means nothing now
+        hits = misses = None
+    return {
+        'finished_at': progress['finished_at'],
+        'warmed': len(names),
+        'warmed_served': served,
+        'warmed_evicted': len(names) - indexed,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': None if hits is None else round(hits / (hits + misses), 4) if hits + misses else 0.0,
+    }
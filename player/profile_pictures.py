@@ -0,0 +1,86 @@
+"""
+Profile picture URL index.
+
+url_for(profile) answers from the Django cache, keyed by profile id and
+last_modified. Profile.last_modified moves on every save, so an upload or a
+removal simply makes the old entry unreachable; nothing has to be
+invalidated. On a miss the URL is built from the field alone. Reading a URL
+never touches storage or writes to the database, which keeps both out of page
+views.
+
+Files that vanish from storage behind the application's back are found by
+reconcile(), run in batches from `manage.py reconcile_profile_pictures`
+rather than inline on GET.
+"""
+import logging
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+INDEX_TIMEOUT = 7 * 24 * 3600  # entries are never stale, only unused
+BATCH_SIZE = 500
+_NONE = ''  # cached for profiles without a picture; None means "not cached"
+
+
+def _key(profile):
+    stamp = profile.last_modified.timestamp() if profile.last_modified else 0
+    return f'profile_picture_url:{profile.pk}:{stamp}'
+
+
+def _build(profile):
+    if not profile.profile_picture:
+        return None
+    # Force URL generation with / separators (Windows fix)
+    return profile.profile_picture.url.replace('\\', '/')
+
+
+def url_for(profile):
+    """The profile's picture URL, or None without one."""
+    url = cache.get(_key(profile))
+    if url is None:
+        url = _build(profile) or _NONE
+        cache.set(_key(profile), url, INDEX_TIMEOUT)
+    return url or None
+
+
+def record(profile):
+    """Index the picture of a profile that was just saved (e.g. after an upload or a removal)."""
+    url = _build(profile)
+    cache.set(_key(profile), url or _NONE, INDEX_TIMEOUT)
+    return url
+
+
+def reconcile(batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Clear the picture of every profile whose file is missing from storage.
+    Returns (profiles checked, pictures cleared, or that would be).
+    """
+    from .user_context import invalidate
+
+    checked = cleared = 0
+    pictures = (Profile.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True)
+                .order_by('pk').values_list('pk', 'user_id', 'profile_picture'))
+    last_pk = 0
+    while True:
+        batch = list(pictures.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        checked += len(batch)
+        missing = [(pk, user_id, name) for pk, user_id, name in batch if not default_storage.exists(name)]
+        cleared += len(missing)
+        if dry_run or not missing:
+            continue
+        for _, _, name in missing:
+            logger.warning(f"Profile picture file missing: {name}")
+        # update() skips auto_now: move last_modified by hand so the index key changes too
+        Profile.objects.filter(pk__in=[pk for pk, _, _ in missing]).update(
+            profile_picture=None, last_modified=timezone.now())
+        for _, user_id, _ in missing:
+            invalidate(user_id)
+    return checked, cleared
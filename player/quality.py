@@ -0,0 +1,28 @@
+"""
+Render quality tiers.
+
+    final    44.1 kHz, full 1 s release tail: exactly what renders have always been
+    preview  22.05 kHz, 0.25 s tail, rendered straight to int16; for auditioning
+             a phrase that is still being edited
+
+Every tier other than 'final' gets its own render-cache namespace (its name
+prefixes the cache key), so a preview can never be served as a final render
+and final renders keep the cache keys they always had.
+"""
+from collections import namedtuple
+
+Tier = namedtuple('Tier', 'name sample_rate channels tail dtype')
+
+FINAL = 'final'
+PREVIEW = 'preview'
+TIERS = {
+    FINAL: Tier(FINAL, 44100, 1, 1.0, 'float64'),
+    PREVIEW: Tier(PREVIEW, 22050, 1, 0.25, 'int16'),
+}
+
+
+def get_tier(name):
+    tier = TIERS.get(name or FINAL)
+    if tier is None:
+        raise ValueError(f"Unknown quality: {name}. Choose: {', '.join(TIERS)}")
+    return tier
@@ -0,0 +1,311 @@
+"""
+Request rate limiting shared by every worker process on the host.
+
+Views opt in declaratively:
+
+    @rate_limit.limit('login', methods=('POST',), on_limited=_login_limited)
+    def login(request): ...
+
+and the rules for each name come from RATE_LIMITS. A rule counts requests
+under one key, always scoped to the route (its URL name):
+
+    key 'ip'        the client address
+    key 'account'   the signed-in user, or else the POST field named by
+                    `field` (e.g. the username being tried), hashed
+    key 'route'     everyone together
+
+with one of two algorithms:
+
+    'window'  sliding window log: at most `limit` requests in any `period`
+              seconds. Exact; keeps one row per request in the window.
+    'bucket'  token bucket: `limit` per `period` on average, bursts of up to
+              `burst`. One row per key.
+
+A rule with `failures` counts only what the view reports through
+record_failure() -- a wrong password, say -- so that getting it right doesn't
+use the allowance up. Its limit is still checked before the view runs.
+
+A rule with `lockout` also locks its key out when it goes over: for
+RATE_LIMIT_LOCKOUT['base'] seconds the first time, `factor` times longer on
+each further strike up to `max`, and the strikes are forgotten after
+`forget` quiet seconds. A locked-out key is refused before anything is
+counted. Keep lockouts to keys the client controls: on an 'account' key
+anyone could lock a stranger out just by naming them.
+
+The 'ip' key is the client address as seen through RATE_LIMIT_TRUSTED_PROXIES:
+when REMOTE_ADDR is one of those addresses (or networks), the client is the
+right-most X-Forwarded-For hop that isn't. Behind a reverse proxy that isn't
+listed, every client shares the proxy's address and one 'ip' allowance.
+
+State lives in a SQLite file (RATE_LIMIT_DB) rather than the cache: every
+check is one IMMEDIATE transaction, so concurrent requests from any worker
+process count exactly, and windows are measured from timestamps instead of
+cache TTLs. Writers queue on an flock() of a companion .lock file, which
+wakes the next one as soon as the lock is free instead of leaving SQLite to
+poll with growing sleeps. A request refused by one rule isn't counted by the
+others. If the file can't be used, requests are let through and a warning
+logged. `manage.py bench_rate_limit` measures the cost per request.
+"""
+import functools
+import hashlib
+import ipaddress
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: SQLite's own busy timeout only
+    fcntl = None
+
+from django.conf import settings
+from django.http import JsonResponse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCKOUT = {'base': 60, 'factor': 2, 'max': 86400, 'forget': 86400}
+BUSY_TIMEOUT = 5.0  # seconds to wait for another process's transaction
+CLEANUP_EVERY = 1000  # checks per process between deletions of expired rows
+
+Rule = namedtuple('Rule', 'key algorithm limit period burst field lockout failures')
+Rule.__new__.__defaults__ = (None, None, None, False, False)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hits (key TEXT NOT NULL, at REAL NOT NULL, expires REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS hits_key_at ON hits (key, at);
+CREATE INDEX IF NOT EXISTS hits_expires ON hits (expires);
+CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL,
+                                    expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS lockouts (key TEXT PRIMARY KEY, strikes INTEGER NOT NULL, until REAL NOT NULL,
+                                     expires REAL NOT NULL);
+"""
+
+_local = threading.local()
+_checks = 0
+
+
+class RateLimited(Exception):
+    """Raised by check() when a request is over one of its rules, or locked out."""
+
+    def __init__(self, retry_after, key, locked=False):
+        super().__init__(f"Rate limit exceeded for {key}; try again in {retry_after}s")
+        self.retry_after = retry_after
+        self.key = key
+        self.locked = locked
+
+
+def _path():
+    return getattr(settings, 'RATE_LIMIT_DB', None) or os.path.join(settings.BASE_DIR, 'rate_limit.sqlite3')
+
+
+def _connection():
+    """This thread's connection to the state file, opened again after a fork or a settings change."""
+    path = _path()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.key != (os.getpid(), path):
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL keeps it consistent; only the last moments can be lost
+        conn.executescript(SCHEMA)
+        _local.lock = open(f'{path}.lock', 'ab') if fcntl is not None else None
+        _local.conn, _local.key = conn, (os.getpid(), path)
+    return conn
+
+
+def rules(name):
+    return [Rule(**rule) for rule in getattr(settings, 'RATE_LIMITS', {}).get(name, ())]
+
+
+def _lockout_settings():
+    return {**DEFAULT_LOCKOUT, **getattr(settings, 'RATE_LIMIT_LOCKOUT', {})}
+
+
+def _hash(value):
+    return hashlib.sha256(value.encode()).hexdigest()[:32]
+
+
+def _trusted(address, proxies):
+    try:
+        address = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def client_ip(request):
+    """REMOTE_ADDR, or the right-most X-Forwarded-For hop not added by a trusted proxy."""
+    address = request.META.get('REMOTE_ADDR') or 'unknown'
+    proxies = getattr(settings, 'RATE_LIMIT_TRUSTED_PROXIES', ())
+    if not proxies or not _trusted(address, proxies):
+        return address
+    for hop in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        if hop.strip() and not _trusted(hop, proxies):
+            return hop.strip()
+    return address
+
+
+def key_for(request, route, rule):
+    """The key `rule` counts `request` under, or None when it has nothing to count by."""
+    if rule.key == 'ip':
+        value = client_ip(request)
+    elif rule.key == 'account':
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            value = f'user:{user.pk}'
+        elif rule.field and request.POST.get(rule.field, '').strip():
+            value = f'{rule.field}:{_hash(request.POST[rule.field].strip().lower())}'
+        else:
+            return None
+    elif rule.key == 'route':
+        value = '*'
+    else:
+        raise ValueError(f"Unknown rate limit key: {rule.key}")
+    return f'{route}:{rule.key}:{value}'
+
+
+def _window(conn, key, rule, now):
+    """(retry_after or None, write to apply if every rule allows the request)."""
+    conn.execute('DELETE FROM hits WHERE key = ? AND at <= ?', (key, now - rule.period))
+    count, oldest = conn.execute('SELECT COUNT(*), MIN(at) FROM hits WHERE key = ?', (key,)).fetchone()
+    if count >= rule.limit:
+        return oldest + rule.period - now, None
+    return None, ('INSERT INTO hits (key, at, expires) VALUES (?, ?, ?)', (key, now, now + rule.period))
+
+
+def _bucket(conn, key, rule, now):
+    capacity = rule.burst or rule.limit
+    rate = rule.limit / rule.period
+    row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+    tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+    if tokens < 1:
+        return (1 - tokens) / rate, None
+    tokens -= 1
+    return None, ('INSERT OR REPLACE INTO buckets (key, tokens, updated, expires) VALUES (?, ?, ?, ?)',
+                  (key, tokens, now, now + (capacity - tokens) / rate))
+
+
+ALGORITHMS = {'window': _window, 'bucket': _bucket}
+
+
+def _strike(conn, key, now):
+    """Lock `key` out for its next, longer, period; returns the seconds it is locked for."""
+    lockout = _lockout_settings()
+    row = conn.execute('SELECT strikes, expires FROM lockouts WHERE key = ?', (key,)).fetchone()
+    strikes = (row[0] if row is not None and row[1] > now else 0) + 1
+    seconds = min(lockout['max'], lockout['base'] * lockout['factor'] ** (strikes - 1))
+    conn.execute('INSERT OR REPLACE INTO lockouts (key, strikes, until, expires) VALUES (?, ?, ?, ?)',
+                 (key, strikes, now + seconds, now + seconds + lockout['forget']))
+    logger.warning(f"Rate limit lockout {strikes} for {key}: {seconds}s")
+    return seconds
+
+
+def _cleanup(conn, now):
+    conn.execute('DELETE FROM hits WHERE expires < ?', (now,))
+    conn.execute('DELETE FROM buckets WHERE expires < ?', (now,))  # full again: same as no row
+    conn.execute('DELETE FROM lockouts WHERE expires < ?', (now,))
+
+
+def check(keyed_rules, now=None, count=True):
+    """
+    Count one request against every (key, Rule) pair, or raise RateLimited
+    (and count it against none) if any of them is over its limit. With
+    count=False it only raises: nothing is counted, though going over a
+    `lockout` rule still strikes.
+    """
+    if not keyed_rules:
+        return
+    now = time.time() if now is None else now
+    conn = _connection()
+    if _local.lock is not None:
+        fcntl.flock(_local.lock, fcntl.LOCK_EX)
+    try:
+        _check(conn, keyed_rules, now, count)
+    finally:
+        if _local.lock is not None:
+            fcntl.flock(_local.lock, fcntl.LOCK_UN)
+
+
+def _check(conn, keyed_rules, now, count=True):
+    global _checks
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        keys = [key for key, rule in keyed_rules if rule.lockout]
+        if keys:
+            until = conn.execute(f"SELECT key, until FROM lockouts WHERE until > ? AND key IN "
+                                 f"({', '.join('?' * len(keys))}) ORDER BY until DESC LIMIT 1",
+                                 (now, *keys)).fetchone()
+            if until is not None:
+                raise RateLimited(_seconds(until[1] - now), until[0], locked=True)
+        writes = []
+        for key, rule in keyed_rules:
+            retry_after, write = ALGORITHMS[rule.algorithm](conn, key, rule, now)
+            if retry_after is not None:
+                if rule.lockout:
+                    retry_after = max(retry_after, _strike(conn, key, now))
+                raise RateLimited(_seconds(retry_after), key, locked=rule.lockout)
+            writes.append(write)
+        for sql, params in writes if count else ():
+            conn.execute(sql, params)
+        _checks += 1
+        if _checks % CLEANUP_EVERY == 0:
+            _cleanup(conn, now)
+    finally:
+        conn.execute('COMMIT')  # a refusal still keeps its strike and the window trimming
+
+
+def _seconds(value):
+    return max(1, int(value + 0.999))
+
+
+def limit(name, methods=None, on_limited=None):
+    """
+    View decorator applying the RATE_LIMITS[name] rules to requests with one
+    of `methods` (default: all). A refused request gets on_limited(request,
+    RateLimited) if given, else a 429 JSON response with Retry-After.
+    `failures` rules are checked here but counted by record_failure().
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                keyed = _keyed(request, name)
+                try:
+                    check([(key, rule) for key, rule in keyed if not rule.failures])
+                    check([(key, rule) for key, rule in keyed if rule.failures], count=False)
+                except RateLimited as e:
+                    logger.info(f"Rate limited {request.method} {request.path}: {e}")
+                    return (on_limited or too_many_requests)(request, e)
+                except sqlite3.Error as e:
+                    logger.warning(f"Rate limiter unavailable, letting the request through: {e}")
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _keyed(request, name):
+    route = request.resolver_match.url_name if request.resolver_match else name
+    keyed = [(key_for(request, route, rule), rule) for rule in rules(name)]
+    return [(key, rule) for key, rule in keyed if key is not None]
+
+
+def record_failure(request, name):
+    """Count a failed attempt (a wrong password, say) against the RATE_LIMITS[name] `failures` rules."""
+    keyed = [(key, rule) for key, rule in _keyed(request, name) if rule.failures]
+    if not keyed:
+        return
+    try:
+        check(keyed)
+    except RateLimited as e:  # a concurrent failure got there first; the next attempt is refused
+        logger.info(f"Rate limit reached for {request.path}: {e}")
+    except sqlite3.Error as e:
+        logger.warning(f"Rate limiter unavailable, not counting the failure: {e}")
+
+
+def too_many_requests(request, e):
+    response = JsonResponse({'success': False, 'error': 'Too many requests. Please try again shortly.',
+                             'retry_after': e.retry_after}, status=429)
+    response['Retry-After'] = str(e.retry_after)
+    return response
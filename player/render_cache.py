@@ -0,0 +1,284 @@
+"""
+Content-addressed render cache for generated audio.
+
+Every render is identified by a hash of everything that affects the output
+(guitar type, the composition's note events, sample rate, format, bitrate)
+and stored as media/generated/<hash>.<ext>. A cache hit returns the existing file
+URL without touching the synthesizer. The directory is kept under
+RENDER_CACHE_MAX_BYTES by evicting the least recently used files; a hit bumps
+the file's last access in the generated files index (see generated_files.py),
+which is what "recently used" means here.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: coalesce within a process only
+    fcntl = None
+
+import numpy as np
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from . import composition, counters
+from .quality import FINAL as FINAL_QUALITY
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = 'generated'
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+STATS_KEYS = ('hits', 'misses', 'stores', 'evictions', 'evicted_bytes')
+CACHE_KEY_VERSION = 2  # bump to invalidate every cached render after a renderer change
+COMPANION_SUFFIXES = ('.npz', '.peaks', '.lock')  # hidden files that live and die with a render
+DEFAULT_COALESCE_TIMEOUT = 120  # seconds to wait for an identical render in flight
+COALESCE_POLL_SECONDS = 0.05
+_CACHE_NAME = re.compile(r'^(?P<key>(?:[a-z]+-)?[0-9a-f]{32})\.(?P<fmt>[a-z0-9]+)$')
+
+_inflight = {}  # (pid, file name) -> [lock, number of requests holding or waiting for it]
+_inflight_lock = threading.Lock()
+
+
+def normalize_events(notes_list, duration=1.0):
+    """
+    Turn create_guitar_music's (notes_list, duration) into the composition
+    that is actually rendered (an EVENT_DTYPE array, see composition.py), in
+    canonical note order with times rounded to the microsecond, so neither
+    float noise nor the order a chord was entered in can split the cache.
+    notes_list is anything composition.from_client accepts; `duration` is the
+    length of notes that don't carry their own.
+    """
+    return composition.sort(composition.from_client(notes_list, duration))
+
+
+def render_key(guitar_type, events, sample_rate=44100, fmt='wav', bitrate=None, engine='synth',
+               quality=FINAL_QUALITY):
+    """
+    Cache key for a render. Tiers other than 'final' get their own namespace:
+    the tier is hashed in and prefixes the key, e.g. 'preview-3f2a...'.
+    """
+    payload = {
+        'v': CACHE_KEY_VERSION,
+        'engine': engine,
+        'guitar_type': guitar_type,
+        'events': composition.digest(events),
+        'sample_rate': int(sample_rate),
+        'format': fmt,
+        'bitrate': bitrate,
+    }
+    if quality != FINAL_QUALITY:
+        payload['quality'] = quality
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    key = digest.hexdigest()[:32]
+    return key if quality == FINAL_QUALITY else f"{quality}-{key}"
+
+
+def _cache_root():
+    return os.path.join(settings.MEDIA_ROOT, CACHE_DIR)
+
+
+def cache_filename(key, fmt='wav'):
+    return f"{key}.{fmt}"
+
+
+def cache_path(key, fmt='wav'):
+    return os.path.join(_cache_root(), cache_filename(key, fmt))
+
+
+def cache_url(key, fmt='wav'):
+    return f"{settings.MEDIA_URL}{CACHE_DIR}/{cache_filename(key, fmt)}"
+
+
+def _incr(name, amount=1):
+    counters.add({f'render_cache_{name}': amount})
+
+
+def lookup(key, fmt='wav', count_miss=True):
+    """
+    Return the URL of a cached render and mark it as recently used, or None.
+    count_miss=False is for a second look by a request that already missed.
+    """
+    from .generated_files import touch
+
+    path = cache_path(key, fmt)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        if count_miss:
+            _incr('misses')
+        return None
+    _incr('hits')
+    touch(cache_filename(key, fmt))
+    return cache_url(key, fmt)
+
+
+def record_miss():
+    """Count the miss of a lookup(count_miss=False) that turned out to be the request's only one."""
+    _incr('misses')
+
+
+@contextmanager
+def render_lock(key, fmt='wav', timeout=None):
+    """
+    Single-flight lock for one render, so identical requests arriving together
+    synthesize once: the first holds the lock while it renders, the others
+    wait for it and then find the file in the cache.
+
+    Threads of one process queue on an in-process lock; processes (other web
+    or job workers on this host) on an flock()ed lock file next to the render.
+    Yields True once held, or False if RENDER_COALESCE_TIMEOUT ran out first,
+    in which case the caller renders anyway.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'RENDER_COALESCE_TIMEOUT', DEFAULT_COALESCE_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    name = (os.getpid(), cache_filename(key, fmt))  # a forked child must not share its parent's locks
+    with _inflight_lock:
+        entry = _inflight.setdefault(name, [threading.Lock(), 0])
+        entry[1] += 1
+
+    held = entry[0].acquire(timeout=timeout)
+    lock_file = _lock_file(key, fmt, deadline) if held else None
+    try:
+        if not held or (fcntl is not None and lock_file is None):
+            logger.warning(f"Gave up waiting for an identical render of {key} after {timeout}s")
+            yield False
+        else:
+            yield True
+    finally:
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        if held:
+            entry[0].release()
+        with _inflight_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _inflight[name]
+
+
+def _lock_file(key, fmt, deadline):
+    """The render's lock file, flock()ed, or None on timeout (or where flock doesn't exist)."""
+    if fcntl is None:
+        return None
+    os.makedirs(_cache_root(), exist_ok=True)
+    lock_file = open(os.path.join(_cache_root(), f".{cache_filename(key, fmt)}.lock"), 'ab')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock_file.close()
+                return None
+            time.sleep(COALESCE_POLL_SECONDS)
+
+
+def key_from_url(url):
+    """(key, fmt) for a render cache URL or file name, or None if it isn't one."""
+    match = _CACHE_NAME.match(os.path.basename(url or ''))
+    return (match['key'], match['fmt']) if match else None
+
+
+def sidecar_path(key, fmt='wav'):
+    """Hidden companion file describing how a render was made (see store())."""
+    return os.path.join(_cache_root(), f".{key}.{fmt}.npz")
+
+
+def peaks_path(key, fmt='wav'):
+    """Hidden companion file with the render's waveform peaks (see peaks.py)."""
+    return os.path.join(_cache_root(), f".{key}.{fmt}.peaks")
+
+
+def load_sidecar(key, fmt='wav'):
+    """The arrays stored alongside a render as a dict, or None."""
+    try:
+        with np.load(sidecar_path(key, fmt)) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return None
+
+
+def temp_path(key, fmt='wav'):
+    """Where a render should be written before store() publishes it."""
+    os.makedirs(_cache_root(), exist_ok=True)
+    return os.path.join(_cache_root(), f".{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _store_companion(tmp_path, path, write, what, key):
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not store {what} for render {key}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store(tmp_path, key, fmt='wav', sidecar=None, peaks=None, owner=None):
+    """
+    Atomically publish a finished render under its content-addressed name,
+    index it (`owner` is the user it counts against), then evict old renders
+    if the cache went over budget. Returns the URL.
+    `sidecar` is an optional dict of arrays saved next to the render (e.g. the
+    events and gain incremental re-rendering needs) and `peaks` the bytes of
+    its waveform peaks file; both are evicted with it.
+    """
+    from . import generated_files
+
+    if sidecar is not None:
+        _store_companion(f"{tmp_path}.npz", sidecar_path(key, fmt), lambda f: np.savez(f, **sidecar),
+                         'events', key)
+    if peaks is not None:
+        _store_companion(f"{tmp_path}.peaks", peaks_path(key, fmt), lambda f: f.write(peaks), 'peaks', key)
+    path = cache_path(key, fmt)
+    os.replace(tmp_path, path)
+    _incr('stores')
+    generated_files.record(cache_filename(key, fmt), os.path.getsize(path), key=key, owner=owner)
+    evict(keep=path)
+    generated_files.start_periodic_sweep()
+    return cache_url(key, fmt)
+
+
+def evict(max_bytes=None, keep=None):
+    """
+    Delete least recently used renders until the cache fits in max_bytes.
+    `keep` protects one path (the render that was just stored). Returns the
+    bytes freed.
+    """
+    from .generated_files import evict as evict_generated
+
+    try:
+        return evict_generated(max_bytes, keep=os.path.basename(keep) if keep else None)[1]
+    except DatabaseError as e:
+        logger.warning(f"Render cache eviction skipped: {e}")
+        return 0
+
+
+def count_eviction(size):
+    _incr('evictions')
+    _incr('evicted_bytes', size)
+
+
+def stats():
+    """Hit/miss counters (across all processes) plus the indexed size of media/generated/, for scraping."""
+    values = counters.get_many(f'render_cache_{name}' for name in STATS_KEYS)
+    data = {name: values[f'render_cache_{name}'] for name in STATS_KEYS}
+    lookups = data['hits'] + data['misses']
+    data['hit_rate'] = round(data['hits'] / lookups, 4) if lookups else 0.0
+
+    from .generated_files import usage
+
+    files, size = usage()
+    data['bytes'] = size
+    data['files'] = files
+    data['max_bytes'] = getattr(settings, 'RENDER_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+    return data
@@ -0,0 +1,257 @@
+"""
+Asynchronous render jobs.
+
+A request creates a RenderJob row and hands its id to a local process pool,
+then returns immediately. The worker process renders with create_guitar_music
+and writes the outcome back to the row, so status and cancel requests can be
+answered by any web worker. No external broker is involved.
+
+RENDER_JOB_BACKEND selects how jobs run:
+    'process'  sandbox.WorkerPool with RENDER_JOB_WORKERS processes (default):
+               memory, CPU and wall-clock limits per render, cheap jobs first
+    'inline'   run in the submitting request; for tests and debugging
+
+Either way a job is priced before it is queued (sandbox.admit): too
+expensive and it is refused, merely expensive and it waits for cheaper ones.
+Admission is insert-then-count: the new row, holding its estimated cost as
+a quota reservation, is written first and withdrawn if the active jobs,
+counted afterwards, are over RENDER_QUEUE_MAX, if its user now has more than
+RENDER_USER_ACTIVE_MAX, or if their other jobs' reservations use up their
+render quota, so concurrent submits can't overshoot any of these. Jobs whose
+worker process went away without recording an outcome (a restart, an OOM
+kill) would otherwise hold their place forever; expire_stale() fails them
+once they are older than any live job can be.
+
+The CPU time a job takes is charged to its user's render quota
+(render_quota.py). A job whose worker was killed past RENDER_TIMEOUT or its
+CPU limit, or died, is charged that limit, or the time it ran if shorter.
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from . import render_cache, render_quota, sandbox
+from .models import RenderJob
+from .peaks import peaks_url
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_MAX = 20
+DEFAULT_USER_ACTIVE_MAX = 3
+DEFAULT_QUEUED_TIMEOUT = 3600
+STALE_GRACE_SECONDS = 60  # past RENDER_TIMEOUT, for the pool to kill the worker and report it
+
+
+class QueueFull(Exception):
+    """Raised by submit() when RENDER_QUEUE_MAX jobs are already queued or running."""
+
+
+class TooManyJobs(QueueFull):
+    """Raised by submit() when the user already has RENDER_USER_ACTIVE_MAX jobs queued or running."""
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_futures = {}  # job id -> Future, for jobs submitted by this process
+
+
+def init_worker_process():
+    # Spawned workers start without Django; forked ones must not reuse the
+    # parent's DB connections
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'RENDER_JOB_WORKERS', DEFAULT_WORKERS)
+            _executor = sandbox.WorkerPool(workers, initializer=init_worker_process)
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = None
+
+
+def submit(user, guitar_type, notes_list, duration, output_format='wav', bitrate=None, quality='final',
+           base_url=''):
+    """
+    Queue a render and return its RenderJob. Raises sandbox.TooExpensive
+    for a render over RENDER_COST_MAX, QueueFull when the shared queue
+    (counted across all workers via the database) is full, TooManyJobs when
+    the user has too many renders in progress, and render_quota.QuotaExceeded
+    when their budget, less what their other jobs have reserved, is used up.
+    base_url names an earlier render this composition is an edit of, so only
+    the changed part is re-synthesized.
+    """
+    cost, priority = sandbox.admit(render_cache.normalize_events(notes_list, duration), quality)
+    queue_max = getattr(settings, 'RENDER_QUEUE_MAX', DEFAULT_QUEUE_MAX)
+    user_max = getattr(settings, 'RENDER_USER_ACTIVE_MAX', DEFAULT_USER_ACTIVE_MAX)
+    expire_stale()
+
+    job = RenderJob.objects.create(user=user, guitar_type=guitar_type, notes=notes_list, duration=duration,
+                                   output_format=output_format, bitrate=bitrate, quality=quality,
+                                   base_url=base_url or '', reserved_seconds=render_quota.reservation(cost))
+    # Counted after the insert: of two racing submits, the later count sees both rows
+    active = RenderJob.objects.filter(status__in=RenderJob.ACTIVE_STATUSES)
+    others = active.filter(user=user).exclude(pk=job.pk).aggregate(jobs=Count('pk'), reserved=Sum('reserved_seconds'))
+    try:
+        if active.count() > queue_max:
+            raise QueueFull(f"Render queue is full ({queue_max} jobs)")
+        if others['jobs'] >= user_max:
+            raise TooManyJobs(f"{user} already has {others['jobs']} renders in progress (max {user_max})")
+        render_quota.check(user, reserved=others['reserved'] or 0.0)
+    except (QueueFull, render_quota.QuotaExceeded):
+        job.delete()
+        raise
+
+    if getattr(settings, 'RENDER_JOB_BACKEND', 'process') == 'inline':
+        run_job(job.pk)
+    else:
+        future = _get_executor().submit(_run_in_worker, job.pk, priority=priority)
+        _futures[job.pk] = future
+        future.add_done_callback(lambda f, pk=job.pk: _job_finished(pk, f))
+
+    job.refresh_from_db()
+    return job
+
+
+def expire_stale(now=None):
+    """
+    Fail active jobs no worker can still be working on: running for longer
+    than RENDER_TIMEOUT allows, or queued for more than RENDER_QUEUED_TIMEOUT.
+    Returns the number failed.
+    """
+    now = now or timezone.now()
+    run_limit = getattr(settings, 'RENDER_TIMEOUT', sandbox.DEFAULT_TIMEOUT) or 0
+    queued_limit = getattr(settings, 'RENDER_QUEUED_TIMEOUT', DEFAULT_QUEUED_TIMEOUT)
+    expired = 0
+    if run_limit:
+        expired += RenderJob.objects.filter(
+            status=RenderJob.RUNNING,
+            started_at__lt=now - timedelta(seconds=run_limit + STALE_GRACE_SECONDS),
+        ).update(status=RenderJob.FAILED, error='The render worker was lost.', finished_at=now)
+    if queued_limit:
+        expired += RenderJob.objects.filter(
+            status=RenderJob.QUEUED, created_at__lt=now - timedelta(seconds=queued_limit),
+        ).update(status=RenderJob.FAILED, error='The render was never started.', finished_at=now)
+    if expired:
+        logger.warning(f"Failed {expired} stale render jobs")
+    return expired
+
+
+def cancel(job):
+    """
+    Cancel a queued or running job. A queued job never starts; a running
+    render is left to finish but its result is discarded. Returns False if the
+    job had already finished.
+    """
+    cancelled = RenderJob.objects.filter(pk=job.pk, status__in=RenderJob.ACTIVE_STATUSES).update(
+        status=RenderJob.CANCELLED, finished_at=timezone.now())
+    future = _futures.get(job.pk)
+    if future is not None:
+        future.cancel()
+    job.refresh_from_db()
+    return bool(cancelled)
+
+
+def _lost_seconds(job, error, now):
+    """
+    CPU-seconds to charge a job whose worker was killed or died: the limit
+    that stopped it (RENDER_TIMEOUT, or RENDER_CPU_LIMIT for a lost worker),
+    or the time it had been running if that is less.
+    """
+    if isinstance(error, sandbox.RenderTimeout):
+        limit = getattr(settings, 'RENDER_TIMEOUT', sandbox.DEFAULT_TIMEOUT)
+    else:
+        limit = getattr(settings, 'RENDER_CPU_LIMIT', sandbox.DEFAULT_CPU_LIMIT)
+    ran = (now - job.started_at).total_seconds()
+    return min(limit, ran) if limit else ran
+
+
+def _job_finished(job_id, future):
+    _futures.pop(job_id, None)
+    if future.cancelled() or future.exception() is None:
+        return
+    # The worker was killed or died before it could record or charge anything itself
+    error = future.exception()
+    logger.error(f"Render job {job_id} failed: {error}")
+    try:
+        now = timezone.now()
+        job = RenderJob.objects.select_related('user').filter(pk=job_id).first()
+        RenderJob.objects.filter(pk=job_id, status__in=RenderJob.ACTIVE_STATUSES).update(
+            status=RenderJob.FAILED, error=str(error), finished_at=now)
+        if isinstance(error, (sandbox.RenderTimeout, sandbox.WorkerLost)) and job is not None and job.started_at:
+            render_quota.charge(job.user, _lost_seconds(job, error, now))
+    finally:
+        close_old_connections()
+
+
+def _run_in_worker(job_id):
+    close_old_connections()
+    try:
+        run_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def run_job(job_id):
+    """Render one job and record the outcome on its row."""
+    from .audio_utils import create_guitar_music
+
+    # Claim the job; if it was cancelled while queued there is nothing to do
+    claimed = RenderJob.objects.filter(pk=job_id, status=RenderJob.QUEUED).update(
+        status=RenderJob.RUNNING, started_at=timezone.now())
+    if not claimed:
+        return
+
+    job = RenderJob.objects.select_related('user').get(pk=job_id)
+    try:
+        with render_quota.meter() as used:
+            url = create_guitar_music(job.guitar_type, job.notes, job.duration,
+                                      fmt=job.output_format, bitrate=job.bitrate, quality=job.quality,
+                                      base=job.base_url or None, owner=job.user_id)
+    except Exception as e:
+        render_quota.charge(job.user, used['seconds'])  # a failed render still used the CPU
+        logger.error(f"Render job {job_id} failed: {e}")
+        RenderJob.objects.filter(pk=job_id, status=RenderJob.RUNNING).update(
+            status=RenderJob.FAILED, error=str(e), finished_at=timezone.now())
+        return
+
+    render_quota.charge(job.user, used['seconds'])
+    # Only record the result if nobody cancelled the job in the meantime
+    RenderJob.objects.filter(pk=job_id, status=RenderJob.RUNNING).update(
+        status=RenderJob.DONE, result_url=url, finished_at=timezone.now())
+
+
+def job_payload(job):
+    """JSON-friendly view of a job for the status endpoint."""
+    return {
+        'id': str(job.id),
+        'status': job.status,
+        'guitar_type': job.guitar_type,
+        'format': job.output_format,
+        'quality': job.quality,
+        'url': job.result_url or None,
+        'peaks_url': peaks_url(job.result_url) if job.result_url else None,
+        'error': job.error or None,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,181 @@
+"""
+Per-user render quotas in synthesis CPU-seconds.
+
+Every user has a token bucket (a RenderQuota row) holding up to `capacity`
+CPU-seconds and refilling at `refill_per_hour`, both set per account tier in
+RENDER_QUOTA_TIERS:
+
+    tier_for(user)   'staff' for staff, else the first of the user's groups
+                     (by name) that names a tier, else 'default'; a tier
+                     set to None is unlimited
+
+A render may start while the balance is positive (check() raises
+QuotaExceeded, with how long until it is, otherwise) and is charged what it
+actually cost afterwards: the CPU time of the thread that rendered it, plus
+whatever segment workers report through add_cpu(). A cache hit costs next to
+nothing, a long render can take the balance below zero, and the user waits
+for the refill to pay the debt back.
+
+Queued jobs haven't been charged yet, so each one holds a reservation: its
+sandbox cost estimate converted by reservation() into CPU-seconds. check()
+counts the reservations of the user's other active jobs against the balance,
+so a burst of submits can't all pass on the same positive balance. A job
+whose worker is killed is charged what its limits let it use (see
+render_jobs).
+"""
+import contextvars
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.db import DatabaseError, transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import RenderQuota
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SECONDS_PER_COST = 0.005  # synthesis CPU-seconds per note-second of sandbox.estimate_cost
+DEFAULT_TIERS = {
+    'default': {'capacity': 60, 'refill_per_hour': 300},
+    'staff': None,
+}
+
+_meter = contextvars.ContextVar('render_quota_meter', default=None)
+
+
+class QuotaExceeded(Exception):
+    """Raised by check() when a user's render budget is used up."""
+
+    def __init__(self, retry_after, budget):
+        super().__init__(f"Render budget used up; try again in {retry_after}s")
+        self.retry_after = retry_after
+        self.budget = budget
+
+
+def tier_group():
+    """Subquery for annotating users with the first of their groups (by name) that names a tier."""
+    tiers = getattr(settings, 'RENDER_QUOTA_TIERS', DEFAULT_TIERS)
+    return Subquery(Group.objects.filter(user=OuterRef('pk'), name__in=list(tiers))
+                    .order_by('name').values('name')[:1])
+
+
+def tier_for(user, groups=None):
+    """
+    (tier name, {'capacity', 'refill_per_hour'} or None for unlimited).
+    `groups` are the user's group names if already known (e.g. from
+    tier_group()); otherwise they are queried.
+    """
+    tiers = getattr(settings, 'RENDER_QUOTA_TIERS', DEFAULT_TIERS)
+    if user.is_staff and 'staff' in tiers:
+        return 'staff', tiers['staff']
+    if groups is None:
+        groups = user.groups.order_by('name').values_list('name', flat=True)
+    for name in groups:
+        if name in tiers:
+            return name, tiers[name]
+    return 'default', tiers.get('default', DEFAULT_TIERS['default'])
+
+
+def _balance(quota, limits, now):
+    """Tokens in `quota` at `now`: the stored balance plus the refill since, up to capacity."""
+    if quota is None:
+        return float(limits['capacity'])
+    refill = (now - quota.updated_at).total_seconds() * limits['refill_per_hour'] / 3600
+    return min(float(limits['capacity']), quota.tokens + max(0.0, refill))
+
+
+def status(user):
+    """
+    The user's budget for display and for 429 responses:
+        {'tier', 'unlimited', 'capacity', 'available', 'used_percent',
+         'refill_per_hour', 'retry_after'}
+    Reads only; nothing is written until a render is charged.
+    """
+    tier, limits = tier_for(user)
+    quota = None if limits is None else RenderQuota.objects.filter(user=user).first()
+    return budget(tier, limits, quota)
+
+
+def budget(tier, limits, quota, now=None):
+    """status() worked out from what it reads: tier_for()'s (tier, limits) and the RenderQuota row or None."""
+    if limits is None:
+        return {'tier': tier, 'unlimited': True, 'capacity': None, 'available': None, 'used_percent': 0,
+                'refill_per_hour': None, 'retry_after': 0}
+    available = _balance(quota, limits, now or timezone.now())
+    capacity = limits['capacity']
+    rate = limits['refill_per_hour'] / 3600
+    retry_after = 0
+    if available <= 0:
+        retry_after = math.floor(-available / rate) + 1 if rate else None
+    return {
+        'tier': tier,
+        'unlimited': False,
+        'capacity': capacity,
+        'available': round(available, 2),
+        'used_percent': min(100, max(0, round(100 * (capacity - available) / capacity))) if capacity else 100,
+        'refill_per_hour': limits['refill_per_hour'],
+        'retry_after': retry_after,
+    }
+
+
+def reservation(cost):
+    """CPU-seconds to hold for a render that sandbox.estimate_cost() priced at `cost`."""
+    return cost * getattr(settings, 'RENDER_QUOTA_SECONDS_PER_COST', DEFAULT_SECONDS_PER_COST)
+
+
+def check(user, reserved=0.0):
+    """
+    Raise QuotaExceeded unless the user may start a render now, with
+    `reserved` CPU-seconds already held for their jobs still to be charged.
+    """
+    budget = status(user)
+    if budget['unlimited'] or budget['available'] - reserved > 0:
+        return
+    retry_after = budget['retry_after']
+    if reserved and budget['refill_per_hour']:
+        retry_after = math.floor((reserved - budget['available']) * 3600 / budget['refill_per_hour']) + 1
+    raise QuotaExceeded(retry_after or 3600, budget)  # no refill: try again in an hour
+
+
+def charge(user, seconds):
+    """Take `seconds` of synthesis CPU time out of the user's bucket."""
+    tier, limits = tier_for(user)
+    if limits is None or seconds <= 0:
+        return
+    try:
+        with transaction.atomic():
+            quota = RenderQuota.objects.select_for_update().filter(user=user).first()
+            now = timezone.now()
+            tokens = _balance(quota, limits, now) - seconds
+            RenderQuota.objects.update_or_create(user=user, defaults={'tokens': tokens, 'updated_at': now})
+    except DatabaseError as e:
+        logger.warning(f"Could not charge {seconds:.3f}s of rendering to {user}: {e}")
+
+
+def add_cpu(seconds):
+    """Add CPU time spent outside this thread (e.g. by segment workers) to the running meter, if any."""
+    meter = _meter.get()
+    if meter is not None:
+        meter['elsewhere'] += seconds
+
+
+@contextmanager
+def meter():
+    """
+    with render_quota.meter() as used:
+        render(...)
+    used['seconds']  # CPU seconds this thread, and the workers it reported, spent
+    """
+    used = {'seconds': 0.0, 'elsewhere': 0.0}
+    token = _meter.set(used)
+    start = time.thread_time()
+    try:
+        yield used
+    finally:
+        used['seconds'] = time.thread_time() - start + used['elsewhere']
+        _meter.reset(token)
@@ -0,0 +1,230 @@
+"""
+Pre-rendered per-pitch sample bank.
+
+Most compositions are single notes at a handful of lengths and velocities, so
+instead of running FluidSynth for every request we render each playable
+(pitch, length, velocity) once per soundfont, offline, with
+`manage.py build_sample_bank`. A bank is two files in SAMPLE_BANK_DIR:
+
+    <guitar_type>_<sample_rate>.npy    every slot's int16 samples, back to back
+    <guitar_type>_<sample_rate>.json   pitches/lengths/velocities + slot offsets
+
+The .npy is memory-mapped, so worker processes share one copy through the page
+cache. render_events() builds a composition by overlay-adding slot samples at
+each event's onset and returns None as soon as any event isn't in the bank, so
+callers can fall back to the synth.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from . import composition
+
+logger = logging.getLogger(__name__)
+
+# Playable MIDI range per instrument: standard-tuned 4-string bass and
+# 6-string guitar, up to the 24th fret on the highest string.
+PITCH_RANGES = {
+    'acoustic': (40, 88),
+    'classical': (40, 88),
+    'electric': (40, 88),
+    'bass': (28, 67),
+}
+DEFAULT_LENGTHS = (0.125, 0.25, 0.5, 1.0)
+DEFAULT_VELOCITIES = (64, 100, 127)
+RELEASE_TAIL = 1.0  # seconds after note-off, same as the synth path
+
+_banks = {}
+_banks_lock = threading.Lock()
+
+
+def bank_dir():
+    return getattr(settings, 'SAMPLE_BANK_DIR', os.path.join(settings.BASE_DIR, 'sample_bank'))
+
+
+def bank_paths(guitar_type, sample_rate):
+    base = os.path.join(bank_dir(), f"{guitar_type}_{int(sample_rate)}")
+    return base + '.npy', base + '.json'
+
+
+class SampleBank:
+    """A loaded bank: memory-mapped samples plus an offset table per slot."""
+
+    def __init__(self, samples, index):
+        self.samples = samples
+        self.sample_rate = index['sample_rate']
+        self.pitches = index['pitches']
+        self.lengths = [round(float(x), 6) for x in index['lengths']]
+        self.velocities = index['velocities']
+        self.offsets = np.asarray(index['offsets'], dtype=np.int64)  # (P, L, V, 2): start, frames
+        self._pitch_lookup = np.full(128, -1, dtype=np.int64)
+        self._pitch_lookup[self.pitches] = np.arange(len(self.pitches))
+
+    @classmethod
+    def load(cls, guitar_type, sample_rate):
+        npy_path, json_path = bank_paths(guitar_type, sample_rate)
+        with open(json_path) as f:
+            index = json.load(f)
+        return cls(np.load(npy_path, mmap_mode='r'), index)
+
+    def slot_indices(self, events):
+        """
+        Map a composition's events to flat slot numbers, or None if any event
+        has a pitch/length/velocity the bank doesn't contain.
+        """
+        pitches = events['pitch'].astype(np.int64)
+        if np.any((pitches < 0) | (pitches > 127)):
+            return None
+        p = self._pitch_lookup[pitches]
+        l = _match(np.round(events['duration'], 6), self.lengths)
+        v = _match(events['velocity'].astype(np.int64), self.velocities)
+        if np.any(p < 0) or l is None or v is None:
+            return None
+        return np.ravel_multi_index((p, l, v), self.offsets.shape[:3])
+
+    def render(self, events):
+        """
+        Overlay-add the bank samples for `events` (an EVENT_DTYPE array).
+        Returns a float32 mono waveform normalized like pretty_midi, or None.
+        """
+        slots = self.slot_indices(events)
+        if slots is None:
+            return None
+
+        flat_offsets = self.offsets.reshape(-1, 2)
+        onsets = (events['onset'] * self.sample_rate).astype(np.int64)
+        ends = onsets + flat_offsets[slots, 1]
+        out = np.zeros(int(ends.max()) if len(ends) else 0, dtype=np.float32)
+
+        order = np.lexsort((onsets, slots))
+        slots, onsets = slots[order], onsets[order]
+        bounds = np.flatnonzero(np.diff(slots)) + 1
+        for group_onsets, slot in zip(np.split(onsets, bounds), slots[np.r_[0, bounds]]):
+            start, frames = flat_offsets[slot]
+            _overlay(out, group_onsets, np.asarray(self.samples[start:start + frames], dtype=np.float32))
+
+        peak = np.abs(out).max() if len(out) else 0
+        if peak > 0:
+            out /= peak
+        return out
+
+
+def _match(values, table):
+    """Index of each value in `table`, or None if any value is missing."""
+    table = np.asarray(table)
+    order = np.argsort(table)
+    pos = np.clip(np.searchsorted(table[order], values), 0, len(table) - 1)
+    idx = order[pos]
+    if not np.all(table[idx] == values):
+        return None
+    return idx
+
+
+def _overlay(out, onsets, sample):
+    """
+    out[o:o + len(sample)] += sample for every onset.
+
+    Each note is one contiguous vectorized add over its whole slot. Slots are
+    at least RELEASE_TAIL long (tens of thousands of samples), so this beats
+    fancy-indexed scatter-adds by a wide margin and the per-note Python
+    overhead is noise.
+    """
+    n = len(sample)
+    for o in onsets.tolist():
+        out[o:o + n] += sample
+
+
+def get_bank(guitar_type, sample_rate=44100):
+    """The bank for a guitar type, loaded once per process; None if it wasn't built."""
+    key = (guitar_type, int(sample_rate))
+    npy_path, json_path = bank_paths(guitar_type, sample_rate)
+    try:
+        mtime = os.path.getmtime(json_path)
+    except OSError:
+        return None
+
+    with _banks_lock:
+        cached = _banks.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            bank = SampleBank.load(guitar_type, sample_rate)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Sample bank for {guitar_type} @ {sample_rate} Hz is unreadable: {e}")
+            return None
+        _banks[key] = (mtime, bank)
+        return bank
+
+
+def render_events(guitar_type, events, sample_rate=44100, tail=RELEASE_TAIL):
+    """
+    Fast path: assemble a composition (an EVENT_DTYPE array, or
+    [(onset, length, pitch, velocity), ...] rows) from the sample bank
+    without FluidSynth. Returns None if there is no bank
+    or any event falls outside it. A `tail` shorter than the bank's release
+    tail cuts the audio that short after the last note-off.
+    """
+    bank = get_bank(guitar_type, sample_rate)
+    if bank is None or len(events) == 0:
+        return None
+    events = composition.as_events(events)
+    audio = bank.render(events)
+    if audio is not None and tail < RELEASE_TAIL:
+        audio = audio[:int(np.ceil(sample_rate * (composition.end_time(events) + tail)))]
+    return audio
+
+
+def build_bank(guitar_type, synth, lengths=DEFAULT_LENGTHS, velocities=DEFAULT_VELOCITIES,
+               block_frames=8192):
+    """
+    Render every (pitch, length, velocity) slot for one guitar type on a
+    borrowed PooledSynth and write the bank files. Samples are streamed
+    straight into a memory-mapped .npy, so building never holds the bank in RAM.
+    """
+    sample_rate = synth.sample_rate
+    low, high = PITCH_RANGES[guitar_type]
+    pitches = list(range(low, high + 1))
+    lengths = sorted(round(float(x), 6) for x in lengths)
+    velocities = sorted(int(v) for v in velocities)
+
+    # Slots are stored in (pitch, length, velocity) order; each one holds the
+    # note itself plus its release tail.
+    tail_frames = int(sample_rate * RELEASE_TAIL)
+    offsets = np.zeros((len(pitches), len(lengths), len(velocities), 2), dtype=np.int64)
+    offsets[..., 1] = np.array([int(sample_rate * x) + tail_frames for x in lengths])[None, :, None]
+    frames = offsets[..., 1].ravel()
+    offsets[..., 0] = (np.cumsum(frames) - frames).reshape(offsets.shape[:3])
+    total = int(frames.sum())
+
+    os.makedirs(bank_dir(), exist_ok=True)
+    npy_path, json_path = bank_paths(guitar_type, sample_rate)
+    tmp_npy = npy_path + '.tmp.npy'
+    samples = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.int16, shape=(total,))
+    for pi, li, vi in np.ndindex(*offsets.shape[:3]):
+        start, frames = offsets[pi, li, vi]
+        event = [(0.0, lengths[li], pitches[pi], velocities[vi])]
+        synth.reset()
+        pos = start
+        for block in synth.render_blocks(event, block_frames, tail=RELEASE_TAIL):
+            samples[pos:pos + len(block)] = block
+            pos += len(block)
+    samples.flush()
+    del samples
+
+    index = {
+        'guitar_type': guitar_type,
+        'sample_rate': int(sample_rate),
+        'pitches': pitches,
+        'lengths': lengths,
+        'velocities': velocities,
+        'offsets': offsets.tolist(),
+    }
+    os.replace(tmp_npy, npy_path)
+    with open(json_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(json_path + '.tmp', json_path)
+    return npy_path, total
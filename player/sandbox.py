@@ -0,0 +1,296 @@
+"""
+Sandboxed render workers and cost-based admission control.
+
+A render's memory and CPU time grow with its composition, and the full float
+PCM is held in memory until it is encoded, so one oversized request could pin
+a worker or take the machine's RAM with it. Renders submitted as jobs
+therefore run in WorkerPool processes:
+
+    memory   each worker's address space is capped with RLIMIT_AS
+             (RENDER_MEMORY_LIMIT bytes); an allocation past it fails with
+             MemoryError, which fails the render, not the worker
+    CPU      each task may use RENDER_CPU_LIMIT CPU seconds (RLIMIT_CPU,
+             re-armed per task); the kernel kills a worker that goes over
+    time     a task still running RENDER_TIMEOUT seconds after it started is
+             killed with its worker
+
+A dead or killed worker is replaced straight away, so one bad render never
+shrinks the pool, and its task fails with WorkerLost/RenderTimeout.
+
+Workers aren't daemonic, so a render may start processes of its own (see
+segmented.py). Each worker leads its own process group, and killing or
+shutting one down signals the whole group, so those helpers go with it; the
+pool shuts itself down at interpreter exit.
+
+Before any of that, estimate_cost() prices a composition in note-seconds
+(notes x audible length, scaled by the tier's sample rate). admit() rejects
+renders over RENDER_COST_MAX and sends those over RENDER_COST_LOW_PRIORITY to
+the back of the queue, behind every cheaper job.
+"""
+import atexit
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+
+from django.conf import settings
+
+from . import composition
+from .quality import get_tier
+
+try:
+    import resource
+except ImportError:  # Windows: timeouts only
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+DEFAULT_CPU_LIMIT = 300
+DEFAULT_COST_MAX = 250_000
+DEFAULT_COST_LOW_PRIORITY = 25_000
+NORMAL, LOW = 0, 1  # priorities: lower runs first
+KILL_GRACE_SECONDS = 1.0  # between SIGTERM and SIGKILL
+
+
+class TooExpensive(ValueError):
+    """Raised by admit() for a render over RENDER_COST_MAX."""
+
+
+class RenderTimeout(Exception):
+    """A task ran past the pool's timeout; its worker was killed."""
+
+
+class WorkerLost(Exception):
+    """A worker died mid-task (over its CPU limit, crashed or killed)."""
+
+
+def estimate_cost(events, quality='final'):
+    """A render's cost in note-seconds: notes x audible length, relative to 44.1 kHz."""
+    tier = get_tier(quality)
+    if not len(events):
+        return 0.0
+    return len(events) * (composition.end_time(events) + tier.tail) * tier.sample_rate / 44100
+
+
+def admit(events, quality='final'):
+    """
+    (cost, priority) for a render, or TooExpensive if it is over
+    RENDER_COST_MAX. Renders over RENDER_COST_LOW_PRIORITY get LOW priority.
+    """
+    cost = estimate_cost(events, quality)
+    cost_max = getattr(settings, 'RENDER_COST_MAX', DEFAULT_COST_MAX)
+    if cost > cost_max:
+        raise TooExpensive(f"This composition is too long to render ({cost:,.0f} note-seconds, "
+                           f"max {cost_max:,}). Shorten it or split it into parts.")
+    low = getattr(settings, 'RENDER_COST_LOW_PRIORITY', DEFAULT_COST_LOW_PRIORITY)
+    return cost, LOW if cost > low else NORMAL
+
+
+def _cpu_used():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _worker_main(conn, memory_limit, cpu_limit, initializer):
+    if hasattr(os, 'setpgid'):
+        os.setpgid(0, 0)  # also done by the parent; whichever runs first wins the race
+    if resource is not None and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    if initializer is not None:
+        initializer()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:  # the pool went away
+            break
+        if task is None:
+            break
+        fn, args = task
+        if resource is not None and cpu_limit:
+            hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+            soft = int(_cpu_used()) + cpu_limit
+            resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard),
+                                                     hard))
+        try:
+            result = ('ok', fn(*args))
+        except BaseException as e:
+            result = ('error', e)
+        try:
+            conn.send(result)
+        except Exception as e:  # the result or the exception doesn't pickle
+            conn.send(('error', RuntimeError(f"{type(e).__name__}: {e}")))
+    for child in multiprocessing.active_children():  # else exiting waits for them to finish
+        child.terminate()
+
+
+class _Worker:
+    def __init__(self, context, memory_limit, cpu_limit, initializer):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_limit, cpu_limit, initializer),
+                                       name='render-worker')
+        self.process.start()
+        if hasattr(os, 'setpgid'):
+            try:
+                os.setpgid(self.process.pid, self.process.pid)
+            except OSError:  # the worker got there first
+                pass
+        child_conn.close()
+        self.future = None
+        self.deadline = None
+
+    def _signal(self, signum):
+        """Send `signum` to the worker and every process it started; False where there are no process groups."""
+        if not hasattr(os, 'killpg'):
+            return False
+        try:
+            os.killpg(self.process.pid, signum)
+        except OSError:  # nothing left in the group
+            pass
+        return True
+
+    def kill(self):
+        if not self._signal(signal.SIGTERM):
+            self.process.terminate()
+        self.process.join(KILL_GRACE_SECONDS)
+        if not self._signal(signal.SIGKILL) and self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of sandboxed worker processes with a priority queue.
+
+        pool = WorkerPool(workers=2, timeout=60)
+        future = pool.submit(fn, arg, priority=sandbox.LOW)
+
+    submit() returns a concurrent.futures.Future; `fn` and its arguments must
+    pickle. Lower priorities run first, equal priorities in submission order.
+    Defaults come from RENDER_TIMEOUT, RENDER_MEMORY_LIMIT and RENDER_CPU_LIMIT
+    (0 turns a limit off).
+    """
+
+    def __init__(self, workers, timeout=None, memory_limit=None, cpu_limit=None, initializer=None):
+        self.timeout = getattr(settings, 'RENDER_TIMEOUT', DEFAULT_TIMEOUT) if timeout is None else timeout
+        self.memory_limit = (getattr(settings, 'RENDER_MEMORY_LIMIT', DEFAULT_MEMORY_LIMIT)
+                             if memory_limit is None else memory_limit)
+        self.cpu_limit = getattr(settings, 'RENDER_CPU_LIMIT', DEFAULT_CPU_LIMIT) if cpu_limit is None else cpu_limit
+        self.initializer = initializer
+        self.replaced = 0  # workers killed or lost and started again
+        self._context = multiprocessing.get_context('fork' if os.name == 'posix' else 'spawn')
+        self._queue = []  # (priority, seq, future, fn, args)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = self._context.Pipe(duplex=False)
+        self._shutdown = False
+        self._workers = [self._start_worker() for _ in range(workers)]
+        self._thread = threading.Thread(target=self._run, name='render-pool', daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)  # non-daemonic workers would otherwise hold up interpreter exit
+
+    def _start_worker(self):
+        return _Worker(self._context, self.memory_limit, self.cpu_limit, self.initializer)
+
+    def submit(self, fn, *args, priority=NORMAL):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Render pool is shut down")
+            heapq.heappush(self._queue, (priority, next(self._seq), future, fn, args))
+            self._wakeup_w.send(None)
+        return future
+
+    def shutdown(self):
+        atexit.unregister(self.shutdown)
+        with self._lock:
+            self._shutdown = True
+            queued, self._queue = self._queue, []
+            self._wakeup_w.send(None)
+        for _, _, future, _, _ in queued:
+            future.cancel()
+        self._thread.join()
+
+    def _dispatch(self):
+        with self._lock:
+            for i, worker in enumerate(self._workers):
+                if worker.future is not None:
+                    continue
+                if not worker.process.is_alive():  # died while idle
+                    self._replace(worker, None)
+                    worker = self._workers[i]
+                while self._queue:
+                    _, _, future, fn, args = heapq.heappop(self._queue)
+                    if future.set_running_or_notify_cancel():  # False: cancelled while queued
+                        break
+                else:
+                    return
+                try:
+                    worker.conn.send((fn, args))
+                except Exception as e:  # doesn't pickle
+                    future.set_exception(e)
+                    continue
+                worker.future = future
+                worker.deadline = time.monotonic() + self.timeout if self.timeout else None
+
+    def _replace(self, worker, error):
+        future = worker.future
+        worker.kill()
+        self._workers[self._workers.index(worker)] = self._start_worker()
+        self.replaced += 1
+        if future is not None and error is not None:
+            future.set_exception(error)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._shutdown:
+                    break
+            self._dispatch()
+            busy = [w for w in self._workers if w.future is not None]
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            ready = wait([self._wakeup_r] + [w.conn for w in busy] + [w.process.sentinel for w in busy], timeout)
+            if self._wakeup_r in ready:
+                while self._wakeup_r.poll():
+                    self._wakeup_r.recv()
+
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        status, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        pass  # died; the sentinel below takes care of it
+                    else:
+                        future, worker.future, worker.deadline = worker.future, None, None
+                        if status == 'ok':
+                            future.set_result(value)
+                        else:
+                            future.set_exception(value)
+                        continue
+                if not worker.process.is_alive():
+                    code = worker.process.exitcode
+                    logger.error(f"Render worker {worker.process.pid} died (exit code {code}); replacing it")
+                    self._replace(worker, WorkerLost(f"Render worker died (exit code {code})"))
+                elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+                    logger.error(f"Render worker {worker.process.pid} ran past {self.timeout}s; replacing it")
+                    self._replace(worker, RenderTimeout(f"Render took longer than {self.timeout}s"))
+
+        for worker in self._workers:
+            if worker.future is not None:
+                worker.future.set_exception(WorkerLost("Render pool shut down"))
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(KILL_GRACE_SECONDS)
+            worker.kill()  # whatever is left of it and of the processes it started
@@ -0,0 +1,151 @@
+"""
+Segmented parallel rendering of one long composition.
+
+A single FluidSynth render runs on one core. render() cuts a long
+composition's timeline into segments, renders them at the same time in a
+pool of worker processes (each keeping its own warm synths), and stitches
+them back together, so an hour-long piece on an 8-core box takes roughly an
+eighth of the wall time.
+
+Cuts go at note onsets where the fewest notes are still ringing, close to an
+even split. Each segment is rendered with lookback (see
+incremental.render_window): notes already sounding at its start are
+re-synthesized from their own onset, so they enter with the right envelope.
+Neighbouring segments overlap by 2 * CROSSFADE_SECONDS around each cut and
+are overlap-added with complementary linear ramps; both hold the same notes
+there, so the seam is only as audible as the synth state that doesn't follow
+the notes (reverb/chorus tails from before the segment).
+
+Settings:
+    RENDER_SEGMENT_WORKERS      processes per render; 1 turns segmenting off
+    RENDER_SEGMENT_MIN_SECONDS  shortest segment worth a process of its own
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from django.conf import settings
+
+from . import composition, render_quota
+from .incremental import CROSSFADE_SECONDS, render_window
+from .render_jobs import init_worker_process
+from .synth_pool import synth_pool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 1
+DEFAULT_MIN_SECONDS = 30
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker_process)
+            _executor_workers = workers
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def split_points(events, sample_rate, segments, tail=1.0):
+    """
+    Up to `segments` - 1 sample positions to cut a render of `events` at,
+    in order. Each is the note onset within a quarter segment of an even
+    split that has the fewest notes still ringing (ties go to the onset
+    nearest the even split). Fewer cuts come back when the song has no
+    onsets in some of those ranges.
+    """
+    fs = sample_rate
+    total = int(np.ceil(fs * (composition.end_time(events) + tail)))
+    fade = int(fs * CROSSFADE_SECONDS)
+    starts = np.sort((fs * events['onset']).astype(np.int64))
+    ends = np.sort((fs * (events['onset'] + events['duration'] + tail)).astype(np.int64))
+    candidates = np.unique(starts)
+    # Notes that started before a candidate and haven't finished their release by it
+    ringing = np.searchsorted(starts, candidates, 'left') - np.searchsorted(ends, candidates, 'right')
+
+    cuts, reach = [], total / (4 * segments)
+    for k in range(1, segments):
+        target = total * k / segments
+        low = max(cuts[-1] if cuts else 0, target - reach)
+        usable = np.flatnonzero((candidates > low + 2 * fade) & (candidates >= target - reach)
+                                & (candidates <= target + reach) & (candidates < total - 2 * fade))
+        if not len(usable):
+            continue
+        best = usable[np.lexsort((np.abs(candidates[usable] - target), ringing[usable]))[0]]
+        cuts.append(int(candidates[best]))
+    return cuts
+
+
+def _render_segment(guitar_type, sample_rate, events, start, end, tail):
+    """The segment's PCM and the CPU seconds it took."""
+    cpu = time.process_time()
+    with synth_pool.borrow(guitar_type, sample_rate=sample_rate) as synth:
+        return render_window(synth, events, start, end, tail), time.process_time() - cpu
+
+
+def render(guitar_type, events, sample_rate, tail=1.0, dtype='float64', workers=None):
+    """
+    Raw (un-normalized, see synth_pool.normalize_peak) render of `events` in
+    parallel segments, or None when the composition is too short to be worth
+    splitting or RENDER_SEGMENT_WORKERS is 1; render it in one pass then.
+    """
+    workers = workers or getattr(settings, 'RENDER_SEGMENT_WORKERS', DEFAULT_WORKERS)
+    min_seconds = getattr(settings, 'RENDER_SEGMENT_MIN_SECONDS', DEFAULT_MIN_SECONDS)
+    seconds = composition.end_time(events) + tail
+    segments = min(workers, int(seconds // min_seconds))
+    if segments < 2:
+        return None
+    cuts = split_points(events, sample_rate, segments, tail)
+    if not cuts:
+        return None
+
+    started = time.perf_counter()
+    fs = sample_rate
+    total = int(np.ceil(fs * seconds))
+    fade = int(fs * CROSSFADE_SECONDS)
+    bounds = [0] + cuts + [total]
+    windows = [(max(0, a - fade), min(total, b + fade)) for a, b in zip(bounds, bounds[1:])]
+
+    # Ship each worker only the notes it can hear
+    ends = events['onset'] + events['duration'] + tail
+    executor = _get_executor(workers)
+    try:
+        futures = [executor.submit(_render_segment, guitar_type, sample_rate,
+                                   events[(events['onset'] < end / fs) & (ends > start / fs)], start, end, tail)
+                   for start, end in windows]
+        parts, cpu = zip(*[future.result() for future in futures])
+    except BrokenProcessPool:
+        _reset_executor()
+        raise
+    render_quota.add_cpu(sum(cpu))
+
+    # Overlap-add: complementary ramps across the 2 * fade samples around each cut
+    rise = (np.arange(2 * fade) + 0.5) / (2 * fade)
+    out = np.zeros(total, dtype=dtype)
+    for (start, end), part in zip(windows, parts):
+        if start > 0:
+            part[:2 * fade] *= rise
+        if end < total:
+            part[-2 * fade:] *= rise[::-1]
+        out[start:end] += np.rint(part).astype(dtype) if out.dtype.kind == 'i' else part
+
+    logger.info(f"Segmented render of {seconds:.1f}s in {len(windows)} segments "
+                f"took {time.perf_counter() - started:.2f}s")
+    return out
@@ -0,0 +1,134 @@
+"""
+Cached, database-backed sessions that are only written when they change.
+
+SESSION_SAVE_EVERY_REQUEST keeps the session cookie sliding, but with the
+stock backends it also means an UPDATE on django_session for every request,
+even when a view set a key to the value it already had. This store (the
+SESSION_ENGINE) writes through to the database only when
+
+    - the session data differs from what was loaded, or
+    - the sliding expiry has moved SESSION_REFRESH_INTERVAL seconds or more
+      past the stored one
+
+so a user clicking around costs one refresh write per interval rather than
+one per page. The stored expiry may trail the cookie by up to the interval,
+which is why it should be small next to SESSION_COOKIE_AGE.
+
+The database stays the authority. Like Django's cached_db, the store reads
+through the SESSION_CACHE_ALIAS cache, but only when every worker process
+shares that cache. A per-process cache (LocMemCache) would keep serving a
+session after another worker flushed it or cycled its key, e.g. at logout.
+With one of those configured, the store reads the database on every request
+and uses the cache for nothing. Write coalescing doesn't depend on it: it
+compares against what this request loaded.
+
+Expired rows are deleted in bounded batches by prune(), run from
+`manage.py prune_sessions` (Django's clearsessions deletes them in one
+statement).
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.contrib.sessions.models import Session
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 3600
+BATCH_SIZE = 1000
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)  # not shared between worker processes
+
+
+class SessionStore(cached_db.SessionStore):
+    cache_key_prefix = 'player.sessions'
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._saved = None  # serialized data as last loaded or written
+        self._saved_expiry = None  # expire_date as last loaded or written
+
+    def _serialize(self, data):
+        return self.serializer().dumps(data)
+
+    @property
+    def cache_shared(self):
+        """Whether the session cache is one every worker process sees; if not, it isn't used."""
+        return not isinstance(self._cache, PROCESS_LOCAL_CACHES)
+
+    def load(self):
+        cached = None
+        if self.cache_shared:
+            try:
+                cached = self._cache.get(self.cache_key)
+            except Exception:  # e.g. memcached rejecting the key; treat as a miss
+                pass
+        if isinstance(cached, tuple):
+            data, self._saved_expiry = cached
+        else:
+            s = self._get_session_from_db()
+            if s is None:
+                return {}
+            data = self.decode(s.session_data)
+            self._saved_expiry = s.expire_date
+            self._cache_set(data, s.expire_date)
+        self._saved = self._serialize(data)
+        return data
+
+    def exists(self, session_key):
+        if not self.cache_shared:
+            return DBStore.exists(self, session_key)
+        return super().exists(session_key)
+
+    def _cache_set(self, data, expiry):
+        if not self.cache_shared:
+            return
+        try:
+            self._cache.set(self.cache_key, (data, expiry), self.get_expiry_age(expiry=expiry))
+        except Exception:
+            logger.exception(f"Error saving session to cache ({self._cache})")
+
+    def needs_write(self):
+        """Whether save() would write: the data changed, or the expiry is due a refresh."""
+        if self._saved is None or self._saved_expiry is None:
+            return True
+        if self._serialize(self._get_session()) != self._saved:
+            return True
+        interval = getattr(settings, 'SESSION_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL)
+        return (self.get_expiry_date() - self._saved_expiry).total_seconds() >= interval
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()  # comes back with must_create=True
+        if not must_create and not self.needs_write():
+            return
+        DBStore.save(self, must_create)
+        data = self._get_session(no_load=must_create)
+        self._saved = self._serialize(data)
+        self._saved_expiry = self.get_expiry_date()
+        self._cache_set(data, self._saved_expiry)
+
+
+def prune(batch_size=BATCH_SIZE, pause=0.0):
+    """
+    Delete expired sessions, batch_size rows per transaction, sleeping
+    `pause` seconds between batches. Returns the number deleted.
+    """
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            keys = list(Session.objects.filter(expire_date__lt=timezone.now())
+                        .values_list('session_key', flat=True)[:batch_size])
+            if not keys:
+                break
+            deleted += Session.objects.filter(session_key__in=keys).delete()[0]
+        if pause:
+            time.sleep(pause)
+    if deleted:
+        logger.info(f"Pruned {deleted} expired sessions")
+    return deleted
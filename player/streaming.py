@@ -0,0 +1,64 @@
+"""
+Chunked audio streaming for the guitar pages.
+
+The song is rendered block by block on a pooled synth and each block is sent
+as soon as it exists, behind a WAV header whose sizes are left open-ended
+(0xFFFFFFFF) because the final length isn't known up front. Browsers start
+playback after the first block, and memory use stays at one block no matter
+how long the composition is.
+"""
+import struct
+
+from django.conf import settings
+
+from .quality import get_tier
+from .synth_pool import synth_pool
+
+DEFAULT_BLOCK_FRAMES = 2048  # ~46 ms at 44.1 kHz
+UNKNOWN_LENGTH = 0xFFFFFFFF
+
+
+def wav_stream_header(sample_rate, channels=1, bits_per_sample=16):
+    """44-byte PCM WAV header with unknown RIFF and data chunk sizes."""
+    block_align = channels * bits_per_sample // 8
+    return b''.join([
+        b'RIFF', struct.pack('<I', UNKNOWN_LENGTH), b'WAVE',
+        b'fmt ', struct.pack('<IHHIIHH', 16, 1, channels, sample_rate,
+                             sample_rate * block_align, block_align, bits_per_sample),
+        b'data', struct.pack('<I', UNKNOWN_LENGTH),
+    ])
+
+
+def stream_wav(guitar_type, events, sample_rate=44100, block_frames=None, tail=1.0):
+    """
+    Generator of WAV bytes for a StreamingHttpResponse: the header first,
+    then one little-endian int16 block at a time. The synth stays borrowed
+    until the generator finishes or the client disconnects.
+    """
+    block_frames = block_frames or getattr(settings, 'RENDER_STREAM_BLOCK_FRAMES', DEFAULT_BLOCK_FRAMES)
+    yield wav_stream_header(sample_rate)
+    with synth_pool.borrow(guitar_type, sample_rate=sample_rate) as synth:
+        for block in synth.render_blocks(events, block_frames, tail=tail):
+            yield block.astype('<i2', copy=False).tobytes()
+
+
+def stream_audio(guitar_type, events, fmt='wav', bitrate=None, block_frames=None, quality='final'):
+    """
+    Generator of encoded audio bytes in `fmt`. WAV goes through stream_wav;
+    other streamable formats are encoded block by block as the synth renders,
+    at the sample rate the codec needs. `quality` picks the tier's sample
+    rate and release tail (see quality.py).
+    """
+    from . import encoders
+
+    encoder = encoders.get_encoder(fmt, streaming=True)
+    tier = get_tier(quality)
+    sample_rate = encoder.sample_rate_for(tier.sample_rate)
+    if fmt == 'wav':
+        yield from stream_wav(guitar_type, events, sample_rate, block_frames, tail=tier.tail)
+        return
+
+    block_frames = block_frames or getattr(settings, 'RENDER_STREAM_BLOCK_FRAMES', DEFAULT_BLOCK_FRAMES)
+    with synth_pool.borrow(guitar_type, sample_rate=sample_rate) as synth:
+        blocks = synth.render_blocks(events, block_frames, tail=tier.tail)
+        yield from encoders.iter_encoded(blocks, fmt, sample_rate, bitrate)
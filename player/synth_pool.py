@@ -0,0 +1,266 @@
+"""
+Warm FluidSynth pool.
+
+Loading a .sf2 file is by far the slowest part of a render, so instead of
+letting pretty_midi spin up (and throw away) a synthesizer per request we keep
+a few synths per (guitar_type, sample_rate) alive with the SoundFont already
+loaded. Callers borrow one, render, and hand it back.
+"""
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+from . import composition, metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_BORROW_TIMEOUT = 30  # seconds to wait for a free synth
+RENDER_CHUNK_FRAMES = 65536  # samples pulled from the synth per call in render_events
+
+
+class PooledSynth:
+    """
+    A fluidsynth.Synth with one SoundFont loaded into it.
+    """
+
+    def __init__(self, sf2_path, sample_rate):
+        import fluidsynth  # pyfluidsynth, only needed once we actually render
+
+        if not os.path.exists(sf2_path):
+            raise ValueError(f"No soundfont file found at {sf2_path}")
+
+        self.sf2_path = sf2_path
+        self.sample_rate = sample_rate
+        self.synth = fluidsynth.Synth(samplerate=float(sample_rate))
+        self.sfid = self.synth.sfload(sf2_path)
+        if self.sfid == -1:
+            self.synth.delete()
+            raise ValueError(f"FluidSynth could not load soundfont {sf2_path}")
+
+    def reset(self):
+        """Silence every voice and restore default channel state between renders."""
+        self.synth.system_reset()
+
+    def render(self, midi):
+        """Render a PrettyMIDI object exactly like midi.fluidsynth(sf2_path=...) would."""
+        return midi.fluidsynth(synthesizer=self.synth, sfid=self.sfid)
+
+    def render_events(self, events, program=25, tail=1.0, dtype='float64', normalize=True, offset=0):
+        """
+        Render a composition (see composition.py) to a mono float64 waveform
+        normalized to a peak of 1.0, the same result pretty_midi produces for
+        the equivalent PrettyMIDI object, without building one.
+        dtype='int16' keeps the synth's int16 output and normalizes it to full
+        scale in place, at a quarter of the memory. normalize=False returns the
+        synth's raw levels; see normalize_peak(). offset=N starts the output
+        at sample N of the piece (no event may come earlier), keeping event
+        times on the same samples as a render from the start.
+        """
+        events = composition.as_events(events)
+        if not len(events):
+            return np.array([], dtype=dtype)
+        fs = self.sample_rate
+        out = np.zeros(int(np.ceil(fs * (composition.end_time(events) + tail))) - offset, dtype=dtype)
+        pos = 0
+        for chunk in self._synthesize(events, program, tail, RENDER_CHUNK_FRAMES, offset):
+            out[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        if normalize:
+            normalize_peak(out)
+        return out
+
+    def render_blocks(self, events, block_frames, program=25, tail=1.0):
+        """
+        Render a composition as a sequence of mono int16 blocks of
+        `block_frames` samples, without ever holding the whole song in memory.
+        Timing matches pretty_midi: note-offs sort before note-ons at the same
+        instant and `tail` seconds follow the last event.
+        """
+        parts, filled = [], 0
+        for chunk in self._synthesize(events, program, tail, block_frames):
+            parts.append(chunk)
+            filled += len(chunk)
+            if filled == block_frames:
+                yield np.concatenate(parts).astype(np.int16, copy=False)
+                parts, filled = [], 0
+        if parts:
+            yield np.concatenate(parts).astype(np.int16, copy=False)
+
+    def _synthesize(self, events, program, tail, max_frames, offset=0):
+        """
+        Drive the synth through a composition, yielding its left channel in
+        chunks that never cross a multiple of `max_frames` or an event time.
+        """
+        events = composition.as_events(events)
+        if not len(events):
+            return
+        fs = self.sample_rate
+        samples, is_on, pitch, velocity, channel = composition.schedule(events, fs)
+        samples -= offset
+        for ch in np.unique(channel).tolist():
+            self.synth.program_select(ch, self.sfid, 0, program)
+
+        # Events sharing a sample are sent together, then the synth runs to the next one
+        starts = np.r_[0, np.flatnonzero(np.diff(samples)) + 1].tolist()
+        times = samples[starts].tolist() + [int(samples[-1]) + int(fs * tail)]
+        is_on, pitch, velocity, channel = is_on.tolist(), pitch.tolist(), velocity.tolist(), channel.tolist()
+        stops = starts[1:] + [len(is_on)]
+
+        pos = 0
+        for group, (first, stop) in enumerate(zip(starts, stops)):
+            while pos < times[group]:  # only before the first event
+                end = min(times[group], (pos // max_frames + 1) * max_frames)
+                yield self.synth.get_samples(end - pos)[::2]
+                pos = end
+            for i in range(first, stop):
+                if is_on[i]:
+                    self.synth.noteon(channel[i], pitch[i], velocity[i])
+                else:
+                    self.synth.noteoff(channel[i], pitch[i])
+            while pos < times[group + 1]:
+                end = min(times[group + 1], (pos // max_frames + 1) * max_frames)
+                yield self.synth.get_samples(end - pos)[::2]  # left channel, like pretty_midi
+                pos = end
+
+    def close(self):
+        self.synth.delete()
+
+
+def normalize_peak(audio):
+    """
+    Scale a raw render in place so its peak is full scale (1.0 for floats,
+    32767 for int16), like pretty_midi does. Returns the raw peak it divided by.
+    """
+    if audio.dtype == np.int16:
+        peak = max(int(audio.max()), -int(audio.min())) if len(audio) else 0  # np.abs(-32768) overflows
+        if peak > 0:
+            np.multiply(audio, 32767 / peak, out=audio, casting='unsafe')
+        return float(peak)
+    peak = float(np.abs(audio).max()) if len(audio) else 0.0
+    if peak > 0:
+        audio /= peak
+    return peak
+
+
+class SynthPool:
+    """
+    Per-process pool of PooledSynth instances, keyed by (guitar_type, sample_rate).
+
+    Synths are created lazily up to `size` per key and then reused forever.
+    A synth that raises while borrowed is discarded instead of being returned,
+    so a broken instance can't poison later renders.
+    """
+
+    def __init__(self, size=None, timeout=None, factory=PooledSynth):
+        self.size = size or getattr(settings, 'SYNTH_POOL_SIZE', DEFAULT_POOL_SIZE)
+        self.timeout = timeout or getattr(settings, 'SYNTH_POOL_TIMEOUT', DEFAULT_BORROW_TIMEOUT)
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = {}     # key -> LifoQueue of idle synths
+        self._created = {}  # key -> number of live synths for that key
+
+    def _check_fork(self):
+        # A pool inherited through fork() (gunicorn --preload, process pools)
+        # must not share native synth handles with its parent.
+        if self._pid != os.getpid():
+            self._reset_state()
+
+    def _acquire(self, guitar_type, sample_rate):
+        from .audio_utils import get_soundfont_path
+
+        sf2_path = get_soundfont_path(guitar_type)
+        key = (guitar_type, int(sample_rate))
+        with self._lock:
+            self._check_fork()
+            idle = self._idle.setdefault(key, queue.LifoQueue())
+            try:
+                return key, idle.get_nowait()
+            except queue.Empty:
+                pass
+            can_create = self._created.get(key, 0) < self.size
+            if can_create:
+                self._created[key] = self._created.get(key, 0) + 1
+
+        if can_create:
+            try:
+                logger.info(f"Loading soundfont for {guitar_type} @ {sample_rate} Hz into synth pool")
+                return key, self.factory(sf2_path, int(sample_rate))
+            except Exception:
+                with self._lock:
+                    self._created[key] -= 1
+                raise
+
+        try:
+            return key, idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free {guitar_type} synthesizer after {self.timeout}s") from None
+
+    def _release(self, key, synth):
+        with self._lock:
+            if self._pid == os.getpid() and key in self._idle:
+                self._idle[key].put(synth)
+                return
+        synth.close()
+
+    def _discard(self, key, synth):
+        with self._lock:
+            if self._pid == os.getpid() and key in self._created:
+                self._created[key] -= 1
+        try:
+            synth.close()
+        except Exception as e:
+            logger.debug(f"Error closing discarded synth: {e}")
+
+    @contextmanager
+    def borrow(self, guitar_type, sample_rate=44100):
+        """
+        with synth_pool.borrow('acoustic') as synth:
+            audio = synth.render(midi)
+        """
+        with metrics.stage('soundfont', guitar_type):
+            key, synth = self._acquire(guitar_type, sample_rate)
+        try:
+            synth.reset()
+            yield synth
+        except Exception:
+            self._discard(key, synth)
+            raise
+        except BaseException:
+            # GeneratorExit from an abandoned stream: the synth itself is fine,
+            # reset() on the next borrow silences whatever was still sounding
+            self._release(key, synth)
+            raise
+        else:
+            self._release(key, synth)
+
+    def warm(self, guitar_types=None, sample_rate=44100):
+        """Load one synth per guitar type up front so the first request is already warm."""
+        from .audio_utils import SOUNDFONT_FILES
+
+        for guitar_type in guitar_types or SOUNDFONT_FILES:
+            with self.borrow(guitar_type, sample_rate):
+                pass
+
+    def close(self):
+        """Delete every idle synth (borrowed ones are closed when they come back)."""
+        with self._lock:
+            idle, self._idle, self._created = self._idle, {}, {}
+        for q in idle.values():
+            while True:
+                try:
+                    q.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
+synth_pool = SynthPool()
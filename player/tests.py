@@ -1,3 +1,1881 @@
-from django.test import TestCase
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (audio_utils, avatars, benchmarks, composition, counters, encoders, generated_files, incremental, metrics,
+               peaks, prewarm, rate_limit, render_cache, render_jobs, render_quota, sample_bank, sandbox, segmented,
+               streaming)
+from .batch import render_batch
+from .models import Dashboard, GeneratedFile, Profile, RenderJob, RenderQuota
+from .synth_pool import PooledSynth, SynthPool
+
+CONFIGURED_RATE_LIMITS = settings.RATE_LIMITS
+
+
+def setUpModule():
+    # Rate limit, counter and session cache state outlives requests and test transactions: keep this run's in
+    # throwaway files, and rate limits off everywhere but RateLimitTests
+    state_dir = tempfile.mkdtemp()
+    session_cache = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                     'LOCATION': os.path.join(state_dir, 'sessions')}
+    override = override_settings(RATE_LIMIT_DB=os.path.join(state_dir, 'rate_limit.sqlite3'), RATE_LIMITS={},
+                                 METRICS_DB=os.path.join(state_dir, 'metrics.sqlite3'),
+                                 CACHES={**settings.CACHES, 'sessions': session_cache})
+    override.enable()
+    unittest.addModuleCleanup(shutil.rmtree, state_dir, ignore_errors=True)
+    unittest.addModuleCleanup(override.disable)
+
+
+class FakeSynth:
+    instances = 0
+    renders = 0
+
+    def __init__(self, sf2_path, sample_rate):
+        FakeSynth.instances += 1
+        self.sf2_path = sf2_path
+        self.sample_rate = sample_rate
+        self.resets = 0
+        self.closed = False
+
+    def reset(self):
+        self.resets += 1
+
+    def render_events(self, events, program=25, tail=1.0, dtype='float64', normalize=True):
+        FakeSynth.renders += 1
+        # Deterministic stand-in waveform: one 0.25 s tone per note
+        return np.concatenate([
+            np.sin(np.arange(int(0.25 * self.sample_rate)) * pitch / 1000.0) * 0.5
+            for pitch in events['pitch'].tolist()
+        ])
+
+    def render_blocks(self, events, block_frames, program=25, tail=1.0):
+        FakeSynth.renders += 1
+        total = int((composition.end_time(events) + tail) * self.sample_rate)
+        for start in range(0, total, block_frames):
+            yield np.full(min(block_frames, total - start), 1000, dtype=np.int16)
+
+    def close(self):
+        self.closed = True
+
+
+class SynthPoolTests(SimpleTestCase):
+    def setUp(self):
+        FakeSynth.instances = 0
+        FakeSynth.renders = 0
+
+    def test_borrow_reuses_loaded_synth_and_resets_it(self):
+        pool = SynthPool(size=2, factory=FakeSynth)
+        with pool.borrow('acoustic') as first:
+            pass
+        with pool.borrow('acoustic') as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(FakeSynth.instances, 1)
+        self.assertEqual(second.resets, 2)
+        self.assertTrue(first.sf2_path.endswith('acoustic_guitar.sf2'))
+
+    def test_pool_is_keyed_by_guitar_type_and_sample_rate(self):
+        pool = SynthPool(size=1, factory=FakeSynth)
+        with pool.borrow('acoustic') as a, pool.borrow('bass') as b:
+            self.assertIsNot(a, b)
+        with pool.borrow('acoustic', sample_rate=22050) as c:
+            self.assertEqual(c.sample_rate, 22050)
+        self.assertEqual(FakeSynth.instances, 3)
+
+    def test_size_caps_concurrent_synths(self):
+        pool = SynthPool(size=1, timeout=0.05, factory=FakeSynth)
+        with pool.borrow('electric'):
+            with self.assertRaises(TimeoutError):
+                with pool.borrow('electric'):
+                    pass
+
+        waiter_got = []
+        with pool.borrow('electric') as held:
+            t = threading.Thread(target=lambda: waiter_got.append(pool.borrow('electric').__enter__()))
+            pool.timeout = 2
+            t.start()
+        t.join()
+        self.assertIs(waiter_got[0], held)
+
+    def test_failed_render_discards_synth(self):
+        pool = SynthPool(size=1, factory=FakeSynth)
+        with self.assertRaises(RuntimeError):
+            with pool.borrow('classical') as broken:
+                raise RuntimeError('synth crashed')
+        self.assertTrue(broken.closed)
+        with pool.borrow('classical') as fresh:
+            self.assertIsNot(fresh, broken)
+
+    def test_invalid_guitar_type(self):
+        pool = SynthPool(factory=FakeSynth)
+        with self.assertRaises(ValueError):
+            with pool.borrow('banjo'):
+                pass
+
+
+class MediaRootMixin:
+    """Point MEDIA_ROOT at a throwaway directory and swap in a FakeSynth pool."""
+
+    def setUp(self):
+        super().setUp()
+        FakeSynth.instances = 0
+        FakeSynth.renders = 0
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.pool = SynthPool(factory=FakeSynth)
+        for module in (audio_utils, segmented, streaming):
+            pool_patch = mock.patch.object(module, 'synth_pool', self.pool)
+            pool_patch.start()
+            self.addCleanup(pool_patch.stop)
+        from django.core.cache import cache
+        cache.clear()
+        counters.reset()
+
+
+class RenderCacheTests(MediaRootMixin, TestCase):
+    def test_identical_request_is_served_from_cache(self):
+        first = audio_utils.create_guitar_music('acoustic', [40, 45, 50], duration=0.5)
+        second = audio_utils.create_guitar_music('acoustic', [40, 45, 50], duration=0.5)
+        self.assertEqual(first, second)
+        self.assertEqual(FakeSynth.renders, 1)
+        stats = render_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['files'], 1)
+
+    def test_compositions_sharing_first_note_do_not_collide(self):
+        a = audio_utils.create_guitar_music('acoustic', [40, 45], duration=0.5)
+        b = audio_utils.create_guitar_music('acoustic', [40, 47], duration=0.5)
+        c = audio_utils.create_guitar_music('bass', [40, 45], duration=0.5)
+        d = audio_utils.create_guitar_music('acoustic', [40, 45], duration=1.0)
+        self.assertEqual(len({a, b, c, d}), 4)
+        self.assertEqual(FakeSynth.renders, 4)
+
+    def test_eviction_drops_least_recently_used(self):
+        old = audio_utils.create_guitar_music('acoustic', [40], duration=0.5)
+        newer = audio_utils.create_guitar_music('acoustic', [41], duration=0.5)
+        old_path = os.path.join(self.media_root, 'generated', os.path.basename(old))
+        newer_path = os.path.join(self.media_root, 'generated', os.path.basename(newer))
+        past = time.time() - 100
+        os.utime(old_path, (past, past))
+        os.utime(newer_path, (past + 10, past + 10))
+        # A hit makes the older render the most recently used one
+        audio_utils.create_guitar_music('acoustic', [40], duration=0.5)
+
+        size = os.path.getsize(old_path)
+        with override_settings(RENDER_CACHE_MAX_BYTES=size * 2):
+            audio_utils.create_guitar_music('acoustic', [42], duration=0.5)
+
+        self.assertTrue(os.path.exists(old_path))
+        self.assertFalse(os.path.exists(newer_path))
+        self.assertEqual(render_cache.stats()['evictions'], 1)
+
+
+class RecordingFluidSynth:
+    """Stands in for fluidsynth.Synth and records what PooledSynth asks of it."""
+
+    def __init__(self):
+        self.calls = []
+
+    def program_select(self, channel, sfid, bank, program):
+        self.calls.append(('program', program))
+
+    def noteon(self, channel, pitch, velocity):
+        self.calls.append(('on', pitch, velocity))
+
+    def noteoff(self, channel, pitch):
+        self.calls.append(('off', pitch))
+
+    def get_samples(self, frames):
+        self.calls.append(('samples', frames))
+        return np.ones(frames * 2, dtype=np.int16)
+
+
+class StatefulFluidSynth:
+    """
+    Stands in for fluidsynth.Synth with output that depends on which notes are
+    sounding and on the sample clock, so any timing or ordering difference
+    between two renderers shows up in the samples.
+    """
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.active = {}
+        self.clock = 0
+
+    def get_setting(self, name):
+        return float(self.sample_rate)
+
+    def system_reset(self):
+        self.active = {}
+
+    def program_select(self, channel, sfid, bank, program):
+        pass
+
+    def noteon(self, channel, pitch, velocity):
+        self.active[pitch] = self.active.get(pitch, 0) + velocity
+
+    def noteoff(self, channel, pitch):
+        self.active.pop(pitch, None)
+
+    def get_samples(self, frames):
+        level = sum(p * v for p, v in self.active.items()) % 3000
+        mono = (np.arange(self.clock, self.clock + frames) % 7 + level).astype(np.int16)
+        self.clock += frames
+        return np.repeat(mono, 2)
+
+
+class RenderBlocksTests(SimpleTestCase):
+    def make_synth(self, sample_rate=100):
+        synth = PooledSynth.__new__(PooledSynth)
+        synth.sample_rate = sample_rate
+        synth.sfid = 1
+        synth.synth = RecordingFluidSynth()
+        return synth
+
+    def test_blocks_are_fixed_size_and_events_land_on_exact_samples(self):
+        synth = self.make_synth()
+        events = [(0.0, 0.25, 40, 100), (0.25, 0.5, 45, 90)]
+        blocks = list(synth.render_blocks(events, block_frames=32, tail=1.0))
+
+        self.assertEqual(sum(len(b) for b in blocks), 175)  # 0.75 s of notes + 1 s tail
+        self.assertTrue(all(len(b) == 32 for b in blocks[:-1]))
+        self.assertEqual(blocks[0].dtype, np.int16)
+
+        calls = synth.synth.calls
+        self.assertEqual(calls[0], ('program', 25))
+        # The note-off for 40 precedes the note-on for 45 at sample 25
+        self.assertEqual(calls[1:5], [('on', 40, 100), ('samples', 25), ('off', 40), ('on', 45, 90)])
+
+
+class GuitarStreamViewTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('streamer', 'streamer@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def test_streams_open_ended_wav(self):
+        url = reverse('player:guitar_stream', args=['acoustic'])
+        with override_settings(RENDER_STREAM_BLOCK_FRAMES=4410):
+            response = self.client.get(url, {'notes': '40,45', 'duration': '0.5'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'audio/wav')
+            chunks = list(response.streaming_content)
+
+        header = chunks[0]
+        self.assertEqual(header[:4], b'RIFF')
+        self.assertEqual(header[4:8], b'\xff\xff\xff\xff')
+        self.assertEqual(header[40:44], b'\xff\xff\xff\xff')
+        self.assertEqual(len(chunks[1]), 4410 * 2)
+        self.assertEqual(sum(len(c) for c in chunks[1:]), 2 * 44100 * 2)  # 1 s of notes + 1 s tail
+        self.assertEqual(FakeSynth.renders, 1)
+
+    def test_per_note_durations(self):
+        url = reverse('player:guitar_stream', args=['bass'])
+        response = self.client.get(url, {'notes': '40,45', 'durations': '0.25,0.75'})
+        self.assertEqual(sum(len(c) for c in list(response.streaming_content)[1:]), 2 * 44100 * 2)
+
+    def test_chords_and_velocities(self):
+        url = reverse('player:guitar_stream', args=['classical'])
+        response = self.client.get(url, {'notes': '40,44,47,52', 'onsets': '0,0,0,0.5', 'duration': '1',
+                                         'velocities': '90,80,80,110'})
+        self.assertEqual(sum(len(c) for c in list(response.streaming_content)[1:]), int(2.5 * 44100) * 2)
+        self.assertEqual(self.client.get(url, {'notes': '40,44', 'onsets': '0'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'notes': '40', 'velocities': '0'}).status_code, 400)
+
+    def test_rejects_bad_input(self):
+        url = reverse('player:guitar_stream', args=['acoustic'])
+        self.assertEqual(self.client.get(url, {'notes': ''}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'notes': '40,x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'notes': '40,200'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'notes': '40', 'durations': '1,2'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('player:guitar_stream', args=['banjo']),
+                                         {'notes': '40'}).status_code, 404)
+
+    def test_requires_login(self):
+        self.client.logout()
+        response = self.client.get(reverse('player:guitar_stream', args=['acoustic']), {'notes': '40'})
+        self.assertEqual(response.status_code, 302)
+
+
+class ToneSynth:
+    """Minimal PooledSynth stand-in that renders a pitch/velocity dependent ramp."""
+
+    def __init__(self, sample_rate=1000):
+        self.sample_rate = sample_rate
+
+    def reset(self):
+        pass
+
+    def render_blocks(self, events, block_frames, program=25, tail=1.0):
+        onset, length, pitch, velocity = events[0]
+        frames = int(self.sample_rate * length) + int(self.sample_rate * tail)
+        tone = (np.arange(frames) % 50 * pitch * velocity // 100).astype(np.int16)
+        for start in range(0, frames, block_frames):
+            yield tone[start:start + block_frames]
+
+
+class SampleBankTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        bank_override = override_settings(SAMPLE_BANK_DIR=os.path.join(self.media_root, 'bank'))
+        bank_override.enable()
+        self.addCleanup(bank_override.disable)
+        sample_bank.build_bank('bass', ToneSynth(), lengths=(0.25, 0.5), velocities=(100,), block_frames=64)
+
+    def naive_mix(self, bank, events):
+        out = np.zeros(0, dtype=np.float64)
+        for onset, length, pitch, velocity in events:
+            slot = bank.slot_indices(composition.as_events([(onset, length, pitch, velocity)]))[0]
+            start, frames = bank.offsets.reshape(-1, 2)[slot]
+            at = int(onset * bank.sample_rate)
+            if len(out) < at + frames:
+                out = np.pad(out, (0, at + frames - len(out)))
+            out[at:at + frames] += bank.samples[start:start + frames]
+        return out / np.abs(out).max()
+
+    def test_overlay_add_matches_naive_mix_with_overlapping_notes(self):
+        bank = sample_bank.get_bank('bass', 1000)
+        rng = np.random.default_rng(0)
+        events = [(round(float(rng.uniform(0, 3)), 3), float(rng.choice([0.25, 0.5])), int(rng.integers(28, 68)), 100)
+                  for _ in range(200)]
+        events += [(1.0, 0.25, 40, 100)] * 3  # identical stacked notes
+        fast = sample_bank.render_events('bass', events, 1000)
+        np.testing.assert_allclose(fast, self.naive_mix(bank, events), atol=1e-5)
+
+    def test_events_outside_bank_are_rejected(self):
+        self.assertIsNone(sample_bank.render_events('bass', [(0, 0.25, 90, 100)], 1000))  # pitch
+        self.assertIsNone(sample_bank.render_events('bass', [(0, 0.3, 40, 100)], 1000))   # length
+        self.assertIsNone(sample_bank.render_events('bass', [(0, 0.25, 40, 64)], 1000))   # velocity
+        self.assertIsNone(sample_bank.render_events('acoustic', [(0, 0.25, 40, 100)], 1000))  # no bank
+
+    def test_fast_path_falls_back_to_synth(self):
+        with mock.patch.object(sample_bank, 'render_events', return_value=None) as fast:
+            url = audio_utils.create_guitar_music_fast('bass', [40, 45], duration=0.5)
+        fast.assert_called_once()
+        self.assertEqual(FakeSynth.renders, 1)
+        self.assertEqual(counters.get('render_cache_misses'), 1)  # not once per lookup
+        self.assertEqual(url, audio_utils.create_guitar_music('bass', [40, 45], duration=0.5))
+
+
+@override_settings(RENDER_JOB_BACKEND='inline', RENDER_QUEUE_MAX=2)
+class RenderJobTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('jobber', 'jobber@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def submit(self, **data):
+        data.setdefault('guitar_type', 'acoustic')
+        data.setdefault('notes', '40,45,50')
+        data.setdefault('duration', '0.5')
+        return self.client.post(reverse('player:render_job_submit'), data)
+
+    def test_submit_then_poll_status(self):
+        response = self.submit()
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job']['id']
+
+        status = self.client.get(response.json()['status_url']).json()['job']
+        self.assertEqual(status['id'], job_id)
+        self.assertEqual(status['status'], RenderJob.DONE)
+        self.assertTrue(status['url'].startswith('/media/generated/'))
+        self.assertEqual(status['peaks_url'], peaks.peaks_url(status['url']))
+        self.assertEqual(FakeSynth.renders, 1)
+
+    def test_full_queue_is_rejected_with_429(self):
+        for _ in range(2):
+            RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0)
+        response = self.submit()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(RenderJob.objects.count(), 2)
+
+    def test_orphaned_jobs_are_failed_and_free_the_queue(self):
+        long_ago = timezone.now() - timedelta(hours=2)
+        running = RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0,
+                                           status=RenderJob.RUNNING)
+        RenderJob.objects.filter(pk=running.pk).update(started_at=long_ago)
+        queued = RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0)
+        RenderJob.objects.filter(pk=queued.pk).update(created_at=long_ago)
+        recent = RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0,
+                                          status=RenderJob.RUNNING, started_at=timezone.now())
+
+        self.assertEqual(self.submit().status_code, 202)
+        for job, status in ((running, RenderJob.FAILED), (queued, RenderJob.FAILED), (recent, RenderJob.RUNNING)):
+            job.refresh_from_db()
+            self.assertEqual(job.status, status)
+        self.assertEqual(RenderJob.objects.get(pk=running.pk).error, 'The render worker was lost.')
+
+    def test_a_refused_submit_leaves_no_row(self):
+        for _ in range(2):
+            RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0)
+        with self.assertRaises(render_jobs.QueueFull):
+            render_jobs.submit(self.user, 'acoustic', [40], 0.5)
+        self.assertEqual(RenderJob.objects.count(), 2)
+
+    def test_cancelled_job_never_renders(self):
+        job = RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0)
+        response = self.client.post(reverse('player:render_job_cancel', args=[job.pk]))
+        self.assertEqual(response.json()['job']['status'], RenderJob.CANCELLED)
+
+        render_jobs.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.CANCELLED)
+        self.assertEqual(FakeSynth.renders, 0)
+        # Cancelling again is a conflict
+        self.assertEqual(self.client.post(reverse('player:render_job_cancel', args=[job.pk])).status_code, 409)
+
+    def test_failed_render_is_recorded(self):
+        with mock.patch.object(audio_utils, 'create_guitar_music', side_effect=RuntimeError('synth crashed')):
+            job_id = self.submit().json()['job']['id']
+        job = RenderJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, RenderJob.FAILED)
+        self.assertEqual(job.error, 'synth crashed')
+
+    def test_expensive_renders_are_refused_or_deprioritized(self):
+        with override_settings(RENDER_COST_MAX=10):
+            response = self.submit(notes='40,45,50,52,55', duration='2')
+            self.assertEqual(response.status_code, 413)
+            self.assertIn('too long', response.json()['error'])
+            self.assertEqual(self.client.get(reverse('player:guitar_stream', args=['acoustic']),
+                                             {'notes': '40,45,50,52,55', 'duration': '2'}).status_code, 413)
+        self.assertEqual(RenderJob.objects.count(), 0)
+
+        pool = mock.Mock()
+        with override_settings(RENDER_JOB_BACKEND='process', RENDER_COST_LOW_PRIORITY=10), \
+                mock.patch.object(render_jobs, '_get_executor', return_value=pool):
+            self.submit(notes='40,45')
+            self.submit(notes='40,45,50,52,55', duration='2')
+        priorities = [call.kwargs['priority'] for call in pool.submit.call_args_list]
+        self.assertEqual(priorities, [sandbox.NORMAL, sandbox.LOW])
+
+    def test_jobs_are_private(self):
+        job = RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0)
+        other = User.objects.create_user('other', 'other@example.com', 'pw123456')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('player:render_job_status', args=[job.pk])).status_code, 404)
+        self.assertEqual(self.client.post(reverse('player:render_job_cancel', args=[job.pk])).status_code, 404)
+
+
+class BatchRenderTests(MediaRootMixin, TestCase):
+    def test_batch_reports_per_item_results_and_throughput(self):
+        report = render_batch([
+            {'guitar_type': 'acoustic', 'notes': [40, 45], 'duration': 0.5},
+            ('bass', [28, 33, 38], 1.0),
+            {'guitar_type': 'banjo', 'notes': [40], 'duration': 0.5},
+        ], workers=1)
+
+        self.assertEqual((report['renders'], report['succeeded'], report['failed']), (3, 2, 1))
+        self.assertTrue(report['results'][0]['url'].endswith('.wav'))
+        self.assertEqual(report['results'][1]['audio_seconds'], 4.0)  # 3 notes + release tail
+        self.assertIn('ValueError', report['results'][2]['error'])
+        self.assertGreater(report['renders_per_second'], 0)
+        self.assertGreater(report['realtime_factor'], 0)
+
+    def test_batch_api_is_staff_only(self):
+        url = reverse('player:render_batch')
+        body = '{"items": [{"guitar_type": "electric", "notes": [52], "duration": 0.25}], "workers": 1}'
+        user = User.objects.create_user('teacher', 'teacher@example.com', 'pw123456')
+        self.client.force_login(user)
+        self.assertEqual(self.client.post(url, body, content_type='application/json').status_code, 302)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.post(url, body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['success'])
+        name = os.path.basename(response.json()['results'][0]['url'])
+        self.assertEqual(GeneratedFile.objects.get(name=name).owner, user)  # counts against the submitter's quota
+        self.assertEqual(self.client.post(url, '{"items": []}', content_type='application/json').status_code, 400)
+
+    @override_settings(RENDER_BATCH_WORKERS=2, RENDER_COST_MAX=100)
+    def test_batch_api_checks_every_item_first_and_caps_workers(self):
+        url = reverse('player:render_batch')
+        staff = User.objects.create_user('editor', 'editor@example.com', 'pw123456', is_staff=True)
+        self.client.force_login(staff)
+        good = {'guitar_type': 'electric', 'notes': [52], 'duration': 0.25}
+        for bad, status in (({'guitar_type': 'electric', 'notes': [52], 'duration': 99}, 400),
+                            ({'guitar_type': 'banjo', 'notes': [52]}, 400),
+                            ({'guitar_type': 'electric', 'notes': [200]}, 400),
+                            ({'guitar_type': 'electric', 'notes': [40] * 50, 'duration': 4}, 413)):
+            with mock.patch('player.views.render_batch') as batch:
+                response = self.client.post(url, json.dumps({'items': [good, bad]}), content_type='application/json')
+            self.assertEqual(response.status_code, status, bad)
+            self.assertEqual(response.json()['index'], 1)
+            batch.assert_not_called()
+
+        response = self.client.post(url, json.dumps({'items': [good], 'workers': 10 ** 6}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['workers'], 2)
+
+    def test_batch_api_requires_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(User.objects.create_user('editor', 'editor@example.com', 'pw123456', is_staff=True))
+        body = '{"items": [{"guitar_type": "electric", "notes": [52], "duration": 0.25}]}'
+        self.assertEqual(client.post(reverse('player:render_batch'), body,
+                                     content_type='application/json').status_code, 403)
+
+
+class EncoderTests(MediaRootMixin, TestCase):
+    def test_negotiate_prefers_query_param_then_accept_then_default(self):
+        factory = RequestFactory()
+        self.assertEqual(encoders.negotiate(factory.get('/', {'format': 'flac'}, HTTP_ACCEPT='audio/ogg')), 'flac')
+        self.assertEqual(encoders.negotiate(factory.get('/', HTTP_ACCEPT='audio/mpeg;q=0.5, audio/ogg')), 'opus')
+        self.assertEqual(encoders.negotiate(factory.get('/', HTTP_ACCEPT='audio/mpeg, audio/flac')), 'mp3')
+        self.assertEqual(encoders.negotiate(factory.get('/', HTTP_ACCEPT='audio/*')), 'wav')
+        self.assertEqual(encoders.negotiate(factory.get('/', HTTP_ACCEPT='audio/mpeg'), streaming=True), 'wav')
+        with self.assertRaises(ValueError):
+            encoders.negotiate(factory.get('/', {'format': 'mp3'}), streaming=True)
+
+    def test_compressed_renders_are_cached_per_format_and_smaller(self):
+        import soundfile as sf
+
+        notes = [40, 45, 50, 55]
+        paths = {}
+        for fmt in ('wav', 'flac', 'opus', 'mp3'):
+            url = audio_utils.create_guitar_music('acoustic', notes, duration=0.5, fmt=fmt)
+            self.assertTrue(url.endswith('.' + fmt))
+            paths[fmt] = os.path.join(self.media_root, 'generated', os.path.basename(url))
+        self.assertEqual(FakeSynth.renders, 4)
+        for fmt in ('flac', 'opus', 'mp3'):
+            self.assertLess(os.path.getsize(paths[fmt]), os.path.getsize(paths['wav']))
+        self.assertEqual(sf.info(paths['opus']).samplerate, 48000)
+
+        low = audio_utils.create_guitar_music('acoustic', notes, duration=0.5, fmt='mp3', bitrate=64)
+        self.assertNotEqual(os.path.basename(low), os.path.basename(paths['mp3']))
+        with self.assertRaises(ValueError):
+            audio_utils.create_guitar_music('acoustic', notes, duration=0.5, fmt='wav', bitrate=64)
+
+    def test_stream_view_encodes_opus_on_the_fly(self):
+        user = User.objects.create_user('listener', 'listener@example.com', 'pw123456')
+        self.client.force_login(user)
+        url = reverse('player:guitar_stream', args=['electric'])
+        response = self.client.get(url, {'notes': '52,55', 'duration': '0.5', 'bitrate': '64'},
+                                   HTTP_ACCEPT='audio/ogg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'audio/ogg')
+        body = b''.join(response.streaming_content)
+        self.assertEqual(body[:4], b'OggS')
+        self.assertLess(len(body), 2 * 48000 * 2)
+        self.assertEqual(self.client.get(url, {'notes': '52', 'format': 'flac'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'notes': '52', 'format': 'opus', 'bitrate': '999'}).status_code, 400)
+
+
+class RenderBenchmarkTests(MediaRootMixin, TestCase):
+    def test_suite_measures_each_case_without_cache_hits(self):
+        report = benchmarks.run_suite(guitar_types=['bass'], engines=['synth', 'bank'], sizes=[1, 4],
+                                      sample_rates=[22050], isolate=False)
+        self.assertEqual(report['results'][0]['quality'], 'final')
+        synth_cases = [c for c in report['results'] if c['engine'] == 'synth']
+        self.assertEqual([c['notes'] for c in synth_cases], [1, 4])
+        self.assertEqual(FakeSynth.renders, 2)
+        for case in synth_cases:
+            self.assertIsNone(case['error'])
+            self.assertEqual(case['output_bytes'], 44 + case['notes'] * int(0.25 * 22050) * 2)
+            self.assertGreater(case['realtime_factor'], 0)
+            self.assertGreater(case['peak_rss_mb'], 0)
+        self.assertTrue(all(c['skipped'] for c in report['results'] if c['engine'] == 'bank'))
+
+    def test_peak_rss_is_skipped_without_resource_module(self):
+        with mock.patch.object(benchmarks, 'resource', None):
+            report = benchmarks.run_suite(guitar_types=['bass'], engines=['synth'], sizes=[1],
+                                          sample_rates=[22050], isolate=False)
+        case = report['results'][0]
+        self.assertIsNone(case['error'])
+        self.assertIsNone(case['peak_rss_mb'])
+        self.assertEqual(benchmarks.compare(report, {'results': [dict(case, peak_rss_mb=100.0)]})['regressions'], [])
+
+    def test_compare_flags_regressions_against_baseline(self):
+        def case(notes, wall, rss=100.0, size=1000, error=None):
+            return {'engine': 'synth', 'guitar_type': 'acoustic', 'sample_rate': 44100, 'notes': notes,
+                    'wall_seconds': wall, 'peak_rss_mb': rss, 'output_bytes': size, 'error': error, 'skipped': None}
+
+        baseline = {'results': [case(1, 0.001), case(10, 1.0), case(100, 1.0), case(1000, 2.0), case(5, 1.0)]}
+        report = {'results': [case(1, 0.005), case(10, 1.1), case(100, 1.5, rss=200.0), case(1000, 1.0),
+                              case(5, None, error='MemoryError'), case(7, 1.0)]}
+        comparison = benchmarks.compare(report, baseline, tolerance=0.2)
+
+        flagged = {(r['case'], r['metric']) for r in comparison['regressions']}
+        self.assertEqual(flagged, {('synth/final/acoustic/44100/100', 'wall_seconds'),
+                                   ('synth/final/acoustic/44100/100', 'peak_rss_mb'),
+                                   ('synth/final/acoustic/44100/5', 'error')})
+        self.assertEqual([i['case'] for i in comparison['improvements']], ['synth/final/acoustic/44100/1000'])
+        self.assertEqual(comparison['new_cases'], ['synth/final/acoustic/44100/7'])
+
+
+class CompositionTests(SimpleTestCase):
+    def test_client_shapes_build_the_same_composition(self):
+        plain = composition.from_client([40, 45, 50], 0.5)
+        columns = composition.from_client({'pitch': [40, 45, 50], 'onset': [0, 0.5, 1.0]}, 0.5)
+        rows = composition.from_client([{'pitch': 40, 'onset': 0}, {'pitch': 45, 'onset': 0.5},
+                                        {'pitch': 50, 'onset': 1.0, 'duration': 0.5}], 0.5)
+        for events in (columns, rows):
+            np.testing.assert_array_equal(events, plain)
+        self.assertEqual(plain['onset'].tolist(), [0.0, 0.5, 1.0])
+        self.assertEqual(plain['velocity'].tolist(), [100, 100, 100])
+        self.assertEqual(plain['string'].tolist(), [-1, -1, -1])
+
+    def test_chords_legato_and_dynamics(self):
+        events = composition.from_client({'pitch': [40, 47, 52, 55], 'onset': [0, 0, 0, 1.0],
+                                          'duration': [2.0, 1.5, 1.0, 1.0], 'velocity': [90, 70, 60, 127],
+                                          'string': [6, 5, 4, 3]})
+        self.assertEqual(composition.end_time(events), 2.0)
+        samples, is_on, pitch, velocity, _ = composition.schedule(events, 10)
+        # At t=1.0 the chord's top note stops before the next note starts
+        at_one = [(bool(o), p) for s, o, p in zip(samples, is_on, pitch) if s == 10]
+        self.assertEqual(at_one, [(False, 52), (True, 55)])
+
+    def test_invalid_compositions(self):
+        for notes in ([40, 200], {'pitch': [40, 45], 'onset': [0]}, {'pitch': [40], 'velocity': 0},
+                      {'pitch': [40], 'onset': [-1]}, {'pitch': [40], 'bend': [1]}, [{'onset': 0}]):
+            with self.assertRaises(ValueError):
+                composition.from_client(notes)
+        with self.assertRaises(ValueError):
+            composition.from_client([40, 45], [0.5])
+
+    def test_cache_key_ignores_entry_order_but_not_content(self):
+        a = render_cache.normalize_events({'pitch': [52, 40], 'onset': [0, 0]})
+        b = render_cache.normalize_events({'pitch': [40, 52], 'onset': [0, 0]})
+        c = render_cache.normalize_events({'pitch': [40, 52], 'onset': [0, 0], 'velocity': [100, 99]})
+        self.assertEqual(render_cache.render_key('acoustic', a), render_cache.render_key('acoustic', b))
+        self.assertNotEqual(render_cache.render_key('acoustic', a), render_cache.render_key('acoustic', c))
+
+    def test_large_sequence_is_built_column_wise(self):
+        notes = np.arange(100000) % 48 + 40
+        start = time.perf_counter()
+        events = render_cache.normalize_events(notes, 0.125)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(events), 100000)
+        self.assertEqual(events['onset'][-1], 99999 * 0.125)
+        self.assertLess(elapsed, 1.0)
+
+    def test_render_events_matches_pretty_midi(self):
+        import pretty_midi
+        import pretty_midi.fluidsynth as pm_fluidsynth
+
+        events = composition.sort(composition.from_client({
+            'pitch': [40, 47, 52, 45, 57, 40], 'onset': [0, 0, 0.3, 0.5, 0.5, 1.25],
+            'duration': [1.0, 0.5, 0.45, 0.75, 0.2, 0.5], 'velocity': [100, 80, 64, 127, 90, 100]}))
+        midi = pretty_midi.PrettyMIDI()
+        guitar = pretty_midi.Instrument(program=25)
+        guitar.notes = [pretty_midi.Note(velocity=int(e['velocity']), pitch=int(e['pitch']),
+                                         start=float(e['onset']), end=float(e['onset'] + e['duration']))
+                        for e in events]
+        midi.instruments.append(guitar)
+
+        synth = PooledSynth.__new__(PooledSynth)
+        synth.sample_rate, synth.sfid = 8000, 1
+        with mock.patch.object(pm_fluidsynth, '_HAS_FLUIDSYNTH', True), \
+                mock.patch.object(pm_fluidsynth, 'fluidsynth', mock.Mock(Synth=StatefulFluidSynth), create=True):
+            synth.synth = StatefulFluidSynth(8000)
+            expected = synth.render(midi)
+            synth.synth = StatefulFluidSynth(8000)
+            actual = synth.render_events(events)
+        np.testing.assert_array_equal(actual, expected)
+
+
+class QualityTierTests(MediaRootMixin, TestCase):
+    def make_synth(self, sample_rate):
+        synth = PooledSynth.__new__(PooledSynth)
+        synth.sample_rate, synth.sfid = sample_rate, 1
+        synth.synth = StatefulFluidSynth(sample_rate)
+        return synth
+
+    def test_final_tier_is_unchanged(self):
+        import soundfile as sf
+
+        events = render_cache.normalize_events([40, 45, 50], 0.5)
+        self.assertEqual(render_cache.render_key('acoustic', events, 44100, 'wav', quality='final'),
+                         render_cache.render_key('acoustic', events, 44100, 'wav'))
+        self.pool.factory = lambda sf2_path, sample_rate: self.make_synth(sample_rate)
+        url = audio_utils.create_guitar_music('acoustic', [40, 45, 50], 0.5, quality='final')
+        path = os.path.join(self.media_root, 'generated', os.path.basename(url))
+
+        reference = os.path.join(self.media_root, 'reference.wav')
+        sf.write(reference, self.make_synth(44100).render_events(events), 44100)
+        with open(path, 'rb') as a, open(reference, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_preview_is_a_separate_smaller_render(self):
+        import soundfile as sf
+
+        self.pool.factory = lambda sf2_path, sample_rate: self.make_synth(sample_rate)
+        final = audio_utils.create_guitar_music('bass', [28, 33, 38, 43], 0.25)
+        preview = audio_utils.create_guitar_music('bass', [28, 33, 38, 43], 0.25, quality='preview')
+        self.assertTrue(os.path.basename(preview).startswith('preview-'))
+        final_path = os.path.join(self.media_root, 'generated', os.path.basename(final))
+        preview_path = os.path.join(self.media_root, 'generated', os.path.basename(preview))
+
+        info = sf.info(preview_path)
+        self.assertEqual((info.samplerate, info.channels, info.subtype), (22050, 1, 'PCM_16'))
+        self.assertAlmostEqual(info.duration, 1.25, places=3)  # 1 s of notes + 0.25 s tail
+        self.assertGreater(os.path.getsize(final_path) / os.path.getsize(preview_path), 3)
+        self.assertEqual(render_cache.stats()['files'], 2)
+        with self.assertRaises(ValueError):
+            audio_utils.create_guitar_music('bass', [28], 0.25, quality='draft')
+
+    def test_int16_render_is_normalized_to_full_scale(self):
+        events = render_cache.normalize_events([40, 47], 0.5)
+        pcm = self.make_synth(22050).render_events(events, tail=0.25, dtype='int16')
+        self.assertEqual(pcm.dtype, np.int16)
+        self.assertEqual(np.abs(pcm.astype(np.int32)).max(), 32767)
+        self.assertEqual(len(pcm), int(np.ceil(22050 * 1.25)))
+
+    def test_stream_view_preview(self):
+        user = User.objects.create_user('auditioner', 'auditioner@example.com', 'pw123456')
+        self.client.force_login(user)
+        url = reverse('player:guitar_stream', args=['acoustic'])
+        response = self.client.get(url, {'notes': '40,45', 'duration': '0.5', 'quality': 'preview'})
+        chunks = list(response.streaming_content)
+        self.assertEqual(int.from_bytes(chunks[0][24:28], 'little'), 22050)
+        self.assertEqual(sum(len(c) for c in chunks[1:]), int(1.25 * 22050) * 2)
+        self.assertEqual(self.client.get(url, {'notes': '40', 'quality': 'draft'}).status_code, 400)
+
+
+class HeldNotesSynth(StatefulFluidSynth):
+    """Output depends only on which notes are held, so a render can be cut anywhere and resumed."""
+    frames = 0
+
+    def get_samples(self, frames):
+        HeldNotesSynth.frames += frames
+        level = sum(p * v for p, v in self.active.items()) % 3000
+        return np.full(frames * 2, level, dtype=np.int16)
+
+
+class HeldNotesMixin(MediaRootMixin):
+    """Render on real PooledSynths driving a HeldNotesSynth."""
+
+    def setUp(self):
+        super().setUp()
+        HeldNotesSynth.frames = 0
+        self.pool.factory = self.make_synth
+
+    def make_synth(self, sf2_path=None, sample_rate=1000):
+        synth = PooledSynth.__new__(PooledSynth)
+        synth.sample_rate, synth.sfid = sample_rate, 1
+        synth.synth = HeldNotesSynth(sample_rate)
+        return synth
+
+    def read(self, url):
+        import soundfile as sf
+        return sf.read(os.path.join(self.media_root, 'generated', os.path.basename(url)), dtype='int16')[0]
+
+
+class IncrementalRenderTests(HeldNotesMixin, TestCase):
+    def song(self, edit=None):
+        rng = np.random.default_rng(7)
+        notes = {'pitch': rng.integers(40, 80, 400).tolist(), 'onset': np.round(np.arange(400) * 0.45, 3).tolist(),
+                 'duration': 0.5, 'velocity': rng.integers(60, 120, 400).tolist()}
+        if edit is not None:
+            notes['pitch'][edit] += 1
+        return notes
+
+    def test_edit_resynthesizes_only_the_affected_window(self):
+        original = audio_utils.create_guitar_music('acoustic', self.song(), sample_rate=1000)
+        full_frames, HeldNotesSynth.frames = HeldNotesSynth.frames, 0
+
+        edited = audio_utils.create_guitar_music('acoustic', self.song(edit=200), sample_rate=1000, base=original)
+        self.assertLess(HeldNotesSynth.frames, full_frames / 20)  # ~4 s of a 3-minute song
+
+        reference = self.make_synth().render_events(render_cache.normalize_events(self.song(edit=200)))
+        spliced = self.read(edited) / 32767
+        self.assertEqual(len(spliced), len(reference))
+        np.testing.assert_allclose(spliced, reference, atol=3 / 32767)
+        self.assertFalse(np.array_equal(self.read(original), self.read(edited)))
+
+    def test_edits_chain_and_change_song_length(self):
+        first = audio_utils.create_guitar_music('acoustic', [40, 45, 50], 0.5, sample_rate=1000)
+        second = audio_utils.create_guitar_music('acoustic', [40, 45, 50, 55], 0.5, sample_rate=1000, base=first)
+        third = audio_utils.create_guitar_music('acoustic', [40, 45], 0.5, sample_rate=1000, base=second)
+        for notes, url in (([40, 45, 50, 55], second), ([40, 45], third)):
+            reference = self.make_synth().render_events(render_cache.normalize_events(notes, 0.5))
+            np.testing.assert_allclose(self.read(url) / 32767, reference, atol=3 / 32767)
+
+    def test_unusable_base_falls_back_to_full_render(self):
+        original = audio_utils.create_guitar_music('acoustic', [40, 45, 50], 0.5, sample_rate=1000)
+        for base in ('/media/generated/../../etc/passwd', '/media/generated/' + 'a' * 32 + '.wav', original):
+            HeldNotesSynth.frames = 0
+            audio_utils.create_guitar_music('bass', [40, 45, 50, 52], 0.5, sample_rate=1000, base=base)
+            self.assertEqual(HeldNotesSynth.frames, 3000)  # 2 s of notes + 1 s tail, from scratch
+            render_cache.evict(max_bytes=0, keep=render_cache.cache_path(render_cache.key_from_url(original)[0]))
+
+    def test_window_covers_onset_to_release_tail(self):
+        old = render_cache.normalize_events([40, 45, 50, 55], 0.5)
+        new = render_cache.normalize_events([40, 45, 52, 55], 0.5)
+        self.assertEqual(incremental.affected_window(old, new, tail=1.0), (1.0, 2.5))
+        self.assertIsNone(incremental.affected_window(old, old.copy(), tail=1.0))
+
+
+@override_settings(RENDER_SEGMENT_MIN_SECONDS=30)
+class SegmentedRenderTests(HeldNotesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Workers fork from this process, so they see the patched pool
+        segmented._reset_executor()
+        self.addCleanup(segmented._reset_executor)
+
+    def song(self):
+        rng = np.random.default_rng(11)
+        return render_cache.normalize_events({
+            'pitch': rng.integers(40, 80, 400).tolist(), 'onset': np.round(np.arange(400) * 0.45, 3).tolist(),
+            'duration': rng.choice([0.3, 0.5, 2.0], 400).tolist(), 'velocity': rng.integers(60, 120, 400).tolist()})
+
+    def test_segments_stitch_to_the_single_pass_render(self):
+        events = self.song()
+        single = self.make_synth().render_events(events, normalize=False)
+        stitched = segmented.render('acoustic', events, 1000, workers=4)
+        self.assertEqual(len(segmented.split_points(events, 1000, 4)), 3)
+        self.assertEqual(len(stitched), len(single))
+        np.testing.assert_allclose(stitched, single, atol=1e-6)
+
+        with override_settings(RENDER_SEGMENT_WORKERS=4):
+            url = audio_utils.create_guitar_music('acoustic', events, sample_rate=1000)
+        reference = self.make_synth().render_events(events)
+        np.testing.assert_allclose(self.read(url) / 32767, reference, atol=1 / 32767)
+
+    def test_segmented_render_inside_a_render_worker(self):
+        events = self.song()
+        with override_settings(RENDER_SEGMENT_WORKERS=2):
+            pool = sandbox.WorkerPool(1, timeout=0, memory_limit=0, cpu_limit=0)
+            self.addCleanup(pool.shutdown)
+            stitched = pool.submit(segmented.render, 'acoustic', events, 1000).result(30)
+            helpers = pool.submit(_child_pids).result(10)
+        self.assertEqual(len(helpers), 2)  # the segment processes, started by the worker
+        single = self.make_synth().render_events(events, normalize=False)
+        np.testing.assert_allclose(stitched, single, atol=1e-6)
+
+        pool.shutdown()
+        for pid in helpers:
+            self.assertFalse(_running(pid))
+
+    def test_cuts_go_where_fewest_notes_ring(self):
+        onsets = np.r_[np.arange(0, 54, 0.5), np.arange(58, 120, 0.5)]
+        events = composition.from_columns(np.full(len(onsets), 48), onset=onsets, duration=3.0)
+        self.assertEqual(segmented.split_points(events, 1000, 2), [58000])  # after the only silence
+
+    def test_short_compositions_render_in_one_pass(self):
+        events = render_cache.normalize_events([40, 45, 50])
+        self.assertIsNone(segmented.render('acoustic', events, 1000, workers=4))
+        self.assertIsNone(segmented.render('acoustic', self.song(), 1000, workers=1))
+
+
+class WaveformPeaksTests(MediaRootMixin, TestCase):
+    def test_peaks_match_a_direct_reduction_whatever_the_block_size(self):
+        audio = np.sin(np.arange(44100 * 2 + 123) / 40.0) * np.linspace(0, 1, 44100 * 2 + 123)
+        builder = peaks.PeakBuilder(44100)
+        for block in np.array_split(audio, [1, 1000, 1001, 70000]):
+            builder.feed(block)
+        sample_rate, levels = peaks.parse(builder.finish())
+
+        self.assertEqual(sample_rate, 44100)
+        self.assertEqual(sorted(levels), list(peaks.PIXELS_PER_SECOND))
+        spp, pairs = levels[150]
+        self.assertEqual((spp, len(pairs)), (294, int(np.ceil(len(audio) / 294))))
+        padded = np.pad(audio, (0, len(pairs) * spp - len(audio)), constant_values=np.nan)
+        expected_max = np.round(np.nanmax(padded.reshape(-1, spp), axis=1) * 127)
+        np.testing.assert_array_equal(pairs[:, 1], expected_max)
+        self.assertTrue(np.all(pairs[:, 0] <= pairs[:, 1]))
+        with self.assertRaises(ValueError):
+            peaks.parse(b'RIFF....')
+
+    def test_every_cached_render_serves_its_peaks(self):
+        url = audio_utils.create_guitar_music('acoustic', [40, 45, 50], duration=0.5, quality='preview')
+        peaks_url = peaks.peaks_url(url)
+        response = self.client.get(peaks_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        sample_rate, levels = peaks.parse(response.content)
+        self.assertEqual(sample_rate, 22050)
+        self.assertEqual(len(levels[10][1]), 8)  # 0.75 s of FakeSynth audio at 10 px/s, last pixel partial
+        self.assertEqual(self.client.get(peaks_url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        render_cache.evict(max_bytes=0)
+        self.assertEqual(self.client.get(peaks_url).status_code, 404)
+        self.assertEqual(self.client.get(reverse('player:render_peaks', args=['passwd'])).status_code, 404)
+
+
+class GeneratedMediaServingTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = audio_utils.create_guitar_music('acoustic', [40, 45, 50], duration=0.5)
+        with open(os.path.join(self.media_root, 'generated', os.path.basename(self.url)), 'rb') as f:
+            self.data = f.read()
+
+    def get(self, url=None, **headers):
+        response = self.client.get(url or self.url, **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_render_urls_are_served_with_immutable_validators(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(response['ETag'], f'"{render_cache.key_from_url(self.url)[0]}"')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual((response['Content-Type'], response['Accept-Ranges']), ('audio/wav', 'bytes'))
+
+        response, body = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, body), (304, b''))
+
+    def test_byte_ranges(self):
+        size = len(self.data)
+        for header, expected in (('bytes=10-19', (10, 19)), ('bytes=100-', (100, size - 1)),
+                                 ('bytes=-5', (size - 5, size - 1)), ('bytes=0-999999', (0, size - 1))):
+            response, body = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(body, self.data[expected[0]:expected[1] + 1])
+            self.assertEqual(response['Content-Range'], f'bytes {expected[0]}-{expected[1]}/{size}')
+            self.assertEqual(int(response['Content-Length']), len(body))
+
+        response, _ = self.get(HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, f'bytes */{size}'))
+        response, body = self.get(HTTP_RANGE='bytes=0-1,5-9')  # several ranges: whole file
+        self.assertEqual((response.status_code, body), (200, self.data))
+        response, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((response.status_code, body), (200, self.data))
+
+    def test_accel_redirect_and_other_files(self):
+        with override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/'):
+            response, body = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/generated/{os.path.basename(self.url)}')
+        self.assertEqual(body, b'')
+
+        custom = audio_utils.create_guitar_music('bass', [40], duration=0.5, filename='lesson-1.wav')
+        response, body = self.get(custom)
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        key, fmt = render_cache.key_from_url(self.url)
+        for missing in (f'/media/generated/.{key}.{fmt}.peaks', '/media/generated/nothing.wav'):
+            self.assertEqual(self.get(missing)[0].status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+
+@override_settings(RENDER_JOB_BACKEND='inline', METRICS_TOKEN='scrape-me')
+class RenderMetricsTests(MediaRootMixin, TestCase):
+    def series(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return dict(line.rsplit(' ', 1) for line in response.content.decode().splitlines()
+                    if not line.startswith('#'))
+
+    def test_counters_and_stage_histograms_by_guitar_type(self):
+        audio_utils.create_guitar_music('acoustic', [40, 45], duration=0.5)
+        audio_utils.create_guitar_music('acoustic', [40, 45], duration=0.5)
+        with mock.patch.object(FakeSynth, 'render_events', side_effect=RuntimeError('synth crashed')):
+            with self.assertRaises(RuntimeError):
+                audio_utils.create_guitar_music('bass', [40], duration=0.5)
+
+        series = self.series()
+        self.assertEqual(series['musicflow_renders_total{guitar_type="acoustic"}'], '1')
+        self.assertEqual(series['musicflow_cache_hits_total{guitar_type="acoustic"}'], '1')
+        self.assertEqual(series['musicflow_failures_total{guitar_type="bass"}'], '1')
+        self.assertEqual(series['musicflow_failures_total{guitar_type="acoustic"}'], '0')
+        for stage in metrics.STAGES:
+            labels = f'guitar_type="acoustic",stage="{stage}"'
+            self.assertEqual(series[f'musicflow_render_stage_seconds_count{{{labels}}}'],
+                             series[f'musicflow_render_stage_seconds_bucket{{{labels},le="+Inf"}}'])
+        self.assertEqual(series['musicflow_render_stage_seconds_count{guitar_type="acoustic",stage="encode"}'], '1')
+        self.assertEqual(series['musicflow_render_stage_seconds_count{guitar_type="acoustic",stage="prepare"}'], '2')
+
+    def test_a_render_writes_its_counts_once(self):
+        with mock.patch.object(counters, 'incr_many', wraps=counters.incr_many) as writes:
+            audio_utils.create_guitar_music('acoustic', [40, 45], duration=0.5)
+        self.assertEqual(writes.call_count, 1)
+        counted = writes.call_args.args[0]
+        self.assertEqual(counted[metrics._key('renders', 'acoustic')], 1)
+        self.assertEqual(counted['render_cache_misses'], 1)
+        self.assertEqual(counters.get(metrics._key('renders', 'acoustic')), 1)
+
+    def test_counters_are_shared_with_other_processes(self):
+        context = multiprocessing.get_context('fork')
+        child = context.Process(target=metrics.count, args=('renders', 'acoustic', 3))
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+        metrics.count('renders', 'acoustic')
+        self.assertEqual(self.series()['musicflow_renders_total{guitar_type="acoustic"}'], '4')
+
+    def test_server_timing_header_and_access(self):
+        user = User.objects.create_user('timer', 'timer@example.com', 'pw123456')
+        self.client.force_login(user)
+        response = self.client.post(reverse('player:render_job_submit'),
+                                    {'guitar_type': 'electric', 'notes': '52,55', 'duration': '0.5'})
+        self.assertEqual(response.status_code, 202)
+        stages = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, list(metrics.STAGES))
+        self.assertNotIn('Server-Timing', self.client.get(reverse('player:index')))
+
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer nope').status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+
+class GeneratedFilesTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw123456')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw123456')
+
+    def path(self, url):
+        return os.path.join(self.media_root, 'generated', os.path.basename(url))
+
+    def test_quotas_then_budget_from_the_index_alone(self):
+        alice = [audio_utils.create_guitar_music('acoustic', [40 + i], duration=0.5, owner=self.alice)
+                 for i in range(3)]
+        bob = audio_utils.create_guitar_music('bass', [40], duration=0.5, owner=self.bob)
+        custom = audio_utils.create_guitar_music('bass', [41], duration=0.5, filename='mine.wav', owner=self.bob)
+        audio_utils.create_guitar_music('acoustic', [40], duration=0.5, owner=self.bob)  # hit: still alice's
+        size = os.path.getsize(self.path(bob))
+        self.assertEqual(GeneratedFile.objects.get(name='mine.wav').owner, self.bob)
+
+        with mock.patch('os.scandir', side_effect=AssertionError('sweep listed the directory')):
+            report = generated_files.sweep(max_bytes=size * 10, user_quota=size * 2, dry_run=True)
+            self.assertEqual((report['users_over_quota'], report['quota_files']), (1, 1))
+            self.assertTrue(os.path.exists(self.path(alice[1])))
+
+            report = generated_files.sweep(max_bytes=size * 3, user_quota=size * 2)
+        # alice's least recently used render goes for her quota, then the least recently used file overall
+        self.assertEqual((report['quota_files'], report['budget_files'], report['files']), (1, 1, 3))
+        self.assertFalse(os.path.exists(self.path(alice[1])))
+        self.assertFalse(os.path.exists(self.path(alice[2])))
+        for url in (alice[0], bob, custom):
+            self.assertTrue(os.path.exists(self.path(url)))
+        self.assertEqual(render_cache.stats()['files'], 3)
+
+    def test_reindex_and_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        kept = audio_utils.create_guitar_music('acoustic', [40], duration=0.5)
+        gone = audio_utils.create_guitar_music('acoustic', [41], duration=0.5)
+        os.remove(self.path(gone))
+        with open(os.path.join(self.media_root, 'generated', 'legacy.wav'), 'wb') as f:
+            f.write(b'x' * 100)
+        self.assertEqual(generated_files.rebuild_index(), (1, 1))
+        self.assertEqual(set(GeneratedFile.objects.values_list('name', flat=True)),
+                         {os.path.basename(kept), 'legacy.wav'})
+
+        out = StringIO()
+        call_command('sweep_generated', '--max-bytes', '0', '--dry-run', stdout=out, stderr=StringIO())
+        self.assertEqual(json.loads(out.getvalue())['budget_files'], 2)
+        self.assertTrue(os.path.exists(self.path(kept)))
+
+
+def _try_render_lock(key, queue):
+    with render_cache.render_lock(key, 'wav', timeout=0.2) as held:
+        queue.put(held)
+
+
+class SingleFlightRenderTests(MediaRootMixin, TestCase):
+    def test_concurrent_identical_requests_synthesize_once(self):
+        render_events = FakeSynth.render_events
+
+        def slow_render(synth, *args, **kwargs):
+            time.sleep(0.2)
+            return render_events(synth, *args, **kwargs)
+
+        urls = []
+        def request():
+            urls.append(audio_utils.create_guitar_music('acoustic', [40, 45, 50], duration=0.5))
+
+        with mock.patch.object(FakeSynth, 'render_events', slow_render):
+            threads = [threading.Thread(target=request) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(urls), 8)
+        self.assertEqual(len(set(urls)), 1)
+        self.assertEqual(FakeSynth.renders, 1)
+        self.assertEqual(render_cache._inflight, {})
+        series = metrics.export(['acoustic'])
+        self.assertIn('musicflow_renders_total{guitar_type="acoustic"} 1', series)
+        self.assertIn('musicflow_coalesced_total{guitar_type="acoustic"} 7', series)
+
+    def test_lock_file_excludes_other_processes(self):
+        if render_cache.fcntl is None:
+            self.skipTest('no flock() on this platform')
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        with render_cache.render_lock('ab' * 16) as held:
+            self.assertTrue(held)
+            child = context.Process(target=_try_render_lock, args=('ab' * 16, queue))
+            child.start()
+            child.join(10)
+            self.assertFalse(queue.get(timeout=5))  # timed out: the parent holds it
+        child = context.Process(target=_try_render_lock, args=('ab' * 16, queue))
+        child.start()
+        child.join(10)
+        self.assertTrue(queue.get(timeout=5))
+
+
+class PrewarmTests(MediaRootMixin, TestCase):
+    def test_catalog_covers_every_guitar_on_its_own_tuning(self):
+        items = prewarm.catalog()
+        self.assertEqual(len({item.name for item in items}), len(items))
+        self.assertEqual({item.guitar_type for item in items}, set(audio_utils.SOUNDFONT_FILES))
+        for item in items:
+            events = composition.from_client(item.notes, item.duration)
+            self.assertGreaterEqual(events['pitch'].min(), prewarm.TUNINGS[prewarm.GUITAR_TUNINGS[item.guitar_type]][0])
+        names = {item.name for item in items}
+        for name in ('bass/scale/E-major', 'bass/chord/A8-A0', 'bass/exercise/spider', 'electric/chord/F-E1',
+                     'electric/chord/Bbm-A1', 'classical/chord/G7-open', 'acoustic/arpeggio/C-dominant-7'):
+            self.assertIn(name, names)
+        self.assertFalse(any(name.startswith('bass/chord/') and name.endswith('-open') for name in names))
+        f_barre = next(item for item in items if item.name == 'acoustic/chord/F-E1')
+        self.assertEqual(f_barre.notes['pitch'], [41, 48, 53, 57, 60, 65])
+
+    def test_resumable_run_then_production_report(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        progress_path = os.path.join(self.media_root, 'progress.json')
+        items = prewarm.catalog(['bass'])[:6]
+        first = prewarm.prewarm(items[:4], workers=1, progress_path=progress_path)
+        self.assertEqual((first['rendered'], first['skipped'], first['failed']), (4, 0, 0))
+        self.assertEqual(FakeSynth.renders, 4)
+
+        # A rerun only renders what the interrupted one didn't get to
+        out = StringIO()
+        call_command('prewarm_renders', '--guitar', 'bass', '--workers', '1', '--progress', progress_path,
+                     stdout=out, stderr=StringIO())
+        self.assertIn(f"{len(prewarm.catalog(['bass'])) - 4} rendered, 4 already done, 0 failed", out.getvalue())
+        renders = FakeSynth.renders
+        again = prewarm.prewarm(items, workers=1, progress_path=progress_path)
+        self.assertEqual((again['rendered'], again['skipped']), (0, 6))
+        self.assertEqual(FakeSynth.renders, renders)
+
+        # Production traffic after the run: one warmed render is requested, one uncached one
+        audio_utils.create_guitar_music('bass', items[0].notes, items[0].duration)
+        audio_utils.create_guitar_music('bass', [30, 31], duration=0.25)
+        self.assertEqual(FakeSynth.renders, renders + 1)
+        # ...and a lookup that misses on another worker process
+        child = multiprocessing.get_context('fork').Process(target=render_cache.lookup, args=('0' * 32,))
+        child.start()
+        child.join()
+        report = prewarm.report(progress_path)
+        self.assertEqual((report['warmed_served'], report['warmed_evicted']), (1, 0))
+        self.assertEqual((report['hits'], report['misses'], report['hit_rate']), (1, 2, 0.3333))
+        self.assertEqual(report['warmed'], len(prewarm.catalog(['bass'])))
+
+        counters.reset()  # e.g. a new host: the run's baseline no longer applies
+        report = prewarm.report(progress_path)
+        self.assertEqual((report['hits'], report['misses'], report['hit_rate']), (None, None, None))
+
+
+def _child_pids():
+    return [child.pid for child in multiprocessing.active_children()]
+
+
+def _running(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'  # a zombie has exited
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+
+def _started_at(_):
+    return time.monotonic()
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _allocate(size):
+    return len(np.ones(size, dtype=np.uint8))
+
+
+def _spin():
+    while True:
+        pass
+
+
+class SandboxTests(SimpleTestCase):
+    def pool(self, **limits):
+        pool = sandbox.WorkerPool(1, **{'timeout': 0, 'memory_limit': 0, 'cpu_limit': 0, **limits})
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_cheap_jobs_run_before_expensive_ones(self):
+        pool = self.pool()
+        pool.submit(_sleep, 0.3)
+        expensive = pool.submit(_started_at, 'a', priority=sandbox.LOW)
+        cheap = pool.submit(_started_at, 'b')
+        self.assertLess(cheap.result(10), expensive.result(10))
+
+    def test_stuck_and_dead_workers_are_replaced(self):
+        pool = self.pool(timeout=0.5)
+        started = time.monotonic()
+        with self.assertRaises(sandbox.RenderTimeout):
+            pool.submit(_sleep, 30).result(10)
+        self.assertLess(time.monotonic() - started, 5)
+        with self.assertRaises(sandbox.WorkerLost):
+            pool.submit(os._exit, 3).result(10)
+        self.assertEqual(pool.submit(_sleep, 0).result(10), 0)
+        self.assertEqual(pool.replaced, 2)
+
+    def test_memory_and_cpu_limits(self):
+        if sandbox.resource is None:
+            self.skipTest('no rlimits on this platform')
+        with open('/proc/self/statm') as f:
+            mapped = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        pool = self.pool(memory_limit=mapped + 256 * 1024 * 1024)
+        with self.assertRaises(MemoryError):
+            pool.submit(_allocate, 2 * 1024 * 1024 * 1024).result(10)
+        self.assertEqual(pool.submit(_allocate, 1024).result(10), 1024)  # the worker survives
+
+        pool = self.pool(cpu_limit=1)
+        with self.assertRaises(sandbox.WorkerLost):
+            pool.submit(_spin).result(10)
+
+    def test_cost_estimate(self):
+        events = composition.sequence([40, 45, 50, 55], duration=1.0)
+        self.assertEqual(sandbox.estimate_cost(events), 4 * 5.0)
+        self.assertEqual(sandbox.estimate_cost(events, 'preview'), 4 * 4.25 / 2)
+        with override_settings(RENDER_COST_MAX=100, RENDER_COST_LOW_PRIORITY=10):
+            self.assertEqual(sandbox.admit(events), (20.0, sandbox.LOW))
+            with self.assertRaises(sandbox.TooExpensive):
+                sandbox.admit(composition.sequence([40] * 30, duration=1.0))
+
+
+@override_settings(RENDER_JOB_BACKEND='inline', RENDER_QUOTA_TIERS={
+    'default': {'capacity': 60, 'refill_per_hour': 360}, 'pro': {'capacity': 600, 'refill_per_hour': 3600},
+    'staff': None})
+class RenderQuotaTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('metered', 'metered@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def test_tiers(self):
+        from django.contrib.auth.models import Group
+
+        self.assertEqual(render_quota.tier_for(self.user)[0], 'default')
+        self.user.groups.add(Group.objects.create(name='pro'))
+        self.assertEqual(render_quota.tier_for(self.user), ('pro', {'capacity': 600, 'refill_per_hour': 3600}))
+        self.user.is_staff = True
+        self.assertTrue(render_quota.status(self.user)['unlimited'])
+        render_quota.charge(self.user, 1000)
+        self.assertFalse(RenderQuota.objects.exists())
+
+    def test_renders_are_charged_their_cpu_time_and_refused_when_in_debt(self):
+        response = self.client.post(reverse('player:render_job_submit'),
+                                    {'guitar_type': 'bass', 'notes': '40,45', 'duration': '0.5'})
+        self.assertEqual(response.status_code, 202)
+        self.assertLess(RenderQuota.objects.get(user=self.user).tokens, 60)
+        b''.join(self.client.get(reverse('player:guitar_stream', args=['bass']), {'notes': '40'}).streaming_content)
+        self.assertLess(RenderQuota.objects.get(user=self.user).tokens, 60)
+
+        render_quota.charge(self.user, 100)  # 40 CPU-seconds into debt, refilling at 0.1/s
+        response = self.client.post(reverse('player:render_job_submit'),
+                                    {'guitar_type': 'bass', 'notes': '40,47', 'duration': '0.5'})
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(400 <= int(response['Retry-After']) <= 401)
+        self.assertEqual(response.json()['budget']['used_percent'], 100)
+        self.assertEqual(self.client.get(reverse('player:guitar_stream', args=['bass']),
+                                         {'notes': '40'}).status_code, 429)
+        self.assertEqual(RenderJob.objects.count(), 1)
+
+        # The bucket refills with time, up to its capacity
+        RenderQuota.objects.filter(user=self.user).update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(render_quota.status(self.user)['available'], 60)
+        self.assertEqual(self.client.post(reverse('player:render_job_submit'),
+                                          {'guitar_type': 'bass', 'notes': '40,47', 'duration': '0.5'}
+                                          ).status_code, 202)
+
+    def test_meter_counts_cpu_reported_by_segment_workers(self):
+        with render_quota.meter() as used:
+            render_quota.add_cpu(2.5)
+        self.assertGreaterEqual(used['seconds'], 2.5)
+        render_quota.add_cpu(1.0)  # no meter running: ignored
+
+    def submit(self, notes='40,45', user=None):
+        if user is not None:
+            self.client.force_login(user)
+        return self.client.post(reverse('player:render_job_submit'),
+                                {'guitar_type': 'bass', 'notes': notes, 'duration': '0.5'})
+
+    @override_settings(RENDER_JOB_BACKEND='process', RENDER_QUOTA_SECONDS_PER_COST=0.01, RENDER_USER_ACTIVE_MAX=10)
+    def test_queued_jobs_reserve_their_estimated_cost(self):
+        long_song = ','.join(['40'] * 100)  # 100 x (50 s + 1 s tail) = 5100 note-seconds: 51 CPU-seconds held
+        with mock.patch.object(render_jobs, '_get_executor', return_value=mock.Mock()):
+            self.assertEqual(self.submit(long_song).status_code, 202)
+            self.assertEqual(self.submit(long_song).status_code, 202)  # 60 - 51 still positive
+            response = self.submit(long_song)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['budget']['available'], 60)  # nothing charged, only reserved
+        self.assertEqual(list(RenderJob.objects.values_list('reserved_seconds', flat=True)), [51.0, 51.0])
+
+        RenderJob.objects.update(status=RenderJob.DONE)  # finished jobs hold nothing
+        with mock.patch.object(render_jobs, '_get_executor', return_value=mock.Mock()):
+            self.assertEqual(self.submit(long_song).status_code, 202)
+
+    @override_settings(RENDER_JOB_BACKEND='process', RENDER_USER_ACTIVE_MAX=2)
+    def test_active_jobs_are_capped_per_user(self):
+        with mock.patch.object(render_jobs, '_get_executor', return_value=mock.Mock()):
+            self.assertEqual(self.submit().status_code, 202)
+            self.assertEqual(self.submit().status_code, 202)
+            response = self.submit()
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('too many renders', response.json()['error'])
+            other = User.objects.create_user('other', 'other@example.com', 'pw123456')
+            self.assertEqual(self.submit(user=other).status_code, 202)
+        self.assertEqual(RenderJob.objects.filter(user=self.user).count(), 2)
+
+    @override_settings(RENDER_TIMEOUT=30, RENDER_CPU_LIMIT=20)
+    def test_killed_jobs_are_charged_their_limit(self):
+        def finish(error, ran):
+            job = RenderJob.objects.create(user=self.user, guitar_type='bass', notes=[40], duration=1.0,
+                                           status=RenderJob.RUNNING, started_at=timezone.now() - ran)
+            future = Future()
+            future.set_exception(error)
+            render_jobs._job_finished(job.pk, future)
+            job.refresh_from_db()
+            self.assertEqual(job.status, RenderJob.FAILED)
+            return render_quota.status(self.user)['available']
+
+        self.assertAlmostEqual(finish(sandbox.RenderTimeout('too slow'), timedelta(minutes=5)), 30, delta=0.1)
+        self.assertAlmostEqual(finish(sandbox.WorkerLost('over its CPU limit'), timedelta(minutes=5)), 10, delta=0.1)
+        self.assertAlmostEqual(finish(sandbox.WorkerLost('pool shut down'), timedelta(seconds=4)), 6, delta=0.1)
+
+    def test_dashboard_shows_budget(self):
+        render_quota.charge(self.user, 15)
+        response = self.client.get(reverse('player:guitar_index'))
+        self.assertContains(response, 'Render Budget')
+        self.assertContains(response, 'of 60 CPU-seconds')
+        self.assertEqual(response.context['render_budget']['used_percent'], 25)
+
+
+class UserContextTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('player', 'player@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def test_guitar_pages_load_the_user_context_once(self):
+        # The session comes from the cache and isn't written back unchanged: only the user is read
+        for name in ('guitar_acoustic', 'guitar_electric', 'guitar_classical', 'guitar_bass', 'guitar_feature_info'):
+            with self.assertNumQueries(1):
+                self.assertEqual(self.client.get(reverse(f'player:{name}')).status_code, 200)
+        # The dashboard's context, render budget and tier included, is one query on top of the user, then cached
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('player:guitar_index'))
+        self.assertEqual(response.context['dashboard'].user_id, self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(reverse('player:guitar_index')), 'Render Budget')
+
+    def test_saves_invalidate_the_cached_context(self):
+        from . import user_context
+
+        context = user_context.get(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(user_context.get(self.user).profile.pk, context.profile.pk)
+
+        self.client.post(reverse('player:save_dashboard'), {'notes': 'practice barre chords'})
+        self.assertEqual(user_context.get(self.user).dashboard.notes, 'practice barre chords')
+        self.client.post(reverse('player:profile_update'), {'first_name': 'Django', 'level': 'expert'})
+        self.assertEqual(user_context.get(self.user).profile.level, 'expert')
+        self.assertContains(self.client.get(reverse('player:guitar_index')), 'practice barre chords')
+
+    @override_settings(RENDER_QUOTA_TIERS={'default': {'capacity': 60, 'refill_per_hour': 360},
+                                          'pro': {'capacity': 600, 'refill_per_hour': 3600}})
+    def test_writes_in_other_processes_invalidate_the_cached_context(self):
+        from django.contrib.auth.models import Group
+        from . import user_context
+
+        budget = self.client.get(reverse('player:guitar_index')).context['render_budget']
+        self.assertEqual(budget['available'], 60)
+        # A render worker charges the user: the row changes without a signal here, and the version is
+        # bumped from that worker's process
+        RenderQuota.objects.bulk_create([RenderQuota(user=self.user, tokens=15, updated_at=timezone.now())])
+        child = multiprocessing.get_context('fork').Process(target=user_context.invalidate, args=(self.user.pk,))
+        child.start()
+        child.join()
+        with self.assertNumQueries(2):  # the user, then the context
+            budget = self.client.get(reverse('player:guitar_index')).context['render_budget']
+        self.assertAlmostEqual(budget['available'], 15, delta=1)
+
+        self.user.groups.add(Group.objects.create(name='pro'))
+        with self.assertNumQueries(1):  # the tier comes with the rest
+            self.assertEqual(user_context.get(self.user).quota_tier[0], 'pro')
+
+    def test_missing_rows_are_created(self):
+        from . import user_context
+
+        Profile.objects.filter(user=self.user).delete()
+        Dashboard.objects.filter(user=self.user).delete()
+        context = user_context.get(self.user)
+        self.assertEqual(context.profile.user_id, self.user.pk)
+        self.assertTrue(Dashboard.objects.filter(user=self.user).exists())
+
+
+class ProfilePictureTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('pictured', 'pictured@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def upload(self):
+        from io import BytesIO
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        data = BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(data, 'PNG')
+        response = self.client.post(reverse('player:profile_update'), {
+            'first_name': 'Pic', 'profile_picture': SimpleUploadedFile('me.png', data.getvalue(), 'image/png'),
+        }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        avatars._reset_executor()  # wait for the background variants
+        return response.json()['image_url']
+
+    def test_page_views_never_stat_storage_or_write(self):
+        from django.core.files.storage import default_storage
+
+        url = self.upload()
+        self.assertTrue(url.startswith('/media/profile_pics/'))
+        os.remove(os.path.join(self.media_root, Profile.objects.get(user=self.user).profile_picture.name))
+        from . import user_context
+        user_context.invalidate(self.user.pk)
+
+        with mock.patch.object(default_storage, 'exists', side_effect=AssertionError('stat on GET')), \
+                mock.patch.object(Profile, 'save', side_effect=AssertionError('write on GET')):
+            response = self.client.get(reverse('player:guitar_index'))
+        self.assertContains(response, url)
+        self.assertEqual(response.context['profile_picture_url'], url)
+
+    def test_index_follows_uploads_and_removals(self):
+        from . import profile_pictures
+
+        url = self.upload()
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile_pictures.url_for(profile), url)
+        self.client.post(reverse('player:profile_update'), {'first_name': 'Pic', 'remove_picture': 'true'})
+        self.assertIsNone(profile_pictures.url_for(Profile.objects.get(user=self.user)))
+
+    def test_reconcile_command_clears_missing_files(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from . import profile_pictures, user_context
+
+        self.upload()
+        other = User.objects.create_user('kept', 'kept@example.com', 'pw123456')
+        self.client.force_login(other)
+        kept_url = self.upload()
+        os.remove(os.path.join(self.media_root, Profile.objects.get(user=self.user).profile_picture.name))
+        user_context.get(self.user)
+
+        out = StringIO()
+        call_command('reconcile_profile_pictures', '--dry-run', '--batch-size', '1', stdout=out)
+        self.assertIn('2 profile pictures checked, 1 missing would be cleared', out.getvalue())
+        self.assertTrue(Profile.objects.get(user=self.user).profile_picture)
+
+        self.assertEqual(profile_pictures.reconcile(batch_size=1), (2, 1))
+        self.assertFalse(Profile.objects.get(user=self.user).profile_picture)
+        self.assertIsNone(user_context.get(self.user).profile_picture_url)
+        self.assertEqual(profile_pictures.url_for(Profile.objects.get(user=other)), kept_url)
+
+
+class AvatarTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(avatars._reset_executor)
+        self.user = User.objects.create_user('avatar', 'avatar@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def photo(self, size=(2400, 1800)):
+        """A camera-sized JPEG with EXIF orientation and GPS tags."""
+        from io import BytesIO
+        from PIL import Image
+
+        image = Image.effect_noise(size, 64).convert('RGB')
+        exif = Image.Exif()
+        exif[0x0112] = 6  # orientation: rotate 90 CW to display
+        exif[0x8825] = {1: 'N', 2: (51.0, 30.0, 0.0)}  # GPS info
+        data = BytesIO()
+        image.save(data, 'JPEG', quality=95, exif=exif)
+        return data.getvalue()
+
+    def upload(self, data, name='photo.jpg'):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post(reverse('player:profile_update'), {
+            'first_name': 'Pic', 'profile_picture': SimpleUploadedFile(name, data, 'image/jpeg'),
+        }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        avatars._reset_executor()  # wait for the background variants
+        return response
+
+    def test_upload_writes_small_exif_free_variants_under_hashed_names(self):
+        from PIL import Image
+
+        original = self.photo()
+        url = self.upload(original).json()['image_url']
+        profile = Profile.objects.get(user=self.user)
+        self.assertRegex(profile.profile_picture.name, r'^profile_pics/[0-9a-f]{20}-256\.jpg$')
+        self.assertEqual(url, f'/media/{profile.profile_picture.name}')
+
+        names = avatars.names(profile.profile_picture.name)
+        self.assertEqual(len(names), len(avatars.SIZES) * len(avatars.FORMATS))
+        for name in names:
+            path = os.path.join(self.media_root, name)
+            with Image.open(path) as image:
+                size = int(name.rsplit('-', 1)[1].split('.')[0])
+                self.assertEqual(image.size, (size, size))
+                self.assertEqual(image.format, 'WEBP' if name.endswith('.webp') else 'JPEG')
+                self.assertFalse(image.getexif())
+            self.assertLess(os.path.getsize(path) * 50, len(original))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.media_root, 'profile_pics'))),
+                         sorted(os.path.basename(n) for n in names))
+
+    def test_jpeg_is_decoded_once_in_draft_mode(self):
+        from PIL import Image, JpegImagePlugin
+
+        with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True,
+                               side_effect=JpegImagePlugin.JpegImageFile.draft) as draft, \
+                mock.patch.object(Image, '_getdecoder', wraps=Image._getdecoder) as decoder:
+            self.upload(self.photo())
+        draft.assert_called_once_with(mock.ANY, 'RGB', (256, 256))
+        self.assertEqual([c.args[1] for c in decoder.call_args_list], ['jpeg'])
+
+    def test_exif_orientation_is_applied(self):
+        from io import BytesIO
+        from PIL import Image
+
+        # Left half black, right half white; orientation 6 turns it so black is on top
+        image = Image.new('RGB', (300, 300), 'white')
+        image.paste((0, 0, 0), (0, 0, 150, 300))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        data = BytesIO()
+        image.save(data, 'JPEG', exif=exif)
+        digest, decoded = avatars.prepare(BytesIO(data.getvalue()), self.user.pk)
+        self.assertLess(sum(decoded.getpixel((128, 10))), 60)
+        self.assertGreater(sum(decoded.getpixel((128, 245))), 700)
+
+    def test_invalid_upload_is_rejected_and_keeps_the_old_picture(self):
+        self.upload(self.photo((400, 300)))
+        before = Profile.objects.get(user=self.user).profile_picture.name
+        response = self.upload(b'not an image at all', name='photo.jpg')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(Profile.objects.get(user=self.user).profile_picture.name, before)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, before)))
+
+    def test_new_upload_or_removal_deletes_every_old_variant(self):
+        self.upload(self.photo((400, 300)))
+        old = Profile.objects.get(user=self.user).profile_picture.name
+        self.upload(self.photo((300, 400)))
+        new = Profile.objects.get(user=self.user).profile_picture.name
+        self.assertNotEqual(old, new)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.media_root, 'profile_pics'))),
+                         sorted(os.path.basename(n) for n in avatars.names(new)))
+
+        self.client.post(reverse('player:profile_update'), {'first_name': 'Pic', 'remove_picture': 'true'})
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'profile_pics')), [])
+
+    def test_guitar_page_offers_srcsets(self):
+        self.upload(self.photo((400, 300)))
+        name = Profile.objects.get(user=self.user).profile_picture.name
+        response = self.client.get(reverse('player:guitar_index'))
+        srcset = response.context['profile_picture_srcset']
+        digest = name.split('/')[1].split('-')[0]
+        self.assertEqual(srcset['webp'], f'/media/profile_pics/{digest}-64.webp 64w, '
+                                         f'/media/profile_pics/{digest}-128.webp 128w, '
+                                         f'/media/profile_pics/{digest}-256.webp 256w')
+        self.assertContains(response, f'srcset="{srcset["webp"]}"')
+        self.assertContains(response, f'srcset="{srcset["jpeg"]}"')
+
+    def test_pictures_from_before_variants_have_no_srcset(self):
+        Profile.objects.update_or_create(user=self.user, defaults={'profile_picture': 'profile_pics/old.png'})
+        self.assertIsNone(avatars.srcsets('profile_pics/old.png'))
+        self.assertEqual(avatars.names('profile_pics/old.png'), ['profile_pics/old.png'])
+        response = self.client.get(reverse('player:guitar_index'))
+        self.assertContains(response, 'src="/media/profile_pics/old.png"')
+        self.assertNotContains(response, 'srcset=')
+
+
+class SessionStoreTests(TestCase):
+    def setUp(self):
+        caches['sessions'].clear()
+        self.user = User.objects.create_user('sessioned', 'sessioned@example.com', 'pw123456')
+        self.client.force_login(self.user)
+
+    def session_writes(self, *names):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            for name in names:
+                self.assertEqual(self.client.get(reverse(f'player:{name}')).status_code, 200)
+        return [q['sql'] for q in queries if 'django_session' in q['sql']]
+
+    def test_unchanged_sessions_are_not_written(self):
+        self.assertEqual(self.session_writes('guitar_acoustic', 'guitar_bass', 'guitar_acoustic'), [])
+        self.assertIn('sessionid', self.client.get(reverse('player:guitar_bass')).cookies)  # still sliding
+
+    def test_refresh_is_coalesced_to_the_interval(self):
+        from django.contrib.sessions.models import Session
+        from .sessions import SessionStore
+
+        with override_settings(SESSION_REFRESH_INTERVAL=0):
+            writes = self.session_writes('guitar_acoustic', 'guitar_bass')
+        self.assertEqual(len([sql for sql in writes if sql.startswith('UPDATE')]), 2)
+
+        store = SessionStore(self.client.session.session_key)
+        store.load()
+        self.assertFalse(store.needs_write())
+        store._saved_expiry -= timedelta(seconds=3600)
+        self.assertTrue(store.needs_write())
+        store.save()
+        row = Session.objects.get(session_key=store.session_key)
+        self.assertAlmostEqual(row.expire_date.timestamp(), store.get_expiry_date().timestamp(), delta=5)
+
+    def test_changes_are_written_through(self):
+        self.client.post(reverse('player:logout'))
+        self.assertEqual(self.client.get(reverse('player:guitar_index')).status_code, 302)  # sets last_page
+        caches['sessions'].clear()  # the database has it too
+        self.assertEqual(self.client.session['last_page'], reverse('player:guitar_index'))
+
+    def test_cold_cache_reads_the_database_once(self):
+        caches['sessions'].clear()
+        with self.assertNumQueries(2):  # session, then user
+            self.client.get(reverse('player:guitar_acoustic'))
+        with self.assertNumQueries(1):
+            self.client.get(reverse('player:guitar_acoustic'))
+
+    def test_sessions_flushed_by_another_worker_are_gone(self):
+        from django.contrib.sessions.backends.base import UpdateError
+        from django.contrib.sessions.models import Session
+        from .sessions import SessionStore
+
+        key = self.client.session.session_key
+        stale = SessionStore(key)
+        self.assertEqual(stale['_auth_user_id'], str(self.user.pk))
+        SessionStore(key).flush()  # logout, served by another worker sharing the session cache
+        self.assertEqual(self.client.get(reverse('player:guitar_index')).status_code, 302)
+        stale['last_page'] = '/'
+        with self.assertRaises(UpdateError):  # and isn't brought back by a request that loaded it before
+            stale.save()
+        self.assertFalse(Session.objects.filter(session_key=key).exists())
+
+    @override_settings(SESSION_CACHE_ALIAS='default')
+    def test_process_local_cache_is_never_read(self):
+        from django.contrib.sessions.models import Session
+        from .sessions import SessionStore
+
+        self.assertFalse(SessionStore().cache_shared)
+        self.client.force_login(self.user)
+        queries = self.session_writes('guitar_acoustic', 'guitar_bass')
+        self.assertEqual([sql.split()[0] for sql in queries], ['SELECT', 'SELECT'])  # one read each, no writes
+        # Another worker logs the user out: it can only clear its own LocMemCache, this one has to notice
+        Session.objects.all().delete()
+        self.assertEqual(self.client.get(reverse('player:guitar_index')).status_code, 302)
+
+    def test_prune_deletes_only_expired_sessions_in_batches(self):
+        from io import StringIO
+        from django.contrib.sessions.models import Session
+        from django.core.management import call_command
+        from . import sessions
+
+        expired = timezone.now() - timedelta(days=1)
+        for i in range(5):
+            Session.objects.create(session_key=f'expired{i}', session_data='', expire_date=expired)
+        with mock.patch.object(Session.objects, 'filter', wraps=Session.objects.filter) as batches:
+            self.assertEqual(sessions.prune(batch_size=2), 5)
+        self.assertEqual(batches.call_count, 3 * 2 + 1)  # select and delete per batch, then the empty select
+        self.assertEqual(Session.objects.count(), 1)  # the logged-in one
+
+        Session.objects.create(session_key='expired', session_data='', expire_date=expired)
+        out = StringIO()
+        call_command('prune_sessions', '--batch-size', '10', stdout=out)
+        self.assertIn('1 expired sessions deleted', out.getvalue())
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir, ignore_errors=True)
+        override = override_settings(RATE_LIMIT_DB=os.path.join(state_dir, 'rate_limit.sqlite3'),
+                                     RATE_LIMITS=CONFIGURED_RATE_LIMITS,
+                                     RATE_LIMIT_LOCKOUT={'base': 60, 'factor': 2, 'max': 600, 'forget': 3600})
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_sliding_window_counts_requests_in_any_period(self):
+        rule = rate_limit.Rule('ip', 'window', limit=3, period=10)
+        for t in (0, 4, 8):
+            rate_limit.check([('k', rule)], now=1000 + t)
+        with self.assertRaises(rate_limit.RateLimited) as refused:
+            rate_limit.check([('k', rule)], now=1009)
+        self.assertEqual(refused.exception.retry_after, 1)  # the request at 1000 leaves the window at 1010
+        rate_limit.check([('k', rule)], now=1010.5)
+        with self.assertRaises(rate_limit.RateLimited):
+            rate_limit.check([('k', rule)], now=1011)
+
+    def test_token_bucket_allows_bursts_then_the_average_rate(self):
+        rule = rate_limit.Rule('account', 'bucket', limit=1, period=2, burst=2)
+        rate_limit.check([('k', rule)], now=1000)
+        rate_limit.check([('k', rule)], now=1000)
+        with self.assertRaises(rate_limit.RateLimited) as refused:
+            rate_limit.check([('k', rule)], now=1000)
+        self.assertEqual(refused.exception.retry_after, 2)
+        rate_limit.check([('k', rule)], now=1002)
+
+    def test_a_refused_request_counts_against_no_rule(self):
+        loose = rate_limit.Rule('ip', 'window', limit=5, period=60)
+        tight = rate_limit.Rule('account', 'window', limit=1, period=60)
+        rate_limit.check([('ip', loose), ('account', tight)], now=1000)
+        for _ in range(3):
+            with self.assertRaises(rate_limit.RateLimited):
+                rate_limit.check([('ip', loose), ('account', tight)], now=1001)
+        for _ in range(4):
+            rate_limit.check([('ip', loose)], now=1002)  # 1 of 5 used, not 4
+
+    def test_lockouts_escalate_and_are_forgotten(self):
+        rule = rate_limit.Rule('ip', 'window', limit=1, period=10, lockout=True)
+        rate_limit.check([('k', rule)], now=1000)
+        with self.assertRaises(rate_limit.RateLimited) as refused:
+            rate_limit.check([('k', rule)], now=1001)
+        self.assertEqual((refused.exception.retry_after, refused.exception.locked), (60, True))
+        with self.assertRaises(rate_limit.RateLimited) as refused:
+            rate_limit.check([('k', rule)], now=1030)  # inside the window's limit again, but locked out
+        self.assertEqual(refused.exception.retry_after, 31)
+
+        rate_limit.check([('k', rule)], now=1062)
+        with self.assertRaises(rate_limit.RateLimited) as refused:
+            rate_limit.check([('k', rule)], now=1063)
+        self.assertEqual(refused.exception.retry_after, 120)
+        rate_limit.check([('k', rule)], now=1063 + 120 + 3600 + 1)
+        with self.assertRaises(rate_limit.RateLimited) as refused:
+            rate_limit.check([('k', rule)], now=1063 + 120 + 3600 + 2)
+        self.assertEqual(refused.exception.retry_after, 60)  # strikes forgotten
+
+    def test_counts_are_exact_across_processes(self):
+        rule = rate_limit.Rule('route', 'window', limit=100, period=60)
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+
+        def hammer():
+            allowed = 0
+            for _ in range(40):
+                try:
+                    rate_limit.check([('shared', rule)])
+                    allowed += 1
+                except rate_limit.RateLimited:
+                    pass
+            results.put(allowed)
+
+        workers = [context.Process(target=hammer) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        allowed = sum(results.get(timeout=30) for _ in workers)
+        for worker in workers:
+            worker.join()
+        self.assertEqual(allowed, 100)
+
+    def test_login_limits_failed_attempts_on_each_account(self):
+        url = reverse('player:login')
+        for i in range(5):
+            response = self.client.post(url, {'username': 'victim', 'password': 'wrong'}, REMOTE_ADDR=f'10.0.0.{i}')
+            self.assertNotEqual(response.status_code, 429)
+        response = self.client.post(url, {'username': 'Victim', 'password': 'wrong'}, REMOTE_ADDR='10.0.0.9',
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 290)  # the first attempt leaves the 5-minute window
+        self.assertLessEqual(int(response['Retry-After']), 300)  # and no lockout on top of it
+        self.assertEqual(response.json()['error'], 'Too many login attempts. Please try again later.')
+        response = self.client.post(url, {'username': 'someone-else', 'password': 'wrong'}, REMOTE_ADDR='10.0.0.9')
+        self.assertNotEqual(response.status_code, 429)
+        self.assertEqual(self.client.get(url).status_code, 200)  # only POSTs count
+
+    def test_successful_logins_are_not_counted(self):
+        User.objects.create_user('regular', 'regular@example.com', 'right-password')
+        url = reverse('player:login')
+        for _ in range(12):  # past both the account's 5 and the address's 10
+            response = self.client.post(url, {'username': 'regular', 'password': 'right-password'})
+            self.assertEqual(response.status_code, 302)
+            self.client.logout()
+        for _ in range(4):
+            self.client.post(url, {'username': 'regular', 'password': 'wrong'})
+        response = self.client.post(url, {'username': 'regular', 'password': 'right-password'})
+        self.assertEqual(response.status_code, 302)  # 4 failures of 5
+
+    def test_clients_behind_a_trusted_proxy_are_counted_apart(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.2',
+                                       HTTP_X_FORWARDED_FOR='203.0.113.7, 198.51.100.1, 10.0.0.1')
+        self.assertEqual(rate_limit.client_ip(request), '10.0.0.2')  # no proxy trusted: the header is ignored
+        with override_settings(RATE_LIMIT_TRUSTED_PROXIES=['10.0.0.0/24']):
+            # the right-most hop a trusted proxy didn't add; anything left of it is the client's to forge
+            self.assertEqual(rate_limit.client_ip(request), '198.51.100.1')
+            direct = RequestFactory().get('/', REMOTE_ADDR='192.0.2.5', HTTP_X_FORWARDED_FOR='203.0.113.7')
+            self.assertEqual(rate_limit.client_ip(direct), '192.0.2.5')
+
+    def test_reset_limits_each_address(self):
+        url = reverse('player:reset')
+        for i in range(10):
+            self.client.post(url, {'email': f'user{i}@example.com'})
+        response = self.client.post(url, {'email': 'another@example.com'})
+        self.assertContains(response, 'Too many reset attempts', status_code=429)
+
+    @override_settings(RATE_LIMITS={'render': [{'key': 'account', 'algorithm': 'bucket', 'limit': 1, 'period': 60}]})
+    def test_render_endpoints_are_limited_per_account_and_route(self):
+        user = User.objects.create_user('limited', 'limited@example.com', 'pw123456')
+        self.client.force_login(user)
+        submit = reverse('player:render_job_submit')
+        self.assertEqual(self.client.post(submit, {'guitar_type': 'banjo'}).status_code, 400)
+        response = self.client.post(submit, {'guitar_type': 'banjo'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(self.client.get(submit).status_code, 405)  # only POSTs count
+        # The stream endpoint has a bucket of its own
+        self.assertEqual(self.client.get(reverse('player:guitar_stream', args=['banjo'])).status_code, 404)
+
+    def test_requests_go_through_when_the_state_file_is_unusable(self):
+        with override_settings(RATE_LIMIT_DB=os.path.join(tempfile.gettempdir(), 'missing-dir', 'x', 'rl.sqlite3')):
+            for _ in range(12):
+                response = self.client.post(reverse('player:login'), {'username': 'u', 'password': 'p'})
+                self.assertNotEqual(response.status_code, 429)
@@ -28,6 +28,13 @@ urlpatterns = [
     path('guitar/feature-info/', views.guitar_feature_info, name='guitar_feature_info'),
     path("save-dashboard/", views.save_dashboard, name="save_dashboard"),
     path("guitar/info/", views.guitar_title_info, name="guitar_title_info"),  # ← add this
+    path('guitar/render-cache/stats/', views.render_cache_stats, name='render_cache_stats'),
+    path('guitar/stream/<str:guitar_type>/', views.guitar_stream, name='guitar_stream'),
+    path('guitar/jobs/', views.render_job_submit, name='render_job_submit'),
+    path('guitar/jobs/<uuid:job_id>/', views.render_job_status, name='render_job_status'),
+    path('guitar/jobs/<uuid:job_id>/cancel/', views.render_job_cancel, name='render_job_cancel'),
+    path('guitar/batch/', views.render_batch_api, name='render_batch'),
+    path('guitar/peaks/<str:name>/', views.render_peaks, name='render_peaks'),
 
 ]
 
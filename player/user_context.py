@@ -0,0 +1,102 @@
+"""
+Per-user page context: the signed-in user's Profile, Dashboard, profile
+picture URL and srcsets, and render budget, loaded together and cached.
+
+get(user) answers from the Django cache; on a miss it loads the user with
+the related rows and the render quota tier's group in one query (creating a
+missing Profile or Dashboard, which only happens once per user), and caches
+the result for USER_CONTEXT_TIMEOUT seconds.
+
+The cache backend may be private to each worker process (LocMemCache), so
+entries are keyed by a per-user version kept in the host-wide counters file
+(counters.py): saving or deleting the User, Profile, Dashboard or RenderQuota,
+or changing the user's groups, bumps it (see the receivers in models.py), and
+every worker's next read misses. A page never shows data older than the last
+write, whichever process made it. The budget is worked out from the cached
+quota row when it is read, so the refill since the last charge shows too.
+
+Pages read it through the context processor below rather than querying for
+themselves, so a page costs no queries of its own once the entry is cached,
+and one when it isn't. The picture URL comes from the profile_pictures index
+and the srcsets from the picture's name (avatars.py), so building the context
+never touches storage.
+"""
+import logging
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from . import avatars, counters, profile_pictures, render_quota
+from .models import Dashboard, Profile, RenderQuota
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300
+
+UserContext = namedtuple('UserContext', 'profile dashboard profile_picture_url profile_picture_srcset '
+                                         'quota_tier quota')
+
+
+def _version_key(user_id):
+    return f'user_context:{user_id}'
+
+
+def _key(user_id, version):
+    return f'user_context:{user_id}:{version}'
+
+
+def _load(user_id):
+    user = (User.objects.select_related('profile', 'dashboard', 'render_quota')
+            .annotate(tier_group=render_quota.tier_group()).get(pk=user_id))
+    try:
+        profile = user.profile
+    except Profile.DoesNotExist:
+        profile = Profile.objects.create(user=user)
+    try:
+        dashboard = user.dashboard
+    except Dashboard.DoesNotExist:
+        dashboard = Dashboard.objects.create(user=user)
+    try:
+        quota = user.render_quota
+    except RenderQuota.DoesNotExist:
+        quota = None
+    url = profile_pictures.url_for(profile)
+    return UserContext(profile, dashboard, url, avatars.srcsets(profile.profile_picture.name) if url else None,
+                       render_quota.tier_for(user, [user.tier_group] if user.tier_group else []), quota)
+
+
+def get(user):
+    """The UserContext of an authenticated user, from the cache when possible."""
+    key = _key(user.pk, counters.get(_version_key(user.pk)))
+    context = cache.get(key)
+    if context is None:
+        context = _load(user.pk)
+        cache.set(key, context, getattr(settings, 'USER_CONTEXT_TIMEOUT', DEFAULT_TIMEOUT))
+    return context
+
+
+def invalidate(user_id):
+    """Make every process's cached context for the user stale."""
+    counters.incr(_version_key(user_id))
+
+
+def user_context(request):
+    """
+    Context processor: `profile`, `dashboard`, `profile_picture_url`,
+    `profile_picture_srcset` and `render_budget` for the signed-in user,
+    loaded on first use in the template.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    context = SimpleLazyObject(lambda: get(user))
+    return {
+        'profile': SimpleLazyObject(lambda: context.profile),
+        'dashboard': SimpleLazyObject(lambda: context.dashboard),
+        'profile_picture_url': SimpleLazyObject(lambda: context.profile_picture_url),
+        'profile_picture_srcset': SimpleLazyObject(lambda: context.profile_picture_srcset),
+        'render_budget': SimpleLazyObject(lambda: render_quota.budget(*context.quota_tier, context.quota)),
+    }
@@ -1,7 +1,7 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout
 from django.contrib.auth.models import User
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.mail import send_mail
@@ -9,79 +9,50 @@ from django.conf import settings
 from django.urls import reverse
 from django.db import transaction, IntegrityError
 from .forms import LoginForm, SignupForm, PasswordResetForm, PasswordResetConfirmForm
-from .models import Profile, Dashboard
+from .models import Profile, Dashboard, RenderJob
+import json
 import logging
 import random
+import time
 import os
 from django.core.cache import cache
 from django.contrib.auth.hashers import make_password, check_password
-from django.core.files.storage import default_storage
+from django.utils.crypto import constant_time_compare
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.contrib.admin.views.decorators import staff_member_required
+from . import (avatars, encoders, media, metrics, peaks, profile_pictures, rate_limit, render_cache, render_jobs,
+               render_quota, sandbox)
+from .batch import parse_spec, render_batch
+from .audio_utils import SOUNDFONT_FILES
+from .quality import get_tier
+from .streaming import stream_audio
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Cache-based rate limiting
-RATE_LIMIT_SECONDS = 60
-MAX_ATTEMPTS = 10
-RESET_TIMEOUT_SECONDS = 120  # 2 minutes
-
+# Render request limits
+MAX_RENDER_NOTES = 2000
+MAX_NOTE_SECONDS = 16.0
+MAX_BATCH_ITEMS = 500
+DEFAULT_BATCH_WORKERS = 4
 
-def check_rate_limit(request):
-    ip = request.META.get('REMOTE_ADDR', 'unknown')
-    cache_key = f'rate_limit_{ip}'
-    attempts = cache.get(cache_key, 0)
-    if attempts >= MAX_ATTEMPTS:
-        return False
-    cache.set(cache_key, attempts + 1, timeout=RATE_LIMIT_SECONDS)
-    return True
+RESET_TIMEOUT_SECONDS = 120  # 2 minutes
 
 
 def index(request):
     return render(request, 'player/index.html')
 
 
-def _get_safe_profile_picture_url(profile):
-    """
-    Helper function to get profile picture URL only if file actually exists
-    """
-    if not profile.profile_picture:
-        print("*** DEBUG: No profile_picture field set")
-        return None
-
-    try:
-        # Check if file actually exists
-        if default_storage.exists(profile.profile_picture.name):
-            print(f"*** DEBUG: Storage says exists: True for {profile.profile_picture.name}")
-            # Force URL generation with / separators (Windows fix)
-            url = profile.profile_picture.url.replace('\\', '/')
-            print(f"*** DEBUG: Generated URL: {url}")
-            return url
-        else:
-            print(f"*** DEBUG: Storage says exists: False for {profile.profile_picture.name}")
-            # File doesn't exist, clear the database reference
-            logger.warning(f"Profile picture file missing: {profile.profile_picture.name}")
-            profile.profile_picture = None
-            profile.save()
-            return None
-    except Exception as e:
-        logger.error(f"Error checking/generating profile picture URL: {e}")
-        print(f"*** DEBUG: Exception in URL gen: {type(e).__name__}: {e}")
-        # Still clear if URL fails
-        profile.profile_picture = None
-        profile.save()
-        return None
-
-
 def _refresh_profile_session(request, user):
     """
     Helper: ensure session contains profile_picture_url so templates have a reliable source.
     """
     try:
         profile, _ = Profile.objects.get_or_create(user=user)
-        request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
+        request.session['profile_picture_url'] = profile_pictures.url_for(profile)
     except Exception as e:
         logger.debug(f"_refresh_profile_session error: {e}")
         request.session['profile_picture_url'] = None
@@ -94,18 +65,8 @@ def guitar_index(request):
         next_url = request.get_full_path()
         return redirect(f"{login_url}?next={next_url}")
 
-    profile, _ = Profile.objects.get_or_create(user=request.user)
-    dashboard, _ = Dashboard.objects.get_or_create(user=request.user)
-
-    # Keep session in sync with profile picture (ensures persistence after login)
-    request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
-
-    return render(request, 'player/guitar_index.html', {
-        'profile': profile,
-        'dashboard': dashboard,
-        'user': request.user,
-        'profile_picture_url': request.session.get('profile_picture_url'),
-    })
+    # profile, dashboard, profile_picture_url and render_budget come from the user_context context processor
+    return render(request, 'player/guitar_index.html')
 
 
 @login_required
@@ -113,17 +74,7 @@ def guitar_feature_info(request):
     """
     View for the guitar feature info page.
     """
-    request.session['last_page'] = request.get_full_path()
-    profile, created = Profile.objects.get_or_create(user=request.user)
-
-    # Refresh session image
-    request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
-
-    return render(request, 'player/guitar_feature_info.html', {
-        'profile': profile,
-        'user': request.user,
-        'profile_picture_url': request.session.get('profile_picture_url'),
-    })
+    return render(request, 'player/guitar_feature_info.html')
 
 
 @login_required
@@ -164,51 +115,37 @@ def profile_update(request):
             remove_pic = request.POST.get("remove_picture") == "true"
 
             # If user uploaded new image → ALWAYS use it (ignore remove flag)
+            old_pic = profile.profile_picture.name if profile.profile_picture else None
             if "profile_picture" in request.FILES:
                 new_pic = request.FILES["profile_picture"]
                 if new_pic:
                     logger.info(
                         f"*** UPLOAD RECEIVED: Filename={new_pic.name}, Size={new_pic.size} bytes, Content-Type={new_pic.content_type} ***")
-
-                    # delete old file physically (if exists)
-                    if profile.profile_picture:
-                        try:
-                            if default_storage.exists(profile.profile_picture.name):
-                                default_storage.delete(profile.profile_picture.name)
-                        except Exception as e:
-                            logger.debug(f"Could not delete old profile picture: {e}")
-
-                    # Save new file
-                    profile.profile_picture = new_pic
+                    try:
+                        # Decoded once here; the resized variants are written in the background
+                        profile.profile_picture, _ = avatars.save(new_pic, user.pk)
+                    except avatars.InvalidImage as e:
+                        logger.info(f"Rejected profile picture from {user.username}: {e}")
+                        error_msg = 'Please upload a JPEG, PNG, GIF or WebP image.'
+                        if is_ajax:
+                            return JsonResponse({'success': False, 'error': error_msg}, status=400)
+                        messages.error(request, error_msg)
+                        return redirect('player:guitar_index')
                     logger.info(f"*** ASSIGNING FILE: Will save to {profile.profile_picture.name} ***")
                     remove_pic = False  # cancel delete if new pic uploaded
 
             # If user clicked remove (and did not upload new one)
             if remove_pic:
-                if profile.profile_picture:
-                    try:
-                        if default_storage.exists(profile.profile_picture.name):
-                            default_storage.delete(profile.profile_picture.name)
-                    except Exception as e:
-                        logger.debug(f"Could not delete removed picture: {e}")
                 profile.profile_picture = None
 
             profile.save()
 
-            # Safe debug: Only if picture exists (avoids NoneType on removal)
-            if profile.profile_picture:
-                import os  # Ensure imported at top if needed
-                from django.conf import settings
-                file_path = os.path.join(settings.MEDIA_ROOT, profile.profile_picture.name).replace('\\', '/')
-                print(f"*** DEBUG: Full file path (normalized): {file_path}")
-                print(f"*** DEBUG: File exists after save? {os.path.exists(file_path)}")
-                print(
-                    f"*** DEBUG: File size: {os.path.getsize(file_path) if os.path.exists(file_path) else 'N/A'} bytes")
-            else:
-                print("*** DEBUG: No profile picture - skipped file checks")
+            # Delete the old picture (and its variants) now nothing points at it
+            if old_pic and old_pic != (profile.profile_picture.name if profile.profile_picture else None):
+                avatars.delete(old_pic)
 
-            # Call safe URL (already handles None)
-            safe_url = _get_safe_profile_picture_url(profile)
+            # Index the new picture (or its removal) for page views
+            safe_url = profile_pictures.record(profile)
             print(f"*** SAVE COMPLETE: Safe URL: {safe_url} ***")
 
             # Rest of your code (logger.info, session set, etc.) unchanged
@@ -241,61 +178,300 @@ def profile_update(request):
 
 @login_required
 def guitar_acoustic(request):
-    request.session['last_page'] = request.get_full_path()
-    profile, created = Profile.objects.get_or_create(user=request.user)
-    request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
-    return render(request, 'player/guitar_acoustic.html', {'profile': profile, 'user': request.user,
-                                                           'profile_picture_url': request.session.get(
-                                                               'profile_picture_url')})
+    return render(request, 'player/guitar_acoustic.html')
 
 
 @login_required
 def guitar_electric(request):
-    request.session['last_page'] = request.get_full_path()
-    profile, created = Profile.objects.get_or_create(user=request.user)
-    request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
-    return render(request, 'player/guitar_electric.html', {'profile': profile, 'user': request.user,
-                                                           'profile_picture_url': request.session.get(
-                                                               'profile_picture_url')})
+    return render(request, 'player/guitar_electric.html')
 
 
 @login_required
 def guitar_classical(request):
-    request.session['last_page'] = request.get_full_path()
-    profile, created = Profile.objects.get_or_create(user=request.user)
-    request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
-    return render(request, 'player/guitar_classical.html', {'profile': profile, 'user': request.user,
-                                                            'profile_picture_url': request.session.get(
-                                                                'profile_picture_url')})
+    return render(request, 'player/guitar_classical.html')
 
 
 @login_required
 def guitar_bass(request):
-    request.session['last_page'] = request.get_full_path()
-    profile, created = Profile.objects.get_or_create(user=request.user)
-    request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
-    return render(request, 'player/guitar_bass.html', {'profile': profile, 'user': request.user,
-                                                       'profile_picture_url': request.session.get(
-                                                           'profile_picture_url')})
+    return render(request, 'player/guitar_bass.html')
+
+
+def _parse_render_params(params):
+    """
+    Read a composition from a QueryDict-like object:
+      notes=40,45,50          MIDI numbers
+      duration=0.5            seconds per note, or
+      durations=0.5,1,0.25    one length per note
+      onsets=0,0,0.5          optional start times; notes sharing an onset form
+                              a chord, otherwise notes play back to back
+      velocities=90,100,64    optional per-note loudness (default 100)
+    Returns (notes, duration) ready for render_cache.normalize_events: notes is
+    the plain list of MIDI numbers, or a column dict when onsets/velocities
+    are given. Raises ValueError with a user-facing message on bad input.
+    """
+    def numbers(name, cast):
+        return [cast(x) for x in params[name].split(',') if x.strip()]
+
+    try:
+        notes_list = [int(n) for n in params.get('notes', '').split(',') if n.strip()]
+        if params.get('durations'):
+            duration = numbers('durations', float)
+        else:
+            duration = float(params.get('duration', 0.5))
+        onsets = numbers('onsets', float) if params.get('onsets') else None
+        velocities = numbers('velocities', int) if params.get('velocities') else None
+    except ValueError:
+        raise ValueError('Notes and velocities must be whole numbers, onsets and durations seconds.')
+
+    if not notes_list:
+        raise ValueError('Add some notes first!')
+    if len(notes_list) > MAX_RENDER_NOTES:
+        raise ValueError(f'Too many notes (max {MAX_RENDER_NOTES}).')
+    if any(not 0 <= n <= 127 for n in notes_list):
+        raise ValueError('MIDI note numbers must be between 0 and 127.')
+    lengths = duration if isinstance(duration, list) else [duration]
+    if isinstance(duration, list) and len(duration) != len(notes_list):
+        raise ValueError('Need exactly one duration per note.')
+    if any(not 0 < d <= MAX_NOTE_SECONDS for d in lengths):
+        raise ValueError(f'Note durations must be between 0 and {MAX_NOTE_SECONDS} seconds.')
+    if onsets is None and velocities is None:
+        return notes_list, duration
+
+    notes = {'pitch': notes_list}
+    for name, values in (('onset', onsets), ('velocity', velocities)):
+        if values is not None:
+            if len(values) != len(notes_list):
+                raise ValueError(f'Need exactly one {name} per note.')
+            notes[name] = values
+    if onsets is not None and any(not 0 <= o <= MAX_RENDER_NOTES * MAX_NOTE_SECONDS for o in onsets):
+        raise ValueError('Note onsets must be zero or later.')
+    if velocities is not None and any(not 1 <= v <= 127 for v in velocities):
+        raise ValueError('Velocities must be between 1 and 127.')
+    if isinstance(duration, list):
+        notes['duration'] = duration
+    return notes, duration
+
+
+def _parse_output_params(request, streaming=False):
+    """
+    Pick the output format (?format=, then Accept, then RENDER_DEFAULT_FORMAT),
+    optional bitrate=<kbps> and quality=final|preview. Returns
+    (encoder, bitrate, quality), raises ValueError with a user-facing message
+    on bad input.
+    """
+    encoder = encoders.get_encoder(encoders.negotiate(request, streaming), streaming)
+    params = request.POST if request.method == 'POST' else request.GET
+    bitrate = params.get('bitrate')
+    if bitrate:
+        try:
+            bitrate = int(bitrate)
+        except ValueError:
+            raise ValueError('Bitrate must be a whole number of kbps.')
+    quality = get_tier(params.get('quality') or None).name
+    return encoder, encoder.check_bitrate(bitrate or None), quality
+
+
+def _quota_exceeded(e):
+    response = JsonResponse({'success': False, 'error': 'Your render budget is used up. Please try again shortly.',
+                             'budget': e.budget}, status=429)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def _charged(user, chunks):
+    """Pass a stream through, charging its user the CPU time spent producing it."""
+    start = time.thread_time()
+    try:
+        yield from chunks
+    finally:
+        render_quota.charge(user, time.thread_time() - start)
+
+
+@login_required
+@rate_limit.limit('render')
+def guitar_stream(request, guitar_type):
+    """
+    Stream a composition while it is being synthesized, so playback starts
+    after the first block instead of after the whole render. WAV by default,
+    Ogg/Opus when asked for with ?format=opus or an Accept header.
+    """
+    if guitar_type not in SOUNDFONT_FILES:
+        return JsonResponse({'success': False, 'error': 'Unknown guitar type.'}, status=404)
+    try:
+        notes_list, duration = _parse_render_params(request.GET)
+        encoder, bitrate, quality = _parse_output_params(request, streaming=True)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    events = render_cache.normalize_events(notes_list, duration)
+    try:
+        # Streams render in this request, not in a sandboxed worker: the cost cap is what bounds them
+        sandbox.admit(events, quality)
+        render_quota.check(request.user)
+    except sandbox.TooExpensive as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=413)
+    except render_quota.QuotaExceeded as e:
+        return _quota_exceeded(e)
+    response = StreamingHttpResponse(
+        _charged(request.user, stream_audio(guitar_type, events, encoder.name, bitrate, quality=quality)),
+        content_type=encoder.content_type)
+    response['Vary'] = 'Accept'
+    response['Cache-Control'] = 'no-store'
+    response['X-Accel-Buffering'] = 'no'  # don't let nginx buffer the stream
+    return response
+
+
+@login_required
+@rate_limit.limit('render', methods=('POST',))
+def render_job_submit(request):
+    """
+    Queue a render and return its job id straight away (202). The client
+    polls render_job_status until the job is done, failed or cancelled.
+    After an edit, passing the previous result's URL as `base` re-renders
+    only the part of the song the edit touched.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=405)
+
+    guitar_type = request.POST.get('guitar_type', '')
+    if guitar_type not in SOUNDFONT_FILES:
+        return JsonResponse({'success': False, 'error': 'Unknown guitar type.'}, status=400)
+    try:
+        notes_list, duration = _parse_render_params(request.POST)
+        encoder, bitrate, quality = _parse_output_params(request)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    try:
+        job = render_jobs.submit(request.user, guitar_type, notes_list, duration,
+                                 output_format=encoder.name, bitrate=bitrate, quality=quality,
+                                 base_url=request.POST.get('base', '')[:255])
+    except sandbox.TooExpensive as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=413)
+    except render_quota.QuotaExceeded as e:
+        return _quota_exceeded(e)
+    except render_jobs.QueueFull as e:
+        if isinstance(e, render_jobs.TooManyJobs):
+            error = 'You have too many renders in progress. Please wait for one to finish.'
+        else:
+            error = 'The render queue is full. Please try again shortly.'
+        response = JsonResponse({'success': False, 'error': error}, status=429)
+        response['Retry-After'] = '5'
+        return response
+
+    return JsonResponse({
+        'success': True,
+        'job': render_jobs.job_payload(job),
+        'status_url': reverse('player:render_job_status', args=[job.pk]),
+        'cancel_url': reverse('player:render_job_cancel', args=[job.pk]),
+    }, status=202)
+
+
+@login_required
+def render_job_status(request, job_id):
+    job = get_object_or_404(RenderJob, pk=job_id, user=request.user)
+    return JsonResponse({'success': True, 'job': render_jobs.job_payload(job)})
+
+
+@login_required
+def render_job_cancel(request, job_id):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=405)
+    job = get_object_or_404(RenderJob, pk=job_id, user=request.user)
+    cancelled = render_jobs.cancel(job)
+    return JsonResponse({'success': cancelled, 'job': render_jobs.job_payload(job)},
+                        status=200 if cancelled else 409)
+
+
+def _check_batch_item(item):
+    """
+    Parse one batch item and hold it to the same limits as a single render:
+    a known guitar, MAX_RENDER_NOTES notes, note lengths and velocities in
+    range, and a cost sandbox.admit() accepts. Raises ValueError or
+    sandbox.TooExpensive with a user-facing message.
+    """
+    if not isinstance(item, (dict, list, tuple)):
+        raise ValueError('Each item must be an object.')
+    try:
+        guitar_type, notes_list, duration = parse_spec(item)
+        events = render_cache.normalize_events(notes_list, duration)
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f'Bad notes: {e}')
+    if guitar_type not in SOUNDFONT_FILES:
+        raise ValueError('Unknown guitar type.')
+    if not len(events):
+        raise ValueError('Add some notes first!')
+    if len(events) > MAX_RENDER_NOTES:
+        raise ValueError(f'Too many notes (max {MAX_RENDER_NOTES}).')
+    if ((events['pitch'] < 0) | (events['pitch'] > 127)).any():
+        raise ValueError('MIDI note numbers must be between 0 and 127.')
+    if ((events['duration'] <= 0) | (events['duration'] > MAX_NOTE_SECONDS)).any():
+        raise ValueError(f'Note durations must be between 0 and {MAX_NOTE_SECONDS} seconds.')
+    if ((events['onset'] < 0) | (events['onset'] > MAX_RENDER_NOTES * MAX_NOTE_SECONDS)).any():
+        raise ValueError('Note onsets must be zero or later.')
+    if ((events['velocity'] < 1) | (events['velocity'] > 127)).any():
+        raise ValueError('Velocities must be between 1 and 127.')
+    sandbox.admit(events)
+
+
+@staff_member_required
+@rate_limit.limit('render', methods=('POST',))
+def render_batch_api(request):
+    """
+    Staff-only batch rendering for lesson content. POST a JSON body
+        {"items": [{"guitar_type": "acoustic", "notes": [40, 45], "duration": 0.5}, ...],
+         "workers": 8}
+    with the CSRF token in an X-CSRFToken header, and get per-item
+    URLs/errors plus throughput figures back. Every item is checked before
+    any is rendered, and `workers` is capped at RENDER_BATCH_WORKERS.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=405)
+    try:
+        payload = json.loads(request.body or b'{}')
+        items = payload['items']
+        workers = int(payload['workers']) if payload.get('workers') else None
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'success': False, 'error': 'Body must be JSON with an "items" list.'}, status=400)
+    if not isinstance(items, list) or not items:
+        return JsonResponse({'success': False, 'error': 'No items to render.'}, status=400)
+    if len(items) > MAX_BATCH_ITEMS:
+        return JsonResponse({'success': False, 'error': f'Too many items (max {MAX_BATCH_ITEMS}).'}, status=400)
+    for i, item in enumerate(items):
+        try:
+            _check_batch_item(item)
+        except sandbox.TooExpensive as e:
+            return JsonResponse({'success': False, 'error': f'Item {i}: {e}', 'index': i}, status=413)
+        except ValueError as e:
+            return JsonResponse({'success': False, 'error': f'Item {i}: {e}', 'index': i}, status=400)
+
+    max_workers = getattr(settings, 'RENDER_BATCH_WORKERS', DEFAULT_BATCH_WORKERS)
+    workers = max(1, min(workers or max_workers, max_workers))
+    report = render_batch(items, workers=workers, owner=request.user.pk)
+    return JsonResponse({'success': report['failed'] == 0, **report})
 
 
 def guitar_title_info(request):
     return render(request, "player/guitar_title_info.html")
 
+def _login_limited(request, e):
+    error_msg = 'Too many login attempts. Please try again later.'
+    if request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest':
+        response = JsonResponse({'success': False, 'error': error_msg}, status=429)
+    else:
+        messages.error(request, error_msg)
+        response = render(request, 'player/login.html', status=429)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@rate_limit.limit('login', methods=('POST',), on_limited=_login_limited)
 def login(request):
     # Check if it's an AJAX request
     is_ajax = request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest'
 
     if request.method == 'POST':
         logger.debug(f'POST data: {request.POST}')
-        if not check_rate_limit(request):
-            error_msg = 'Too many login attempts. Please try again later.'
-            logger.error('Rate limit exceeded')
-            if is_ajax:
-                return JsonResponse({'success': False, 'error': error_msg})
-            messages.error(request, error_msg)
-            return render(request, 'player/login.html')
-
         form = LoginForm(request.POST)
         if form.is_valid():
             username_input = form.cleaned_data['username']
@@ -319,7 +495,7 @@ def login(request):
                     # Refresh profile session immediately so UI has correct image
                     try:
                         profile, _ = Profile.objects.get_or_create(user=user)
-                        request.session['profile_picture_url'] = _get_safe_profile_picture_url(profile)
+                        request.session['profile_picture_url'] = profile_pictures.url_for(profile)
                     except Exception as e:
                         logger.debug(f"Error setting session profile_picture_url on login: {e}")
                         request.session['profile_picture_url'] = None
@@ -366,6 +542,7 @@ def login(request):
             else:
                 error_msg = 'Invalid username/email or password.'
                 logger.warning(f'Authentication failed for username_input: {username_input}')
+                rate_limit.record_failure(request, 'login')
                 if is_ajax:
                     return JsonResponse({'success': False, 'error': error_msg})
                 messages.error(request, error_msg)
@@ -463,12 +640,16 @@ def terms_condition(request):
     return render(request, 'player/terms_condition.html')
 
 
+def _reset_limited(request, e):
+    messages.error(request, 'Too many reset attempts. Please try again later.')
+    response = render(request, 'player/reset.html', status=429)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@rate_limit.limit('reset', methods=('POST',), on_limited=_reset_limited)
 def reset(request):
     if request.method == 'POST':
-        if not check_rate_limit(request):
-            messages.error(request, 'Too many reset attempts. Please try again later.')
-            return render(request, 'player/reset.html')
-
         form = PasswordResetForm(request.POST)
         if form.is_valid():
             email = form.cleaned_data['email']
@@ -632,3 +813,63 @@ def save_dashboard(request):
 
     return JsonResponse({"success": False, "message": "Invalid request"})
 
+
+
+@staff_member_required
+def render_cache_stats(request):
+    """Render cache hit/miss counters and disk usage as JSON (staff only)."""
+    return JsonResponse(render_cache.stats())
+
+
+def _peaks_etag(request, name):
+    parsed = render_cache.key_from_url(name)
+    if parsed is None or not os.path.exists(render_cache.peaks_path(*parsed)):
+        return None
+    return f'"{parsed[0]}.{parsed[1]}.peaks"'
+
+
+@condition(etag_func=_peaks_etag)
+def render_peaks(request, name):
+    """
+    Waveform peaks of a cached render (binary, see peaks.py). Render names are
+    content hashes, so the response never changes and may be cached forever.
+    """
+    parsed = render_cache.key_from_url(name)
+    if parsed is None:
+        return JsonResponse({'success': False, 'error': 'Not a generated audio file.'}, status=404)
+    try:
+        with open(render_cache.peaks_path(*parsed), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return JsonResponse({'success': False, 'error': 'No peaks for this file.'}, status=404)
+    response = HttpResponse(data, content_type=peaks.CONTENT_TYPE)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def serve_generated(request, name):
+    """
+    Generated audio under MEDIA_URL/generated/, with Range, ETag and long-lived
+    caching for content-addressed renders (see media.py).
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    if name.startswith('.') or os.path.basename(name) != name:
+        raise Http404('Not a generated audio file.')
+    try:
+        return media.serve_file(request, os.path.join(settings.MEDIA_ROOT, render_cache.CACHE_DIR, name), name)
+    except (FileNotFoundError, IsADirectoryError):
+        raise Http404('Not a generated audio file.')
+
+
+def metrics_view(request):
+    """
+    Render metrics in the Prometheus text format (see metrics.py). Scrapers
+    authenticate with `Authorization: Bearer <METRICS_TOKEN>`; staff can
+    read it from a browser session.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    auth = request.headers.get('Authorization', '')
+    if not request.user.is_staff and not (token and constant_time_compare(auth, f'Bearer {token}')):
+        return JsonResponse({'success': False, 'error': 'Not allowed.'}, status=403)
+    return HttpResponse(metrics.export(), content_type=metrics.CONTENT_TYPE)
@@ -12,6 +12,7 @@ let hasGenerated = false;
 let currentTime = 0;
 let totalDuration = 0;
 let playInterval = null;
+let audioElement = null;
 let capo = 0;
 
 // Guitar configurations
@@ -329,8 +330,20 @@ async function generateAudio() {
         playBtn.innerHTML = '<i class="fas fa-spinner fa-spin me-2"></i>Generating...';
     }
 
-    // Simulate audio generation
-    await new Promise(resolve => setTimeout(resolve, 1200));
+    // Stream the render from the server; playback can start with the first block
+    if (notes.length > 0 && window.guitarStreamUrl) {
+        try {
+            await openAudioStream();
+        } catch (err) {
+            console.error('Audio stream failed:', err);
+            if (playBtn) {
+                playBtn.disabled = false;
+                playBtn.innerHTML = '<i class="fas fa-play me-2"></i>Play';
+            }
+            showToast('Could not generate audio. Please try again.');
+            return;
+        }
+    }
 
     hasGenerated = true;
     if (playBtn) {
@@ -357,10 +370,36 @@ async function generateAudio() {
     startPlayback();
 }
 
+function noteToMidi(note) {
+    return (note.octave + 1) * 12 + NOTE_POSITIONS[note.name];
+}
+
+function openAudioStream() {
+    const secondsPerBeat = 60 / bpm;
+    const params = new URLSearchParams({
+        notes: notes.map(noteToMidi).join(','),
+        durations: notes.map(note => {
+            const beats = typeof note.durationValue === 'number' ? note.durationValue : (DURATION_VALUES[note.duration] || 1);
+            return (beats * secondsPerBeat).toFixed(3);
+        }).join(',')
+    });
+
+    if (audioElement) audioElement.pause();
+    audioElement = new Audio(`${window.guitarStreamUrl}?${params}`);
+    audioElement.addEventListener('ended', stopPlayback);
+
+    // 'canplay' fires once the first streamed block has arrived
+    return new Promise((resolve, reject) => {
+        audioElement.addEventListener('canplay', resolve, { once: true });
+        audioElement.addEventListener('error', () => reject(audioElement.error), { once: true });
+    });
+}
+
 function startPlayback() {
     if (totalDuration === 0) return;
 
     isPlaying = true;
+    if (audioElement) audioElement.play();
     const playBtn = document.getElementById('generateBtn');
     if (playBtn) playBtn.innerHTML = '<i class="fas fa-pause me-2"></i>Pause';
 
@@ -380,6 +419,7 @@ function startPlayback() {
 function pausePlayback() {
     isPlaying = false;
     if (playInterval) clearInterval(playInterval);
+    if (audioElement) audioElement.pause();
     const playBtn = document.getElementById('generateBtn');
     if (playBtn) playBtn.innerHTML = '<i class="fas fa-play me-2"></i>Play';
 }
@@ -387,6 +427,7 @@ function pausePlayback() {
 function stopPlayback() {
     pausePlayback();
     currentTime = 0;
+    if (audioElement) audioElement.currentTime = 0;
     updateProgressBar();
 }
 
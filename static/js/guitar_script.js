@@ -559,6 +559,7 @@ function setupProfilePicture() {
                 imgElement.src = imageData;
                 previewElement.parentNode.replaceChild(imgElement, previewElement);
             } else {
+                dropResponsiveSources(previewElement);
                 previewElement.src = imageData;
                 previewElement.style.display = 'block';
                 previewElement.style.opacity = '1';
@@ -895,6 +896,19 @@ function updateUserDisplay(profileData) {
         navbarUserName.textContent = `${profileData.firstName || ''} ${profileData.lastName || ''}`.trim() || 'Guest User';
     }
 }
+// ----------------------------------------------------------
+// 🧹 Utility: Drop Responsive Sources Before Replacing an Avatar
+// ----------------------------------------------------------
+// The server-rendered preview carries srcsets for the stored picture's resized
+// variants; they would win over a new src, so drop them before replacing it
+function dropResponsiveSources(imgElement) {
+    imgElement.removeAttribute('srcset');
+    imgElement.removeAttribute('sizes');
+    if (imgElement.parentNode && imgElement.parentNode.tagName === 'PICTURE') {
+        imgElement.parentNode.querySelectorAll('source').forEach(source => source.remove());
+    }
+}
+
 // ----------------------------------------------------------
 // 🔄 Utility: Update All Avatars with Permanent URL - WITH 404 FALLBACK
 // ----------------------------------------------------------
@@ -939,6 +953,9 @@ function updateAllAvatars(profilePictureUrl) {
                 this.style.display = 'none';
                 showPlaceholder();  // Trigger full placeholder reset
             };
+            if (imgElement.getAttribute('src') !== profilePictureUrl) {
+                dropResponsiveSources(imgElement);
+            }
             imgElement.src = fullUrl;
         }
 